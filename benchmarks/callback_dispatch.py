@@ -0,0 +1,106 @@
+"""
+Micro-benchmark of callback dispatch cost: aiogram handlers registered with a chain of
+`startswith` lambda filters (how main.py worked before) versus a single handler that
+routes by prefix and decodes the payload
+
+python -m benchmarks.callback_dispatch
+"""
+import asyncio
+import time
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import CallbackQuery, User
+
+from modules import callbacks
+
+SAMPLES = [
+    callbacks.START.encode('full'),
+    callbacks.MY.encode('2022-10-10'),
+    callbacks.DATE.encode('2022-10-10'),
+    callbacks.CHECKIN_MENU.encode('2022-10-10'),
+    callbacks.GROUP.encode('2022-10-10', 436),
+    callbacks.AUTO_CHECKIN.encode('2022-10-10', '436|0|10:00-11:30'),
+    callbacks.TRAINING.encode(123456),
+    callbacks.NOTIFICATION.encode(123456),
+    callbacks.FAST_CHECKIN.encode(123456),
+    callbacks.LOGOUT_NOW.encode(),
+    callbacks.DELETE.encode(),
+]
+
+LINEAR_FILTERS = [  # same order as handlers were registered in main.py
+    lambda c: c.data.startswith('start/'),
+    lambda c: c.data.startswith('my/'),
+    lambda c: c.data == 'change',
+    lambda c: c.data.startswith('date/'),
+    lambda c: c.data.startswith('ckin/'),
+    lambda c: c.data.startswith('gid/'),
+    lambda c: c.data.startswith('auto'),
+    lambda c: c.data == 'why',
+    lambda c: c.data.startswith('aid/'),
+    lambda c: c.data.startswith('unckin/'),
+    lambda c: c.data.startswith('tid/') or c.data.startswith('ntid/'),
+    lambda c: c.data.startswith('rawckin/') or c.data.startswith('rawnid/') or c.data.startswith('fckin/'),
+    lambda c: c.data == 'del',
+    lambda c: c.data.startswith('logout/'),
+    lambda c: c.data == 'logoutnow',
+]
+
+ROUTED_KINDS = [
+    callbacks.MY, callbacks.CHANGE_DAY, callbacks.DATE, callbacks.CHECKIN_MENU, callbacks.GROUP,
+    callbacks.AUTO_MENU, callbacks.WHY, callbacks.AUTO_CHECKIN, callbacks.UNCHECKIN_MENU, callbacks.TRAINING,
+    callbacks.NOTIFICATION, callbacks.RAW_CHECKIN, callbacks.RAW_NOTIFICATION, callbacks.FAST_CHECKIN,
+    callbacks.DELETE, callbacks.LOGOUT, callbacks.LOGOUT_NOW
+]
+
+
+async def _linear_handler(callback_query: CallbackQuery):
+    callback_query.data.split('/')
+
+
+async def _routed_handler(callback_query: CallbackQuery, payload):
+    pass
+
+
+def build_linear() -> Dispatcher:
+    dp = Dispatcher(Bot(token='123456:benchmark'))
+    for check in LINEAR_FILTERS:
+        dp.register_callback_query_handler(_linear_handler, check)
+    return dp
+
+
+def build_routed() -> Dispatcher:
+    dp = Dispatcher(Bot(token='123456:benchmark'))
+    router = callbacks.Router()
+    router.route(callbacks.START, requires_session=False)(_routed_handler)
+    router.route(*ROUTED_KINDS)(_routed_handler)
+    dp.register_callback_query_handler(router.dispatch, lambda c: router.is_public(c.data))
+    dp.register_callback_query_handler(router.dispatch)
+    return dp
+
+
+async def measure(dp: Dispatcher, queries: list, rounds: int) -> float:
+    User.set_current(queries[0].from_user)  # default state filter resolves storage address from it
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for query in queries:
+            await dp.callback_query_handlers.notify(query)
+    return (time.perf_counter() - start) / (rounds * len(queries))
+
+
+def main(rounds: int = 2000):
+    queries = [
+        CallbackQuery(**{'id': '1', 'from': {'id': 1, 'is_bot': False, 'first_name': 'bench'}, 'chat_instance': '1', 'data': data})
+        for data in SAMPLES
+    ]
+    loop = asyncio.new_event_loop()
+    for name, dp in [('linear filters', build_linear()), ('prefix router', build_routed())]:
+        seconds = min(loop.run_until_complete(measure(dp, queries, rounds)) for _ in range(5))
+        print(f'{name:>15}: {seconds * 1e6:6.2f} us per callback')
+    loop.close()
+
+    longest = max(SAMPLES, key=lambda data: len(data.encode()))
+    print(f'longest payload: {len(longest.encode())}/{callbacks.MAX_CALLBACK_BYTES} bytes ({longest})')
+
+
+if __name__ == '__main__':
+    main()
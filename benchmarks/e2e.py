@@ -0,0 +1,207 @@
+"""
+End-to-end benchmark: runs the real dispatcher and handlers against a fake sport site,
+a fake Bot API and the in-memory database, and replays user journeys
+`/now -> date/ -> ckin/ -> gid/ -> tid/` with given concurrency. Reports handler latency
+percentiles per step and number of upstream requests per journey
+
+python -m benchmarks.e2e --users 20 --journeys 3 --concurrency 5 --latency 0.05
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import time
+from datetime import datetime, timedelta
+
+from benchmarks.harness import FakeSportServer, FakeTelegram
+
+ADMIN_ID = 1
+STEPS = ('/now', 'date', 'ckin', 'gid', 'tid')
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def configure(sport: FakeSportServer, telegram: FakeTelegram) -> None:
+    """
+    Point the bot to the fakes. Must be called before `main` is imported
+    """
+    os.environ.update({
+        'BOT_TOKEN': '123456:benchmark',
+        'ADMIN_ID': str(ADMIN_ID),
+        'ADMIN_EMAIL': 'admin@innopolis.university',
+        'ADMIN_PSW': FakeSportServer.PASSWORD,
+        'DATABASE_URL': 'memory://',
+        'SPORT_SERVER_URL': sport.url,
+        'TELEGRAM_API_URL': telegram.url,
+        'TRACE_THRESHOLD': 'inf',  # do not write slow traces of the benchmark
+        'LOOP_STALL_THRESHOLD': '0',
+    })
+
+
+def register_users(main, count: int, offline_share: float) -> list:
+    from modules import api, database
+
+    main.SERVICE.maintain()  # service accounts log in before journeys are measured
+    user_ids = []
+    offline = int(count * offline_share)
+    for i in range(count):
+        user_id = 100000 + i
+        if i < offline:
+            database.create_user(user_id=user_id, student_id=str(5000 + i))
+        else:
+            session = api.login_user(f'user{i}@innopolis.university', FakeSportServer.PASSWORD)
+            database.create_user(
+                user_id=user_id,
+                student_id=session.cookies['student_id'],
+                session_id=session.cookies['sessionid'],
+                csrftoken=session.cookies['csrftoken']
+            )
+        user_ids.append(user_id)
+    return user_ids
+
+
+class Journey:
+    """
+    Builds updates of one user going through the check-in flow on given date
+    """
+    _update_ids = itertools.count(1)
+
+    def __init__(self, user_id: int, date: str, group_id: int, training_id: int):
+        self.user_id = user_id
+        self.date = date
+        self.group_id = group_id
+        self.training_id = training_id
+        self.message_id = user_id  # message with the photo that buttons belong to
+
+    def _user(self) -> dict:
+        return {'id': self.user_id, 'is_bot': False, 'first_name': f'user{self.user_id}'}
+
+    def _message(self, **fields) -> dict:
+        return {'message_id': self.message_id, 'date': int(time.time()), 'chat': {'id': self.user_id, 'type': 'private'}, **fields}
+
+    def command(self, text: str) -> dict:
+        return {
+            'update_id': next(self._update_ids),
+            'message': self._message(**{'from': self._user(), 'text': text, 'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]}),
+        }
+
+    def callback(self, data: str) -> dict:
+        return {
+            'update_id': next(self._update_ids),
+            'callback_query': {
+                'id': str(next(self._update_ids)),
+                'from': self._user(),
+                'chat_instance': str(self.user_id),
+                'data': data,
+                'message': self._message(photo=[{'file_id': 'photo', 'file_unique_id': 'photo', 'width': 1, 'height': 1}]),
+            }
+        }
+
+    def updates(self) -> list:
+        from modules import callbacks
+        return [
+            ('/now', self.command('/now')),
+            ('date', self.callback(callbacks.DATE.encode(self.date))),
+            ('ckin', self.callback(callbacks.CHECKIN_MENU.encode(self.date))),
+            ('gid', self.callback(callbacks.GROUP.encode(self.date, self.group_id))),
+            ('tid', self.callback(callbacks.TRAINING.encode(self.training_id))),
+        ]
+
+
+async def replay(main, journeys: list, concurrency: int) -> dict:
+    from aiogram import Bot, Dispatcher
+    from aiogram.types import Update
+
+    Bot.set_current(main.bot)
+    Dispatcher.set_current(main.dp)
+    latencies = {step: [] for step in STEPS}
+    totals = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(journey: Journey):
+        async with semaphore:
+            journey_start = time.perf_counter()
+            for step, data in journey.updates():
+                start = time.perf_counter()
+                await main.dp.updates_handler.notify(Update.to_object(data))
+                latencies[step].append(time.perf_counter() - start)
+            totals.append(time.perf_counter() - journey_start)
+
+    await asyncio.gather(*(run(journey) for journey in journeys))
+    latencies['journey'] = totals
+    return latencies
+
+
+async def close_bot_session(bot) -> None:
+    session = await bot.get_session()
+    await session.close()
+
+
+def report(latencies: dict, wall: float, journeys: int, sport: FakeSportServer, telegram: FakeTelegram) -> str:
+    lines = [f'{journeys} journeys in {wall:.1f}s ({journeys / wall:.2f} journeys/s)', '']
+    lines.append(f'{"step":>8} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"max ms":>9}')
+    for step, values in latencies.items():
+        lines.append(
+            f'{step:>8} ' + ' '.join(f'{percentile(values, q) * 1000:9.1f}' for q in (0.5, 0.95, 0.99)) +
+            f' {max(values, default=0) * 1000:9.1f}'
+        )
+    for title, server in (('sport site', sport), ('telegram', telegram)):
+        total = sum(server.requests.values())
+        lines.append('')
+        lines.append(f'{title}: {total} requests ({total / journeys:.1f} per journey)')
+        for endpoint, amount in server.requests.most_common():
+            lines.append(f'  {endpoint}: {amount} ({amount / journeys:.1f} per journey)')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--journeys', type=int, default=3, help='journeys per user')
+    parser.add_argument('--concurrency', type=int, default=5, help='journeys replayed at the same time')
+    parser.add_argument('--latency', type=float, default=0.0, help='sport site response delay, seconds')
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help='Bot API response delay, seconds')
+    parser.add_argument('--offline-share', type=float, default=0.0, help='share of users in offline mode')
+    parser.add_argument('--groups', type=int, default=12, help='sport groups in the fake schedule')
+    args = parser.parse_args()
+
+    sport = FakeSportServer(groups=args.groups, latency=args.latency).start()
+    telegram = FakeTelegram(latency=args.telegram_latency).start()
+    configure(sport, telegram)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)  # main starts its scheduler on import
+    import main as bot_main
+    bot_main.scheduler.pause()  # only handlers are measured, see benchmarks/scheduler_load.py for jobs
+
+    user_ids = register_users(bot_main, args.users, args.offline_share)
+    day = datetime.now().date() + timedelta(days=1)  # tomorrow, so check-ins are open
+    trainings = sport.day_trainings(day)
+    journeys = [
+        Journey(user_id, day.isoformat(), trainings[i % len(trainings)]['group_id'], trainings[i % len(trainings)]['id'])
+        for i, user_id in enumerate(user_ids * args.journeys)
+    ]
+
+    sport.reset_counters()
+    telegram.reset_counters()
+    start = time.perf_counter()
+    latencies = loop.run_until_complete(replay(bot_main, journeys, args.concurrency))
+    wall = time.perf_counter() - start
+    print(report(latencies, wall, len(journeys), sport, telegram))
+
+    for user_id in user_ids:  # renders of benchmark users
+        if os.path.isfile(f'images/{user_id}.png'):
+            os.remove(f'images/{user_id}.png')
+    bot_main.scheduler.shutdown(wait=False)
+    loop.run_until_complete(close_bot_session(bot_main.bot))
+    sport.stop()
+    telegram.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,403 @@
+"""
+Fake sport site and fake Telegram Bot API used by end-to-end benchmarks. Both run
+in background threads (like the /metrics endpoint), so blocking `requests` calls made
+by the bot on its event loop are answered without help from that loop
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from http.cookies import SimpleCookie
+from urllib.parse import urlparse, parse_qs
+from collections import Counter
+from datetime import datetime, timedelta, date as date_type
+import threading
+import random
+import json
+import re
+import time
+
+SLOTS = ('09:00', '10:40', '12:40', '14:20', '16:00', '17:40', '19:20')
+TRAINING_MINUTES = 90
+
+
+def _endpoint(path: str) -> str:
+    """
+    Request path with ids replaced by placeholders (`/api/training/{id}`), used as counter key
+    """
+    return '/'.join('{id}' if part.isdigit() else part for part in path.split('/'))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real servers
+    disable_nagle_algorithm = True  # otherwise delayed ACKs add ~40ms to every keep-alive request
+    server: '_Server'
+
+    def _body(self) -> bytes:
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                chunk = self.rfile.read(size + 2)[:size]  # chunk and its trailing CRLF
+                if size == 0:
+                    break
+                chunks.append(chunk)
+            return b''.join(chunks)
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _handle(self, method: str):
+        url = urlparse(self.path)
+        body = self._body()
+        cookies = {key: morsel.value for key, morsel in SimpleCookie(self.headers.get('Cookie', '')).items()}
+        self.server.owner.count(method, url.path)
+        status, content_type, payload, headers = self.server.owner.handle(method, url.path, parse_qs(url.query), body, cookies, self.headers)
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, owner, host: str, port: int):
+        super().__init__((host, port), _Handler)
+        self.owner = owner
+
+
+class FakeServer:
+    """
+    Base of the fake servers: threaded http server with request counters and optional latency
+    """
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0, jitter: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.requests = Counter()
+        self._lock = threading.Lock()
+        self._server = _Server(self, host, port)
+        self.url = f'http://{host}:{self._server.server_address[1]}'
+
+    def start(self) -> 'FakeServer':
+        threading.Thread(target=self._server.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def count(self, method: str, path: str) -> None:
+        with self._lock:
+            self.requests[f'{method} {_endpoint(path)}'] += 1
+
+    def reset_counters(self) -> None:
+        with self._lock:
+            self.requests.clear()
+
+    def wait(self) -> None:
+        delay = self.latency + (random.uniform(-self.jitter, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def handle(self, method: str, path: str, query: dict, body: bytes, cookies: dict, headers) -> tuple:
+        raise NotImplementedError
+
+
+def _json(data, status: int = 200, headers: list = ()) -> tuple:
+    return status, 'application/json', json.dumps(data), list(headers)
+
+
+def _html(text: str, status: int = 200, headers: list = ()) -> tuple:
+    return status, 'text/html; charset=utf-8', text, list(headers)
+
+
+class FakeSportServer(FakeServer):
+    """
+    Synthetic sport.innopolis.university: `groups` sport groups with trainings in SLOTS every day
+    of the semester (about a month back and two months ahead). Training ids encode day, group
+    and slot, so schedule is generated lazily; only loads and check-ins are stored.
+    Any email logs in with `password`, every other password is rejected like the real form does
+    """
+    PASSWORD = 'password'
+
+    def __init__(self, groups: int = 12, capacity: int = 20, slots_per_group: int = 2, seed: int = 1, **kwargs):
+        super().__init__(**kwargs)
+        self.groups = groups
+        self.capacity = capacity
+        self.slots_per_group = slots_per_group
+        today = datetime.now().date()
+        self.semester_start = today - timedelta(days=30)
+        self.semester_end = today + timedelta(days=60)
+        self._random = random.Random(seed)
+        self._loads = dict()  # training_id -> taken seats
+        self._checkins = dict()  # training_id -> set of student ids
+        self._sessions = dict()  # sessionid -> student_id
+        self._students = dict()  # email -> student_id
+        self._state = threading.RLock()
+
+    # Schedule
+
+    def training_id(self, day: date_type, group_id: int, slot: int) -> int:
+        return (day.toordinal() * 100 + group_id) * 10 + slot
+
+    def group_slots(self, group_id: int) -> list:
+        return [(group_id * 3 + i * 2) % len(SLOTS) for i in range(self.slots_per_group)]
+
+    def training(self, training_id: int) -> dict or None:
+        rest, slot = divmod(training_id, 10)
+        ordinal, group_id = divmod(rest, 100)
+        if not 1 <= group_id <= self.groups or slot not in self.group_slots(group_id):
+            return None
+        try:
+            day = date_type.fromordinal(ordinal)
+        except ValueError:
+            return None
+        if not self.semester_start <= day <= self.semester_end:
+            return None
+        start = datetime.combine(day, datetime.strptime(SLOTS[slot], '%H:%M').time())
+        return {
+            'id': training_id,
+            'group_id': group_id,
+            'title': f'Sport group {group_id}',
+            'start': start,
+            'end': start + timedelta(minutes=TRAINING_MINUTES),
+        }
+
+    def day_trainings(self, day: date_type) -> list:
+        if not self.semester_start <= day <= self.semester_end:
+            return []
+        return [
+            self.training(self.training_id(day, group_id, slot))
+            for group_id in range(1, self.groups + 1)
+            for slot in self.group_slots(group_id)
+        ]
+
+    def trainings_between(self, start: date_type, end: date_type) -> list:
+        trainings = []
+        while start <= end:
+            trainings.extend(self.day_trainings(start))
+            start += timedelta(days=1)
+        return trainings
+
+    def load(self, training_id: int) -> int:
+        with self._state:
+            if training_id not in self._loads:
+                self._loads[training_id] = random.Random(training_id).randint(self.capacity // 2, self.capacity)
+            return self._loads[training_id]
+
+    def set_load(self, training_id: int, load: int) -> None:
+        with self._state:
+            self._loads[training_id] = max(0, min(self.capacity, load))
+
+    def churn(self, training_ids: list, probability: float) -> list:
+        """
+        Randomly free or take one seat in every training with given probability,
+        returns ids of trainings where a seat was freed
+        """
+        freed = []
+        for training_id in training_ids:
+            if self._random.random() >= probability:
+                continue
+            load = self.load(training_id)
+            if self._random.random() < 0.5 and load > 0:
+                self.set_load(training_id, load - 1)
+                freed.append(training_id)
+            else:
+                self.set_load(training_id, load + 1)
+        return freed
+
+    def can_check_in(self, training: dict, student_id: str or None) -> bool:
+        now = datetime.now()
+        return (
+            student_id is not None
+            and now < training['start'] <= now + timedelta(days=7)
+            and student_id not in self._checkins.get(training['id'], ())
+            and self.load(training['id']) < self.capacity
+        )
+
+    # Accounts
+
+    def student_id(self, email: str) -> str:
+        with self._state:
+            if email not in self._students:
+                self._students[email] = str(1000 + len(self._students))
+            return self._students[email]
+
+    def _login_page(self) -> tuple:
+        return _html(
+            '<html><body>'
+            f'<form id="options" method="post" action="{self.url}/adfs/ls/?client-request-id=benchmark">'
+            '<input name="UserName"><input name="Password"></form>'
+            '</body></html>'
+        )
+
+    def issue_session(self, email: str) -> tuple:
+        """
+        Log user in without the login form (bulk setup of simulations), returns student_id and session id
+        """
+        student_id = self.student_id(email)
+        with self._state:
+            session_id = f'session-{student_id}-{self._random.getrandbits(32):08x}'
+            self._sessions[session_id] = student_id
+        return student_id, session_id
+
+    def _login(self, body: bytes) -> tuple:
+        form = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+        if form.get('Password') != self.PASSWORD:
+            return _html('<html><body><div id="error">Incorrect user ID or password.</div></body></html>')
+        student_id, session_id = self.issue_session(form.get('UserName', ''))
+        return _html(
+            '<html><body><div class="card-body"><script>\n'
+            f'  var student_id = "{student_id}";\n'
+            '</script></div></body></html>',
+            headers=[
+                ('Set-Cookie', f'sessionid={session_id}; Path=/'),
+                ('Set-Cookie', f'csrftoken=csrf-{student_id}; Path=/'),
+            ]
+        )
+
+    def _profile(self) -> tuple:
+        start, end = (day.strftime('%b %d, %Y') for day in (self.semester_start, self.semester_end))
+        return _html(
+            '<html><body><div id="semester-hours"><table>'
+            '<tr><th>Start</th><th>End</th><th>Hours</th></tr>'
+            f'<tr><td>{start}</td><td>{end}.</td><td>0</td></tr>'
+            '</table></div></body></html>'
+        )
+
+    def _event(self, training: dict, student_id: str) -> dict:
+        return {
+            'title': training['title'],
+            'start': training['start'].isoformat() + '+03:00',
+            'end': training['end'].isoformat() + '+03:00',
+            'allDay': False,
+            'extendedProps': {
+                'id': training['id'],
+                'group_id': training['group_id'],
+                'training_class': None,
+                'can_edit': False,
+                'can_grade': False,
+                'can_check_in': self.can_check_in(training, student_id),
+                'checked_in': student_id in self._checkins.get(training['id'], ()),
+            }
+        }
+
+    def _calendar(self, query: dict, student_id: str) -> tuple:
+        start = datetime.fromisoformat(query['start'][0]).date()
+        end = datetime.fromisoformat(query['end'][0]).date()
+        return _json([self._event(training, student_id) for training in self.trainings_between(start, end)])
+
+    def _training_info(self, training: dict, student_id: str) -> tuple:
+        return _json({
+            'training': {
+                'id': training['id'],
+                'start': training['start'].isoformat() + '+03:00',
+                'end': training['end'].isoformat() + '+03:00',
+                'load': self.load(training['id']),
+                'group': {'id': training['group_id'], 'name': training['title'], 'capacity': self.capacity},
+            },
+            'can_check_in': self.can_check_in(training, student_id),
+            'checked_in': student_id in self._checkins.get(training['id'], ()),
+        })
+
+    def _group_info(self, group_id: int) -> tuple:
+        return _json({
+            'group_name': f'Sport group {group_id}',
+            'trainers': [{
+                'trainer_first_name': 'Иван',
+                'trainer_last_name': f'Тренеров{group_id}',
+                'trainer_email': f'trainer{group_id}@innopolis.university',
+            }],
+        })
+
+    def _check_in(self, training: dict, student_id: str, cancel: bool) -> tuple:
+        with self._state:
+            checked_in = self._checkins.setdefault(training['id'], set())
+            if cancel and student_id in checked_in:
+                checked_in.discard(student_id)
+                self.set_load(training['id'], self.load(training['id']) - 1)
+            elif not cancel and self.can_check_in(training, student_id):
+                checked_in.add(student_id)
+                self.set_load(training['id'], self.load(training['id']) + 1)
+        return _json({})
+
+    def handle(self, method: str, path: str, query: dict, body: bytes, cookies: dict, headers) -> tuple:
+        self.wait()
+        if path == '/':
+            return _html('<html><body>Sport</body></html>')
+        if path == '/oauth2/login':
+            return self._login_page()
+        if path.startswith('/adfs/ls'):
+            return self._login(body)
+
+        student_id = self._sessions.get(cookies.get('sessionid'))
+        parts = path.strip('/').split('/')
+        if parts[:2] == ['api', 'attendance'] and len(parts) == 4:  # works without session like the real site
+            return _json({'final_hours': 12} if parts[3] == 'negative_hours' else 42.5)
+        if student_id is None:
+            return _html('<html><body>Please log in</body></html>', status=403)
+        if path == '/profile':
+            return self._profile()
+        if path == '/api/calendar/trainings':
+            return self._calendar(query, student_id)
+        if parts[:2] == ['api', 'group'] and len(parts) == 3:
+            return self._group_info(int(parts[2]))
+        if parts[:2] == ['api', 'training'] and len(parts) >= 3:
+            training = self.training(int(parts[2]))
+            if training is None:
+                return _json({'detail': 'Not found.'}, status=404)
+            if len(parts) == 3:
+                return self._training_info(training, student_id)
+            if method == 'POST' and parts[3] in ('check_in', 'cancel_check_in'):
+                return self._check_in(training, student_id, cancel=parts[3] == 'cancel_check_in')
+        return _html('<html><body>Not found</body></html>', status=404)
+
+
+class FakeTelegram(FakeServer):
+    """
+    Bot API endpoint (`TELEGRAM_API_URL`) that accepts every method, counts calls by method
+    and answers with minimal valid objects. Sent messages without files are recorded in `sent`
+    as (monotonic time, method, parameters)
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.sent = []
+        self._message_ids = iter(range(1, 1 << 62))
+
+    def count(self, method: str, path: str) -> None:
+        with self._lock:
+            self.requests[path.rsplit('/', 1)[-1]] += 1
+
+    def handle(self, method: str, path: str, query: dict, body: bytes, cookies: dict, headers) -> tuple:
+        self.wait()
+        name = path.rsplit('/', 1)[-1]
+        params = dict()
+        if headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+            params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+            if name.startswith('send'):
+                with self._lock:
+                    self.sent.append((time.monotonic(), name, params))
+        else:
+            chat_id = re.search(rb'name="chat_id"\r\n(?:[^\r\n]*\r\n)*?\r\n(-?\d+)', body)
+            if chat_id is not None:
+                params['chat_id'] = chat_id.group(1).decode()
+        if name == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        elif name in ('answerCallbackQuery', 'deleteMessage', 'setWebhook', 'deleteWebhook'):
+            result = True
+        else:
+            with self._lock:
+                message_id = next(self._message_ids)
+            chat_id = int(params.get('chat_id', 0))
+            result = {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}}
+        return _json({'ok': True, 'result': result})
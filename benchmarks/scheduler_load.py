@@ -0,0 +1,208 @@
+"""
+Scheduler load simulator: fills the in-memory database with synthetic users, auto-checkins
+and notifications, runs `handle_notifications` and `handle_check_in` on their intervals
+against the fake sport site while seats are freed and taken in the background, and reports
+pass durations, missed intervals, seat-freed-to-notified delay and upstream request volume
+
+python -m benchmarks.scheduler_load --users 5000 --auto-checkins 20000 --watched 1000 --latency 0.01
+"""
+import argparse
+import asyncio
+import threading
+import time
+from datetime import datetime, timedelta
+
+from benchmarks.e2e import close_bot_session, configure, percentile
+from benchmarks.harness import FakeSportServer, FakeTelegram
+
+
+def auto_checkin_keys(sport: FakeSportServer) -> list:
+    """
+    All `group|weekday|start-end` keys of the fake schedule with ids of their upcoming trainings
+    """
+    keys = dict()
+    for training in sport.trainings_between(datetime.now().date() + timedelta(days=1), sport.semester_end):
+        start, end = training['start'], training['end']
+        key = f"{training['group_id']}|{start.weekday()}|{start.strftime('%H:%M')}-{end.strftime('%H:%M')}"
+        keys.setdefault(key, []).append(training['id'])
+    return sorted(keys.items())
+
+
+def populate(main, sport: FakeSportServer, users: int, auto_checkins: int, watched: int, watchers: int) -> dict:
+    """
+    Synthetic database: `users` full-mode users, `auto_checkins` keys spread evenly between them and
+    `watched` full trainings of the next week with `watchers` users waiting for a seat in each one
+    """
+    from modules import database
+
+    main.SERVICE.maintain()  # service accounts log in before the jobs are measured
+    user_ids = [100000 + i for i in range(users)]
+    with database.Batch() as batch:
+        for i, user_id in enumerate(user_ids):
+            student_id, session_id = sport.issue_session(f'user{i}@innopolis.university')
+            database.create_user(user_id, student_id, session_id, f'csrf-{student_id}', batch=batch)
+
+    keys = auto_checkin_keys(sport)
+    with database.Batch() as batch:
+        for i in range(auto_checkins):
+            user_index, key_index = i % users, i // users  # key_index-th key of the user
+            training_key, training_ids = keys[(user_index * 7 + key_index) % len(keys)]
+            batch.set(f'/auto_checkin/{user_ids[user_index]}/{training_key}', training_ids)
+
+    upcoming = [
+        training['id'] for training in
+        sport.trainings_between(datetime.now().date() + timedelta(days=1), datetime.now().date() + timedelta(days=7))
+    ]
+    watched_ids = upcoming[:watched]
+    if len(watched_ids) < watched:
+        print(f'Only {len(watched_ids)} trainings in the next week, use more --groups to watch {watched}')
+    waiting = dict()
+    for i, training_id in enumerate(watched_ids):
+        sport.set_load(training_id, sport.capacity)  # seats have to free up before anybody is notified
+        waiting[training_id] = {user_ids[(i * watchers + j) % users] for j in range(watchers)}
+        for user_id in waiting[training_id]:
+            database.add_user_notification(training_id, user_id)
+    return waiting
+
+
+class Churn:
+    """
+    Background thread that frees or takes seats of watched trainings and remembers
+    when a seat was freed for the first time
+    """
+    def __init__(self, sport: FakeSportServer, training_ids: list, probability: float, interval: float):
+        self.sport = sport
+        self.training_ids = training_ids
+        self.probability = probability
+        self.interval = interval
+        self.freed = dict()  # training_id -> monotonic time of the first freed seat
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        threading.Thread(target=self._run, name='seat-churn', daemon=True).start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            now = time.monotonic()
+            for training_id in self.sport.churn(self.training_ids, self.probability):
+                self.freed.setdefault(training_id, now)
+
+
+async def run_job(job, interval: float, duration: float) -> dict:
+    """
+    Run job every `interval` seconds like the scheduler does (one instance at a time,
+    ticks that come while the job is still running are missed)
+    """
+    durations = []
+    missed = 0
+    start = time.monotonic()
+    next_run = start
+    while next_run < start + duration:
+        await asyncio.sleep(max(0.0, next_run - time.monotonic()))
+        pass_start = time.monotonic()
+        await job()
+        finished = time.monotonic()
+        durations.append(finished - pass_start)
+        ticks = int((finished - start) // interval) + 1
+        missed += max(0, ticks - int((next_run - start) // interval) - 1)
+        next_run = start + ticks * interval
+    return {'durations': durations, 'missed': missed}
+
+
+def notification_delays(churn: Churn, telegram: FakeTelegram, waiting: dict) -> tuple:
+    """
+    Delay between the first freed seat and the first "available place" message to a watcher
+    of that training, and the number of freed trainings nobody was told about
+    """
+    first_sent = dict()  # chat_id -> monotonic time
+    for sent_at, method, params in list(telegram.sent):
+        if method == 'sendMessage' and params.get('text', '').startswith('There is one available place'):
+            first_sent.setdefault(int(params['chat_id']), sent_at)
+    delays = []
+    unnoticed = 0
+    for training_id, freed_at in churn.freed.items():
+        sent = [first_sent[user_id] for user_id in waiting[training_id] if first_sent.get(user_id, 0) >= freed_at]
+        if sent:
+            delays.append(min(sent) - freed_at)
+        else:
+            unnoticed += 1
+    return delays, unnoticed
+
+
+def describe(values: list, unit: float = 1.0) -> str:
+    if not values:
+        return 'no data'
+    return (
+        f'p50 {percentile(values, 0.5) * unit:.2f}s, p95 {percentile(values, 0.95) * unit:.2f}s, '
+        f'p99 {percentile(values, 0.99) * unit:.2f}s, max {max(values) * unit:.2f}s'
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--auto-checkins', type=int, default=20000, help='auto-checkin keys in total')
+    parser.add_argument('--watched', type=int, default=1000, help='trainings with notifications')
+    parser.add_argument('--watchers', type=int, default=2, help='users waiting for a seat in every watched training')
+    parser.add_argument('--groups', type=int, default=80, help='sport groups in the fake schedule')
+    parser.add_argument('--latency', type=float, default=0.0, help='sport site response delay, seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random +- addition to the latency, seconds')
+    parser.add_argument('--churn', type=float, default=0.01, help='probability of a seat change per training per churn tick')
+    parser.add_argument('--churn-interval', type=float, default=1.0, help='seconds between churn ticks')
+    parser.add_argument('--interval', type=float, default=30, help='scheduler interval of both jobs, seconds')
+    parser.add_argument('--duration', type=float, default=300, help='simulated run time, seconds')
+    args = parser.parse_args()
+
+    sport = FakeSportServer(groups=args.groups, latency=args.latency, jitter=args.jitter).start()
+    telegram = FakeTelegram().start()
+    configure(sport, telegram)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)  # main starts its scheduler on import
+    import main as bot_main
+    bot_main.scheduler.pause()  # jobs are driven by the simulator
+
+    setup_start = time.perf_counter()
+    waiting = populate(bot_main, sport, args.users, args.auto_checkins, args.watched, args.watchers)
+    print(f'Synthetic data created in {time.perf_counter() - setup_start:.1f}s')
+
+    sport.reset_counters()
+    telegram.reset_counters()
+    churn = Churn(sport, list(waiting), args.churn, args.churn_interval)
+    churn.start()
+    start = time.perf_counter()
+    notifications, check_in = loop.run_until_complete(asyncio.gather(
+        run_job(bot_main.handle_notifications, args.interval, args.duration),
+        run_job(bot_main.handle_check_in, args.interval, args.duration),
+    ))
+    wall = time.perf_counter() - start
+    churn.stop()
+
+    delays, unnoticed = notification_delays(churn, telegram, waiting)
+    lines = [f'Simulated {wall:.0f}s with {args.interval:g}s interval', '']
+    for name, result in (('handle_notifications', notifications), ('handle_check_in', check_in)):
+        lines.append(f'{name}: {len(result["durations"])} passes, {result["missed"]} missed intervals')
+        lines.append(f'  pass duration: {describe(result["durations"])}')
+    lines.append('')
+    lines.append(f'Seat freed -> watcher notified ({len(delays)} trainings): {describe(delays)}')
+    lines.append(f'Freed trainings without notification by the end: {unnoticed}')
+    lines.append(f'Sessions: {bot_main.SESSIONS.stats()}')
+    for title, server in (('sport site', sport), ('telegram', telegram)):
+        total = sum(server.requests.values())
+        lines.append('')
+        lines.append(f'{title}: {total} requests ({total / wall:.1f}/s)')
+        for endpoint, amount in server.requests.most_common():
+            lines.append(f'  {endpoint}: {amount}')
+    print('\n'.join(lines))
+
+    bot_main.scheduler.shutdown(wait=False)
+    loop.run_until_complete(close_bot_session(bot_main.bot))
+    sport.stop()
+    telegram.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Micro-benchmark of the HTML scrapers: full `html.parser` trees (how api.py parsed pages before)
+versus parsing only the needed elements with the configured parser backend (`api.PARSER`).
+
+Pages are synthetic by default: they copy the structure of the real ADFS login page, the page
+after login and /profile (inline styles and scripts, navigation, tables) at a similar size, but
+they are not captured from the site. Put captured pages into a directory as `login.html`,
+`auth.html` and `profile.html` and pass it with --fixtures to measure on them
+
+python -m benchmarks.scrapers --rounds 200
+"""
+import argparse
+import os
+import time
+
+from bs4 import BeautifulSoup
+
+from modules import api
+
+FILLER_STYLE = ''.join(f'.c{i}{{margin:{i % 7}px;padding:{i % 5}px;color:#{i * 2654435761 % 0xffffff:06x}}}\n' for i in range(600))
+FILLER_SCRIPT = ''.join(f'function f{i}(a,b){{return a<b?"{"x" * (i % 40)}":b+{i};}}\n' for i in range(500))
+
+
+def _navigation(links: int) -> str:
+    return '<nav><ul>' + ''.join(f'<li class="nav-item"><a class="nav-link" href="/page/{i}">Page {i}</a></li>' for i in range(links)) + '</ul></nav>'
+
+
+def login_page() -> str:
+    return (
+        f'<!DOCTYPE html><html lang="en"><head><meta charset="utf-8"><title>Sign In</title><style>{FILLER_STYLE}</style>'
+        f'<script>{FILLER_SCRIPT}</script></head><body><div id="fullPage"><div id="contentWrapper"><div id="content">'
+        '<div id="header"><img class="logoImage" src="/adfs/portal/logo/logo.png" alt="Innopolis University"></div>'
+        '<div id="workArea"><div id="authArea" class="groupMargin"><div id="loginArea">'
+        '<div id="loginMessage" class="groupMargin">Sign in with your organizational account</div>'
+        '<form method="post" id="loginForm" autocomplete="off" novalidate="novalidate" onKeyPress="if (event && event.keyCode == 13) Login.submitLoginRequest();" action="/adfs/ls/?client-request-id=placeholder">'
+        '<div id="formsAuthenticationArea"><div id="userNameArea"><input id="userNameInput" name="UserName" type="email" class="text fullWidth"></div>'
+        '<div id="passwordArea"><input id="passwordInput" name="Password" type="password" class="text fullWidth"></div>'
+        '<div id="submissionArea" class="submitMargin"><span id="submitButton" class="submit" tabindex="4">Sign in</span></div></div>'
+        '<input id="optionForms" type="hidden" name="AuthMethod" value="FormsAuthentication"></form>'
+        '<form id="options" method="post" action="https://sso.university.innopolis.ru/adfs/oauth2/authorize/?client-request-id=benchmark">'
+        '<script type="text/javascript">function SelectOption(option) { document.forms["options"].submit(); }</script>'
+        '<input id="optionSelection" type="hidden" name="AuthMethod"></form>'
+        '</div></div></div></div></div>'
+        f'<div id="footerPlaceholder"></div><script>{FILLER_SCRIPT}</script></div></body></html>'
+    )
+
+
+def auth_page(student_id: str = '12345') -> str:
+    return (
+        f'<!DOCTYPE html><html lang="en"><head><meta charset="utf-8"><title>Sport</title><style>{FILLER_STYLE}</style></head><body>'
+        f'<header>{_navigation(40)}</header><main class="container">'
+        + ''.join(f'<div class="card"><div class="card-header">News {i}</div><p>{"Lorem ipsum dolor sit amet. " * 8}</p></div>' for i in range(30))
+        + '<div class="card"><div class="card-body"><script>\n'
+        f'  var student_id = "{student_id}";\n'
+        '  window.student = {id: student_id};\n'
+        '</script><h5 class="card-title">Student</h5></div></div>'
+        f'</main><script>{FILLER_SCRIPT}</script></body></html>'
+    )
+
+
+def profile_page() -> str:
+    trainings = ''.join(
+        f'<tr><td>Sport group {i % 40}</td><td>{["Mon", "Tue", "Wed"][i % 3]} {10 + i % 8}:00</td><td>{i % 3}</td><td><a href="/training/{i}">details</a></td></tr>'
+        for i in range(400)
+    )
+    return (
+        f'<!DOCTYPE html><html lang="en"><head><meta charset="utf-8"><title>Profile</title><style>{FILLER_STYLE}</style></head><body>'
+        f'<header>{_navigation(40)}</header><main class="container">'
+        '<div id="semester-hours"><table class="table">'
+        '<tr><th>Semester start</th><th>Semester end</th><th>Hours</th></tr>'
+        '<tr><td>Aug. 29, 2026</td><td>Dec. 25, 2026</td><td>12</td></tr>'
+        '</table></div>'
+        f'<div id="trainings"><table class="table">{trainings}</table></div>'
+        f'</main><script>{FILLER_SCRIPT}</script></body></html>'
+    )
+
+
+def fixtures(directory: str = None) -> dict:
+    if directory is None:
+        return {'login': login_page(), 'auth': auth_page(), 'profile': profile_page()}
+    pages = dict()
+    for name in ('login', 'auth', 'profile'):
+        with open(os.path.join(directory, f'{name}.html'), 'rb') as file:
+            pages[name] = file.read()
+    return pages
+
+
+def full_tree(pages: dict) -> tuple:
+    """
+    Previous scrapers: whole pages with html.parser
+    """
+    action = BeautifulSoup(pages['login'], 'html.parser').find('form', {'id': 'options'}).get('action')
+    bs = BeautifulSoup(pages['auth'], 'html.parser')
+    error = bs.find('div', {'id': 'error'})
+    student_id = bs.find('div', {'class': 'card-body'}).find('script').text.split('\n')[1].split('"')[1]
+    bs = BeautifulSoup(pages['profile'], 'html.parser')
+    cells = bs.find('div', {'id': 'semester-hours'}).find_all('tr', limit=2)[1].find_all('td', limit=2)
+    return action, error, student_id, [cell.text for cell in cells]
+
+
+def targeted(pages: dict) -> tuple:
+    """
+    Current scrapers: only needed elements with api.PARSER
+    """
+    action = BeautifulSoup(pages['login'], api.PARSER, parse_only=api.LOGIN_FORM).find('form', {'id': 'options'}).get('action')
+    bs = BeautifulSoup(pages['auth'], api.PARSER, parse_only=api.AUTH_RESULT)
+    error = bs.find('div', {'id': 'error'})
+    student_id = bs.find('div', {'class': 'card-body'}).find('script').text.split('\n')[1].split('"')[1]
+    semester = api.parse_semester_start_end_dates(pages['profile'])
+    return action, error, student_id, semester
+
+
+def measure(function, pages: dict, rounds: int) -> float:
+    function(pages)  # warm up
+    start = time.perf_counter()
+    for _ in range(rounds):
+        function(pages)
+    return (time.perf_counter() - start) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rounds', type=int, default=200)
+    parser.add_argument('--fixtures', help='directory with captured login.html, auth.html and profile.html')
+    args = parser.parse_args()
+
+    pages = fixtures(args.fixtures)
+    print(f'Pages ({"captured" if args.fixtures else "synthetic"}): ' + ', '.join(f'{name} {len(page) / 1024:.0f} KB' for name, page in pages.items()))
+    print(f'Parser backend: {api.PARSER}')
+    print(f'Results: {targeted(pages)}')
+    before = measure(full_tree, pages, args.rounds)
+    after = measure(targeted, pages, args.rounds)
+    print(f'full html.parser trees: {before * 1000:8.2f} ms per login + semester')
+    print(f'targeted parsing:       {after * 1000:8.2f} ms per login + semester ({before / after:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
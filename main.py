@@ -1,5 +1,8 @@
 import datetime
+import asyncio
 import logging
+import time
+import io
 import atexit
 from os import getenv
 import calendar
@@ -7,16 +10,17 @@ import random
 
 import dotenv
 from aiogram import Bot, Dispatcher, executor
-from aiogram.types import Message, CallbackQuery
+from aiogram.bot.api import TelegramAPIServer
+from aiogram.types import Message, CallbackQuery, Update, InputFile
+from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.types.input_media import InputMediaPhoto
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher.filters.state import State, StatesGroup
-from aiogram.utils.exceptions import MessageNotModified
 from aiogram.dispatcher import FSMContext
 from requests.exceptions import ContentDecodingError, ConnectionError, RetryError
+from requests.sessions import Session
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-from modules import api, database, generators
+from modules import api, callbacks, changes, cluster, database, generators, metrics, occupancy, outputs, profiler, reference, schedule, service, sessions, tracing, upstream, user_stats, watchdog, webhook, week_view
 
 # Configure logging
 logging.basicConfig(
@@ -38,12 +42,139 @@ if ADMIN_ID is None:
 else:
     ADMIN_ID = int(ADMIN_ID)
 
+MAX_SESSIONS = int(getenv('MAX_SESSIONS', 1000))
+SESSION_MAX_AGE = int(getenv('SESSION_MAX_AGE', 3600))
+
+# Serving mode: `polling` (default) or `webhook`
+BOT_MODE = getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = getenv('WEBHOOK_URL')  # public https base url that telegram will call
+WEBHOOK_PATH = getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = getenv('WEBHOOK_SECRET')
+WEBAPP_HOST = getenv('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(getenv('WEBAPP_PORT', 8080))
+UPDATE_WORKERS = int(getenv('UPDATE_WORKERS', 4))
+TELEGRAM_API_URL = getenv('TELEGRAM_API_URL')  # e.g. local bot api server or fake endpoint for tests
+
+# Multi-worker mode: per-user jobs are sharded by user_id, global jobs run on the lease holder only
+WORKER_INDEX = int(getenv('WORKER_INDEX', 0))
+WORKER_COUNT = int(getenv('WORKER_COUNT', 1))
+REDIS_URL = getenv('REDIS_URL')  # shared FSM storage, required when WORKER_COUNT > 1
+
+if WORKER_COUNT > 1 and REDIS_URL is None:
+    logging.critical('No REDIS_URL variable found in project environment (required for multi-worker mode)')
+if WORKER_COUNT > 1 and BOT_MODE != 'webhook':
+    logging.critical('Multi-worker mode requires BOT_MODE=webhook, telegram does not allow concurrent polling with one token')
+    raise SystemExit(1)
+
+tracing.THRESHOLD = float(getenv('TRACE_THRESHOLD', tracing.THRESHOLD))
+tracing.OUTPUT_FILE = getenv('TRACE_FILE', tracing.OUTPUT_FILE)
+
+LOOP_STALL_THRESHOLD = float(getenv('LOOP_STALL_THRESHOLD', 0.5))  # seconds, 0 disables watchdog
+
+# Public schedule cache shared by offline views, kept warm by a scheduler job
+schedule.DAY_TTL = float(getenv('SCHEDULE_TTL', schedule.DAY_TTL))
+schedule.CAPACITY_TTL = float(getenv('CAPACITY_TTL', schedule.CAPACITY_TTL))
+WARMUP_INTERVAL = int(getenv('WARMUP_INTERVAL', 5))  # minutes, 0 disables warm-up
+SCHEDULE_CHANGES_INTERVAL = int(getenv('SCHEDULE_CHANGES_INTERVAL', 10))  # minutes, 0 disables change detector
+
+# Trainers and semester dates survive restarts in a file and are refreshed in background
+reference.FILE = getenv('REFERENCE_CACHE_FILE', reference.FILE)
+reference.TEACHERS_TTL = float(getenv('TEACHERS_TTL', reference.TEACHERS_TTL))
+REFERENCE_REFRESH_INTERVAL = int(getenv('REFERENCE_REFRESH_INTERVAL', 10))  # minutes
+logging.info(f'Reference cache: {reference.load()} entries loaded from {reference.FILE}')
+
+# Requests to the sport site: check-ins first, then taps, then background jobs
+upstream.MAX_CONCURRENCY = int(getenv('UPSTREAM_CONCURRENCY', upstream.MAX_CONCURRENCY))  # 0 disables the scheduler
+upstream.RESERVED = int(getenv('UPSTREAM_RESERVED', upstream.RESERVED))  # slots background jobs can not take
+upstream.RATE = float(getenv('UPSTREAM_RATE', upstream.RATE))  # requests per second to one host, 0 disables
+week_view.WEEK_TTL = float(getenv('WEEK_TTL', week_view.WEEK_TTL))  # own week of full users
+user_stats.HOURS_TTL = float(getenv('HOURS_TTL', user_stats.HOURS_TTL))
+user_stats.BETTER_THAN_TTL = float(getenv('BETTER_THAN_TTL', user_stats.BETTER_THAN_TTL))
+STATS_REFRESH_INTERVAL = int(getenv('STATS_REFRESH_INTERVAL', 2))  # minutes, 0 disables background refresh of statistics
+# Watched trainings without seat churn at their lead time are polled once per that many seconds
+occupancy.COLD_INTERVAL = float(getenv('COLD_POLL_INTERVAL', occupancy.COLD_INTERVAL))
+
+METRICS_HOST = getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(getenv('METRICS_PORT', 9090))  # 0 disables /metrics endpoint
+
+# Record count, errors and latency of every sport site, database and render call
+metrics.instrument_module(api, 'api')
+metrics.instrument_module(database, 'database')
+metrics.instrument_module(generators, 'render', ['draw_day', 'draw_my_week'])
+database.Batch.flush = metrics.timed('database', 'Batch.flush')(database.Batch.flush)
+
+
+class InstrumentedBot(Bot):
+    """
+    Bot that records every Bot API request as `telegram` metric and trace span
+    """
+    async def request(self, method, data=None, files=None, **kwargs):
+        if method in outputs.EDIT_METHODS and data:  # remembered output is unknown until outputs.show records it
+            outputs.forget(data.get('chat_id'), data.get('message_id'))
+        start = time.perf_counter()
+        error = False
+        try:
+            with tracing.span(f'telegram.{method}'):
+                return await super().request(method, data, files, **kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            metrics.REGISTRY.observe('telegram', method, time.perf_counter() - start, error)
+
+
+class TracingMiddleware(BaseMiddleware):
+    """
+    Every update is processed in its own trace, total duration is recorded as `update` metric
+    """
+    @staticmethod
+    def trace_name(update: Update) -> str:
+        if update.callback_query:
+            return f'callback {callbacks.get_prefix(update.callback_query.data or "")}'
+        if update.message:
+            return f'message {update.message.get_command() or "text"}'
+        return 'update'
+
+    async def on_pre_process_update(self, update: Update, data: dict):
+        data['_trace'] = tracing.start_trace(self.trace_name(update), update_id=update.update_id)
+
+    async def on_post_process_update(self, update: Update, results: list, data: dict):
+        root, token = data.pop('_trace')
+        tracing.finish_trace(root, token)
+        metrics.REGISTRY.observe('update', root.name, root.duration)
+
+
+if BOT_MODE == 'webhook' and WEBHOOK_URL is None:
+    logging.critical('No WEBHOOK_URL variable found in project environment (required for webhook mode)')
+
 # Initialize bot and dispatcher
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+if TELEGRAM_API_URL is not None:
+    bot = InstrumentedBot(token=BOT_TOKEN, server=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+else:
+    bot = InstrumentedBot(token=BOT_TOKEN)
+storage = cluster.create_storage(REDIS_URL, max_size=MAX_SESSIONS)
 dp = Dispatcher(bot, storage=storage)
-SESSIONS = dict()
-LOGIN_REQUEST = dict()
+SESSIONS = sessions.SessionStore(max_size=MAX_SESSIONS, max_age=SESSION_MAX_AGE, pinned={ADMIN_ID})
+
+# Service accounts for offline users and background jobs, `email:password,...` (admin account by default)
+service.MAX_AGE = float(getenv('SERVICE_SESSION_MAX_AGE', service.MAX_AGE))  # seconds before proactive re-login
+SERVICE_CHECK_INTERVAL = int(getenv('SERVICE_CHECK_INTERVAL', 1))  # minutes
+SERVICE = service.Pool()
+reference.SESSION = SERVICE.session  # background refresh never reuses sessions of users
+for email, password in service.parse_accounts(getenv('SERVICE_ACCOUNTS', f"{getenv('ADMIN_EMAIL', '')}:{getenv('ADMIN_PSW', '')}")):
+    SERVICE.add(email, password, database.create_session(ADMIN_ID) if email == getenv('ADMIN_EMAIL') else None)
+if not len(SERVICE):
+    logging.critical('No service accounts found in project environment (SERVICE_ACCOUNTS or ADMIN_EMAIL and ADMIN_PSW)')
+if WORKER_COUNT > 1:
+    LOGIN_REQUEST = cluster.SharedFlags('login_requests')
+    NOTIFICATIONS_LEASE = cluster.Lease('notifications', ttl=75, backend=cluster.FirebaseLeaseBackend())
+    outputs.ENABLED = False  # another worker may edit the same message, remembered output can be stale
+else:
+    LOGIN_REQUEST = sessions.LRUCache(max_size=MAX_SESSIONS)
+    NOTIFICATIONS_LEASE = cluster.Lease('notifications', ttl=75)
+dp.middleware.setup(TracingMiddleware())
+dp.middleware.setup(sessions.SessionContextMiddleware(SESSIONS, api.session_is_valid))
+router = callbacks.Router()
 
 
 # States
@@ -74,152 +205,398 @@ async def send_users(users: list, text: str, reply_markup: dict = None, segregat
             pass
 
 
-async def handle_notifications():
-    if not update_session(ADMIN_ID):
-        logging.warning('Admin session died')
-        SESSIONS[ADMIN_ID] = api.login_user(getenv('ADMIN_EMAIL'), getenv('ADMIN_PSW'))
-
-    notifications = database.get_notifications()
-    for training_id in notifications:
-        training_info = api.get_training_info(session=SESSIONS.get(ADMIN_ID), training_id=training_id)
-        end_time = datetime.datetime.fromisoformat(training_info['training']['end'])
-        capacity = training_info['training']['group']['capacity']
-        load = capacity - training_info['training']['load']
-
-        if end_time.timestamp() <= datetime.datetime.now().timestamp():
-            notification_users = database.get_notification_users(training_id)
-            logging.info(f'Notification expired for {training_id} and {len(notification_users)} users')
-            training_name = training_info['training']['group']['name']
-            training_time = end_time.strftime("%H:%M")
-            training_day = end_time.strftime('%d/%m/%Y')
-            weekday = calendar.day_name[end_time.weekday()]
-            text = f'Sorry, but no free spaces appeared for a {training_name} at {training_time} on {weekday} ' \
-                   f'({training_day}).\n' \
-                   f'Not to got into the same situation again see autocheckin feature in `My sports`'
-            await send_users(notification_users, text)
-            database.remove_notification(training_id)
-
-        elif load > 0:
-            notification_users = database.get_notification_users(training_id)
-            logging.info(f'Notification succeed for {training_id} and users {len(notification_users)}')
-            training_name = training_info['training']['group']['name']
-            training_time = end_time.strftime("%H:%M")
-            training_day = end_time.strftime('%d/%m/%Y')
-            weekday = calendar.day_name[end_time.weekday()]
-            text = f"There is one available place for a {training_name} at {training_time} on {weekday} ({training_day}) ! Check-in ASAP!\nThis message has been sent to {len(notification_users) - 1} more people"
-            await send_users(notification_users, text, {'text': '‼️Check-in ‼', 'callback_data': f'rawckin/{training_id}'}, segregate_offline={'text': 'Got it', 'callback_data': 'del'})
-            database.remove_notification(training_id)
+def get_service_training_info(training_id: int) -> dict:
+    """
+    Training info through the service pool, retried once on another account when the session was rejected
+    """
+    training_info = dict()
+    for _ in range(2):  # rejected account is not healthy anymore, so the retry goes to another one
+        try:
+            training_info = api.get_training_info(SERVICE.session(), training_id)
+        except ValueError:  # not JSON, e.g. login page
+            training_info = {'detail': 'Response is not JSON'}
+        if training_info.get('training') is not None:
+            break
+    return training_info
 
 
+@cluster.leader_only(NOTIFICATIONS_LEASE)
+@tracing.traced('job handle_notifications')
+@metrics.timed('job')
+async def handle_notifications():
+    upstream.set_priority(upstream.BACKGROUND)
+    notifications = database.get_notifications()
+    skipped = 0
+    async with database.Batch() as batch:
+        for training_id in notifications:
+            if not occupancy.should_poll(training_id):
+                skipped += 1
+                continue
+            training_info = await asyncio.to_thread(get_service_training_info, training_id)
+            if training_info.get('training') is None:
+                logging.warning(f'main.py -> handle_notifications -> {training_id}: {training_info}')
+                continue
+            occupancy.record(training_info)
+            end_time = datetime.datetime.fromisoformat(training_info['training']['end'])
+            capacity = training_info['training']['group']['capacity']
+            load = capacity - training_info['training']['load']
+
+            if end_time.timestamp() <= datetime.datetime.now().timestamp():
+                notification_users = database.get_notification_users(training_id)
+                logging.info(f'Notification expired for {training_id} and {len(notification_users)} users')
+                training_name = training_info['training']['group']['name']
+                training_time = end_time.strftime("%H:%M")
+                training_day = end_time.strftime('%d/%m/%Y')
+                weekday = calendar.day_name[end_time.weekday()]
+                text = f'Sorry, but no free spaces appeared for a {training_name} at {training_time} on {weekday} ' \
+                       f'({training_day}).\n' \
+                       f'Not to got into the same situation again see autocheckin feature in `My sports`'
+                await send_users(notification_users, text)
+                database.remove_notification(training_id, notification_users, batch=batch)
+
+            elif load > 0:
+                notification_users = database.get_notification_users(training_id)
+                logging.info(f'Notification succeed for {training_id} and users {len(notification_users)}')
+                training_name = training_info['training']['group']['name']
+                training_time = end_time.strftime("%H:%M")
+                training_day = end_time.strftime('%d/%m/%Y')
+                weekday = calendar.day_name[end_time.weekday()]
+                text = f"There is one available place for a {training_name} at {training_time} on {weekday} ({training_day}) ! Check-in ASAP!\nThis message has been sent to {len(notification_users) - 1} more people"
+                await send_users(notification_users, text, {'text': '‼️Check-in ‼', 'callback_data': callbacks.RAW_CHECKIN.encode(training_id)}, segregate_offline={'text': 'Got it', 'callback_data': callbacks.DELETE.encode()})
+                database.remove_notification(training_id, notification_users, batch=batch)
+    metrics.REGISTRY.set_gauge('notification_polls_skipped', {}, skipped)
+
+
+@tracing.traced('job handle_check_in')
+@metrics.timed('job')
 async def handle_check_in():
-    if not update_session(ADMIN_ID):
-        logging.warning('Admin session died')
-        SESSIONS[ADMIN_ID] = api.login_user(getenv('ADMIN_EMAIL'), getenv('ADMIN_PSW'))
-
+    upstream.set_priority(upstream.BACKGROUND)
     auto_checkins = database.get_auto_checkins()
     if auto_checkins is None:
         return
-    for user_id in auto_checkins:
-
-        if not update_session(user_id):
-            if not LOGIN_REQUEST.get(user_id, False):
-                LOGIN_REQUEST[user_id] = True
-
-                await bot.send_message(
-                    chat_id=user_id,
-                    text='Your session died, please login one more time to keep your auto-checkin running',
-                    reply_markup=generators.generate_delete_inline('Login!'),
-                )
-            continue
+    async with database.Batch() as batch:
+        for user_key in auto_checkins:
+            user_id = int(user_key)  # caches, sessions and flags are keyed by int ids, database keys are strings
+            if not cluster.owns(user_id, WORKER_INDEX, WORKER_COUNT):  # other worker handles this user
+                continue
 
-        for training_key, sport_list in auto_checkins[user_id].items():
-            for training_id in sport_list:
-                training_info = api.get_training_info(SESSIONS.get(user_id), training_id)
+            session = SESSIONS.load(user_id)  # same as update_session, but the request is sent from a thread
+            if session is None or (session.cookies.get('sessionid') is not None and not await asyncio.to_thread(api.session_is_valid, session)):
+                if not LOGIN_REQUEST.get(user_id, False):
+                    LOGIN_REQUEST[user_id] = True
 
-                if training_info.get('detail') is not None:
-                    group_id, weekday, time = training_key.split('|')
-                    group_info = api.get_group_info(SESSIONS.get(ADMIN_ID), group_id)
-
-                    user_message = \
-                        f'Hello! Some changes to schedule was made and we found out that your sport ' \
-                        f'{group_info["group_name"]} on {calendar.day_name[int(weekday)]} at {time} is no longer ' \
-                        f'available for check-in. Please check new schedule for the day to see changes. Sorry for ' \
-                        f'inconvenience.'
-
-                    with open(f'images/something_happened.png', 'rb') as file:
-                        await bot.send_photo(
+                    await bot.send_message(
+                        chat_id=user_id,
+                        text='Your session died, please login one more time to keep your auto-checkin running',
+                        reply_markup=generators.generate_delete_inline('Login!'),
+                    )
+                continue
+
+            for training_key, sport_list in auto_checkins[user_key].items():
+                remaining = list(sport_list)
+                for training_id in sport_list:
+                    with upstream.priority(upstream.CHECK_IN):  # this probe decides the check-in, seats may be open now
+                        training_info = await asyncio.to_thread(api.get_training_info, session, training_id)
+
+                    if training_info.get('detail') is not None:
+                        if SCHEDULE_CHANGES_INTERVAL:
+                            continue  # removed, handle_schedule_changes drops it and tells the user
+
+                        group_id, weekday, time = training_key.split('|')
+                        group_info = await asyncio.to_thread(api.get_group_info, SERVICE.session(), group_id)
+
+                        user_message = \
+                            f'Hello! Some changes to schedule was made and we found out that your sport ' \
+                            f'{group_info["group_name"]} on {calendar.day_name[int(weekday)]} at {time} is no longer ' \
+                            f'available for check-in. Please check new schedule for the day to see changes. Sorry for ' \
+                            f'inconvenience.'
+
+                        with open(f'images/something_happened.png', 'rb') as file:
+                            await bot.send_photo(
+                                chat_id=user_id,
+                                caption=user_message,
+                                parse_mode='Markdown',
+                                reply_markup=generators.generate_investigate_inline(),
+                                photo=file
+                            )
+
+                        database.remove_auto_checkin(user_id, training_key, batch=batch)
+                        break
+
+                    if datetime.datetime.fromisoformat(training_info['training']['end'].split('+')[0]) < datetime.datetime.now():
+                        database.remove_given_auto_checkin(user_id, training_key, training_id, remaining, batch=batch)
+                        continue
+
+                    if training_info['checked_in']:
+                        database.remove_given_auto_checkin(user_id, training_key, training_id, remaining, batch=batch)
+                        continue
+
+                    training_start = datetime.datetime.fromisoformat(training_info['training']['start'].split('+')[0])
+
+                    if not training_info['can_check_in'] or datetime.datetime.now() + datetime.timedelta(days=7) <= training_start:
+                        break
+
+                    load = training_info['training']['group']['capacity'] - training_info['training']['load']
+                    if load > 0 and training_info['can_check_in'] and not training_info['checked_in']:
+                        await asyncio.to_thread(api.checkin, session, training_id)
+                        changed_check_in(user_id, training_id, True, session)
+                        database.remove_given_auto_checkin(user_id, training_key, training_id, remaining, batch=batch)
+
+                        group_id, weekday, time = training_key.split('|')
+                        bot_info = await bot.get_me()
+
+                        user_message = \
+                            f'I checked you in to next {training_info["training"]["group"]["name"]} on ' \
+                            f'{calendar.day_name[int(weekday)]} at {time} ({training_start.strftime("%d/%m/%Y")}).\n' \
+                            f'Thanks for using @{bot_info["username"]}!'
+
+                        await bot.send_message(
                             chat_id=user_id,
-                            caption=user_message,
+                            text=user_message,
                             parse_mode='Markdown',
-                            reply_markup=generators.generate_investigate_inline(),
-                            photo=file
+                            reply_markup=generators.generate_delete_inline(),
                         )
-
-                    database.remove_auto_checkin(user_id, training_key)
-                    generators.generate_auto_checkin_list_caption()
                     break
 
-                if datetime.datetime.fromisoformat(training_info['training']['end'].split('+')[0]) < datetime.datetime.now():
-                    database.remove_given_auto_checkin(user_id, training_key, training_id)
-                    continue
 
-                if training_info['checked_in']:
-                    database.remove_given_auto_checkin(user_id, training_key, training_id)
-                    continue
+@cluster.leader_only(NOTIFICATIONS_LEASE)
+@tracing.traced('job handle_schedule_changes')
+@metrics.timed('job')
+async def handle_schedule_changes():
+    upstream.set_priority(upstream.BACKGROUND)
+    since = datetime.datetime.now().isoformat()
+    current = await asyncio.to_thread(changes.fetch_snapshot, SERVICE.session())
+    if not current:
+        return  # semester is over or sport site returned nothing, keep the last snapshot
+    previous = database.get_schedule_snapshot()
+    if previous is None:
+        database.set_schedule_snapshot(current)
+        return  # first snapshot, nothing to compare with
+    added, removed, moved = changes.diff(previous, current, since)
+    if not (added or removed or moved):
+        return
+    database.set_schedule_snapshot(current)
+    logging.info(f'Schedule changed: {len(added)} added, {len(removed)} removed, {len(moved)} moved trainings')
+
+    # caches
+    gone = {int(training_id) for training_id in removed + moved}
+    for date in changes.dates(*(previous[training_id] for training_id in removed + moved), *(current[training_id] for training_id in added + moved)):
+        schedule.invalidate(date)
+    for training_id in gone:
+        schedule.forget_training(training_id)
+    week_view.forget_trainings(gone)
+    await asyncio.to_thread(generators.parse_and_save_whole_semester, SERVICE.session())  # auto-checkin keys
+
+    messages = dict()  # user_id -> lines about their trainings
+    appeared = dict()  # auto-checkin key -> trainings that now match it
+    for training_id in added + moved:
+        appeared.setdefault(changes.training_key(current[training_id]), []).append(int(training_id))
+
+    def tell(user_id: int, training_id: str):
+        if training_id in current:
+            line = f'{changes.describe(previous[training_id])} was moved to {changes.describe(current[training_id])}'
+        else:
+            line = f'{changes.describe(previous[training_id])} was cancelled'
+        messages.setdefault(int(user_id), []).append(line)
+
+    async with database.Batch() as batch:
+        for user_id, keys in (database.get_auto_checkins() or dict()).items():
+            for training_key, training_ids in keys.items():
+                kept = [training_id for training_id in training_ids if training_id not in gone]
+                kept += [training_id for training_id in appeared.get(training_key, []) if training_id not in kept]
+                for training_id in training_ids:
+                    if training_id in gone:
+                        tell(user_id, str(training_id))
+                if kept != training_ids:
+                    kept.sort(key=lambda training_id: current.get(str(training_id), (None, None, ''))[2])
+                    database.set_auto_checkin_ids(user_id, training_key, kept, batch=batch)
+
+        for training_id in removed + moved:
+            users = database.get_notification_users(int(training_id))
+            for user_id in users:
+                tell(user_id, training_id)
+            if users and training_id in removed:
+                database.remove_notification(int(training_id), users, batch=batch)
+
+    by_text = dict()  # same changes are sent with the same text
+    for user_id, lines in messages.items():
+        text = 'Hello! Some changes to schedule were made:\n' + '\n'.join(sorted(set(lines))) + \
+               '\nPlease check new schedule to see changes. Sorry for inconvenience.'
+        by_text.setdefault(text, []).append(user_id)
+    photo = None  # uploaded once, then sent by file_id
+    for text, users in by_text.items():
+        for user_id in users:
+            try:
+                if photo is None:
+                    with open('images/something_happened.png', 'rb') as file:
+                        sent = await bot.send_photo(chat_id=user_id, caption=text, photo=file,
+                                                    reply_markup=generators.generate_investigate_inline())
+                    photo = sent.photo[-1].file_id if sent.photo else None
+                else:
+                    await bot.send_photo(chat_id=user_id, caption=text, photo=photo,
+                                         reply_markup=generators.generate_investigate_inline())
+            except Exception as ex:
+                logging.warning(f'main.py -> handle_schedule_changes -> {user_id}: {ex}')
+
+
+@tracing.traced('job refresh_reference')
+@metrics.timed('job')
+async def refresh_reference():
+    upstream.set_priority(upstream.BACKGROUND)
+    refreshed = await asyncio.to_thread(reference.refresh)
+    if refreshed:
+        logging.info(f'Reference cache: {refreshed} entries refreshed')
+    await asyncio.to_thread(reference.save)  # changes of taps and refresh in one write
+
+
+@tracing.traced('job refresh_user_stats')
+@metrics.timed('job')
+async def refresh_user_stats():
+    upstream.set_priority(upstream.BACKGROUND)
+    for user_id in user_stats.active_users():
+        session = SESSIONS.load(user_id)
+        if session is None or session.cookies.get('sessionid') is None:
+            continue  # logged out or offline
+        try:
+            await asyncio.to_thread(user_stats.refresh, session, user_id)
+        except Exception as ex:  # tap fetches it again
+            logging.warning(f'main.py -> refresh_user_stats -> {user_id}: {ex}')
+
+
+@tracing.traced('job maintain_service_accounts')
+@metrics.timed('job')
+async def maintain_service_accounts():
+    upstream.set_priority(upstream.BACKGROUND)
+    healthy = await asyncio.to_thread(SERVICE.maintain)
+    metrics.REGISTRY.set_gauge('service_accounts_healthy', {}, healthy)
+    if not healthy:
+        logging.warning('No healthy service accounts')
+
+
+@tracing.traced('job warm_up_caches')
+@metrics.timed('job')
+async def warm_up_caches():
+    upstream.set_priority(upstream.BACKGROUND)
+    week = [date for date, _ in generators.get_week()]
+    for date in week:  # in a thread, so users are not waiting for renders of the whole week
+        await asyncio.to_thread(generators.warm_up_day, SERVICE.session(), date)
+    generators.drop_stale_renders(week)
+
+
+@metrics.timed('job')
+async def handle_memory():
+    expired = SESSIONS.prune() + LOGIN_REQUEST.prune()
+    occupancy.compact()
+    if isinstance(storage, sessions.BoundedMemoryStorage):
+        dropped = storage.prune()
+        logging.info(f'Memory: {SESSIONS.stats()}, fsm records: {len(storage)} ({dropped} dropped), {expired} sessions expired')
+    else:
+        logging.info(f'Memory: {SESSIONS.stats()}, {expired} sessions expired')
 
-                training_start = datetime.datetime.fromisoformat(training_info['training']['start'].split('+')[0])
 
-                if not training_info['can_check_in'] or datetime.datetime.now() + datetime.timedelta(days=7) <= training_start:
-                    break
+scheduler = AsyncIOScheduler()
+scheduler.add_job(func=handle_notifications, trigger="interval", seconds=30)
+scheduler.add_job(func=handle_check_in, trigger="interval", seconds=30)
+if SCHEDULE_CHANGES_INTERVAL:
+    scheduler.add_job(func=handle_schedule_changes, trigger="interval", minutes=SCHEDULE_CHANGES_INTERVAL)
+scheduler.add_job(func=handle_memory, trigger="interval", minutes=10)
+scheduler.add_job(func=maintain_service_accounts, trigger="interval", minutes=SERVICE_CHECK_INTERVAL, next_run_time=datetime.datetime.now())
+scheduler.add_job(func=refresh_reference, trigger="interval", minutes=REFERENCE_REFRESH_INTERVAL)
+if STATS_REFRESH_INTERVAL:
+    scheduler.add_job(func=refresh_user_stats, trigger="interval", minutes=STATS_REFRESH_INTERVAL)
+if WARMUP_INTERVAL:
+    scheduler.add_job(func=warm_up_caches, trigger="interval", minutes=WARMUP_INTERVAL, next_run_time=datetime.datetime.now())
+scheduler.start()
+logging.getLogger('apscheduler.executors.default').setLevel(logging.WARNING)
 
-                load = training_info['training']['group']['capacity'] - training_info['training']['load']
-                if load > 0 and training_info['can_check_in'] and not training_info['checked_in']:
-                    api.checkin(SESSIONS.get(user_id), training_id)
-                    database.remove_given_auto_checkin(user_id, training_key, training_id)
 
-                    group_id, weekday, time = training_key.split('|')
-                    bot_info = await bot.get_me()
+loop_watchdog = watchdog.LoopWatchdog(threshold=LOOP_STALL_THRESHOLD)
 
-                    user_message = \
-                        f'I checked you in to next {training_info["training"]["group"]["name"]} on ' \
-                        f'{calendar.day_name[int(weekday)]} at {time} ({training_start.strftime("%d/%m/%Y")}).\n' \
-                        f'Thanks for using @{bot_info["username"]}!'
 
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text=user_message,
-                        parse_mode='Markdown',
-                        reply_markup=generators.generate_delete_inline(),
-                    )
-                break
+async def start_watchdog():
+    if LOOP_STALL_THRESHOLD:
+        loop_watchdog.start()
 
 
-scheduler = AsyncIOScheduler()
-scheduler.add_job(func=handle_notifications, trigger="interval", seconds=30)
-scheduler.add_job(func=handle_check_in, trigger="interval", seconds=30)
-scheduler.start()
-logging.getLogger('apscheduler.executors.default').setLevel(logging.WARNING)
+async def shutdown_scheduler():
+    loop_watchdog.stop()
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    NOTIFICATIONS_LEASE.release()  # let other worker take over without waiting for lease expiration
+
 
 # Shut down the scheduler when exiting the app
-atexit.register(lambda: scheduler.shutdown())
+atexit.register(lambda: scheduler.shutdown() if scheduler.running else None)
+atexit.register(reference.save)
 
 
 def update_session(user_id: int) -> bool:
-    if SESSIONS.get(user_id) is None:
-        SESSIONS[user_id] = database.create_session(user_id)
+    context = sessions.current_context(user_id)
+    if context is not None:  # already resolved (or will be resolved once) for current update
+        return context.valid
 
-    if SESSIONS.get(user_id) is None:
-        return False
-    if SESSIONS.get(user_id).cookies.get('sessionid') is None:  # offline users are valid users with valid session
-        return True
-    return api.session_is_valid(SESSIONS[user_id])
+    with tracing.span('session.resolve', user_id=user_id):
+        session = SESSIONS.load(user_id)  # evicted sessions are rebuilt from the database
+
+        if session is None:
+            return False
+        if session.cookies.get('sessionid') is None:  # offline users are valid users with valid session
+            return True
+        return api.session_is_valid(session)
+
+
+def user_session(user_id: int) -> Session or None:
+    """
+    Own session of full users, service session for offline ones
+    """
+    return SERVICE.session() if is_offline(user_id) else SESSIONS.get(user_id)
 
 
 def is_offline(user_id: int) -> bool:
+    context = sessions.current_context(user_id)
+    if context is not None:
+        return context.offline
+
     update_session(user_id)
     return (SESSIONS.get(user_id) is not None) and (SESSIONS.get(user_id).cookies.get('sessionid') is None)
 
 
+_confirmations = set()  # running background confirmations, referenced until done
+
+
+def changed_check_in(user_id: int, training_id: int, checked_in: bool, session: Session = None) -> None:
+    """
+    Apply check-in (or cancel) the bot has just made to cached data and confirm the week of the user in background
+    (with given session, by default the one in SESSIONS)
+    """
+    schedule.forget_training(training_id)  # seats changed
+    week_view.set_checked_in(user_id, training_id, checked_in)
+    user_stats.forget(user_id)
+    task = asyncio.create_task(asyncio.to_thread(week_view.confirm, session or SESSIONS.get(user_id), user_id, training_id, checked_in))
+    _confirmations.add(task)
+    task.add_done_callback(_confirmations.discard)
+
+
+def image_version(render: int or str) -> str or None:
+    """
+    Renders (named by user_id) are identified by fingerprint of their data, static images by name
+    """
+    if isinstance(render, int):
+        return generators.rendered_version(render)  # None makes outputs hash the file
+    return f'static:{render}'
+
+
+@dp.errors_handler(exception=service.Unavailable)
+async def service_unavailable(update: Update, exception: service.Unavailable):
+    logging.warning(f'main.py -> service_unavailable -> {exception}')
+    text = 'Bot is starting, please try again in a minute'
+    if update.callback_query is not None:
+        await update.callback_query.answer(text)
+    elif update.message is not None:
+        await bot.send_message(update.message.chat.id, text)
+    return True
+
+
 @dp.message_handler(lambda msg: api.is_dead())
 async def server_is_down(message: Message):
     await bot.send_message(
@@ -230,9 +607,14 @@ async def server_is_down(message: Message):
     )
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('start/'))
-async def start_registration(callback_query: CallbackQuery):
-    mode = callback_query.data.split('/')[1]
+@dp.callback_query_handler(lambda c: router.is_public(c.data))
+async def public_callback(callback_query: CallbackQuery):
+    await router.dispatch(callback_query)
+
+
+@router.route(callbacks.START, requires_session=False)
+async def start_registration(callback_query: CallbackQuery, payload):
+    mode = payload.mode
     await callback_query.answer('Nice choice!')
 
     if mode == 'offline':
@@ -316,6 +698,11 @@ async def session_problem_button(callback_query: CallbackQuery):
     await callback_query.answer('Updated')
 
 
+@dp.callback_query_handler()
+async def route_callback(callback_query: CallbackQuery):
+    await router.dispatch(callback_query)
+
+
 @dp.message_handler(lambda m: not update_session(m.from_user.id))
 async def session_problem_message(message: Message):
     user_id = message.from_user.id
@@ -369,10 +756,8 @@ async def start(message: Message):
 async def process_sport_user_id(message: Message, state: FSMContext):
     user_id = message.from_user.id
     student_id = message.text.replace('\'"', '')
-    print(user_id, student_id)
-    print(api.student_id_is_valid(SESSIONS.get(ADMIN_ID), student_id))
 
-    if not api.student_id_is_valid(SESSIONS.get(ADMIN_ID), student_id):
+    if not await asyncio.to_thread(api.student_id_is_valid, SERVICE.session(), student_id):
         await bot.send_message(
             chat_id=user_id,
             text="Seems like this student_id is invalid, please check and try again. How would you like to login?",
@@ -382,9 +767,10 @@ async def process_sport_user_id(message: Message, state: FSMContext):
         return
 
     database.create_user(user_id=user_id, student_id=student_id)
+    sessions.reset_context(user_id)
     update_session(user_id)
 
-    generators.generate_today_image(user_id, SESSIONS.get(ADMIN_ID), ignore_checked_in=True)
+    generators.generate_today_image(user_id, SERVICE.session(), ignore_checked_in=True)
 
     await bot.send_message(user_id, 'You logged in successfully!')
 
@@ -420,7 +806,7 @@ async def process_password(message: Message, state: FSMContext):
     await bot.delete_message(message.chat.id, message.message_id)
     async with state.proxy() as data:
         try:
-            session = api.login_user(email=data.get('email'), password=message.text)
+            session = await asyncio.to_thread(api.login_user, data.get('email'), message.text)
             database.create_user(
                 user_id=message.from_user.id,
                 student_id=session.cookies['student_id'],
@@ -428,6 +814,7 @@ async def process_password(message: Message, state: FSMContext):
                 csrftoken=session.cookies['csrftoken']
             )
             SESSIONS[user_id] = session
+            sessions.reset_context(user_id)
             generators.generate_today_image(user_id, session)
             await bot.send_message(user_id, 'You logged in successfully!')
             with open(f'images/{user_id}.png', 'rb') as file:
@@ -465,9 +852,9 @@ async def process_password(message: Message, state: FSMContext):
                 "try again (probably won't help):\nSend your innopolis email:")
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('my/'))
-async def my_image(callback_query: CallbackQuery):
-    date = callback_query.data.split('/')[1]
+@router.route(callbacks.MY, coalesce=True)
+async def my_image(callback_query: CallbackQuery, payload):
+    date = payload.date
     user_id = callback_query.from_user.id
 
     render = 'please_register'
@@ -475,93 +862,98 @@ async def my_image(callback_query: CallbackQuery):
         render = generators.draw_my_week(SESSIONS.get(user_id), user_id)
         render = user_id if render else 'sleep'  # if none sport selected
 
-    try:
-        with open(f'images/{render}.png', 'rb') as file:
-            await bot.edit_message_media(
-                chat_id=callback_query.message.chat.id,
-                message_id=callback_query.message.message_id,
-                media=InputMediaPhoto(
-                    file,
-                    caption=generators.generate_my_caption(SESSIONS.get(user_id)),
-                    parse_mode='Markdown'),
-                reply_markup=generators.generate_my_inline(date)
-            )
-    except MessageNotModified as ex:
-        pass
+    await outputs.show(
+        bot,
+        chat_id=callback_query.message.chat.id,
+        message_id=callback_query.message.message_id,
+        image=f'images/{render}.png',
+        image_version=image_version(render),
+        caption=await asyncio.to_thread(generators.generate_my_caption, SESSIONS.get(user_id), user_id),
+        parse_mode='Markdown',
+        reply_markup=generators.generate_my_inline(date)
+    )
     await callback_query.answer('Your statistics')
 
 
-@dp.callback_query_handler(lambda c: c.data == 'change')
-async def change_day(callback_query: CallbackQuery):
-    with open(f'images/change.png', 'rb') as file:
-        await bot.edit_message_media(
-            chat_id=callback_query.message.chat.id,
-            message_id=callback_query.message.message_id,
-            media=InputMediaPhoto(file, caption='Please select day of the week that you want to attend:'),
-            reply_markup=generators.generate_inline_markup(
-                *[{'text': f'{weekday} ({date})', 'callback_data': f'date/{date}'} for (date, weekday) in
-                  generators.get_week()]
-            )
+@router.route(callbacks.CHANGE_DAY)
+async def change_day(callback_query: CallbackQuery, payload):
+    await outputs.show(
+        bot,
+        chat_id=callback_query.message.chat.id,
+        message_id=callback_query.message.message_id,
+        image='images/change.png',
+        image_version=image_version('change'),
+        caption='Please select day of the week that you want to attend:',
+        reply_markup=generators.generate_inline_markup(
+            *[{'text': f'{weekday} ({date})', 'callback_data': callbacks.DATE.encode(date)} for (date, weekday) in
+              generators.get_week()]
         )
+    )
     await callback_query.answer('Select day')
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('date/'))
-async def select_day(callback_query: CallbackQuery):
-    date = callback_query.data.split('/')[1]
+@router.route(callbacks.DATE, coalesce=True)
+async def select_day(callback_query: CallbackQuery, payload):
+    date = payload.date
     user_id = callback_query.from_user.id
 
     if is_offline(user_id):
-        contains = generators.generate_date_image(date, user_id, SESSIONS.get(ADMIN_ID), rewrite=True, ignore_checked_in=True)
+        contains = generators.generate_date_image(date, user_id, SERVICE.session(), rewrite=True, ignore_checked_in=True)
     else:
         contains = generators.generate_date_image(date, user_id, SESSIONS.get(user_id), rewrite=True)
 
-    with open(f'images/{user_id if contains else "free"}.png', 'rb') as file:
-        await bot.edit_message_media(
-            chat_id=callback_query.message.chat.id,
-            message_id=callback_query.message.message_id,
-            media=InputMediaPhoto(file, caption=generators.generate_date_caption(date), parse_mode='Markdown'),
-            reply_markup=generators.generate_date_inline(date)
-        )
+    render = user_id if contains else 'free'
+    await outputs.show(
+        bot,
+        chat_id=callback_query.message.chat.id,
+        message_id=callback_query.message.message_id,
+        image=f'images/{render}.png',
+        image_version=image_version(render),
+        caption=generators.generate_date_caption(date),
+        parse_mode='Markdown',
+        reply_markup=generators.generate_date_inline(date)
+    )
     await callback_query.answer('Select option')
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('ckin/'))
-async def select_type(callback_query: CallbackQuery):
-    date = callback_query.data.split('/')[1]
-    await bot.edit_message_caption(
+@router.route(callbacks.CHECKIN_MENU)
+async def select_type(callback_query: CallbackQuery, payload):
+    date = payload.date
+    await outputs.show(
+        bot,
         chat_id=callback_query.message.chat.id,
         message_id=callback_query.message.message_id,
         caption='Select sport type that you want to checkin:',
-        reply_markup=generators.generate_date_courses_buttons(date, SESSIONS.get(ADMIN_ID))
+        reply_markup=generators.generate_date_courses_buttons(date, SERVICE.session())
     )
     await callback_query.answer('Select course')
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('gid/'))
-async def select_time(callback_query: CallbackQuery):
-    _, date, group_id = callback_query.data.split('/')
-    group_id = int(group_id)
+@router.route(callbacks.GROUP)
+async def select_time(callback_query: CallbackQuery, payload):
+    date, group_id = payload.date, payload.group_id
     user_id = callback_query.from_user.id
-    await bot.edit_message_caption(
+    await outputs.show(
+        bot,
         chat_id=callback_query.message.chat.id,
         message_id=callback_query.message.message_id,
-        caption=generators.generate_group_time_caption(group_id, SESSIONS.get(ADMIN_ID)),
-        reply_markup=generators.generate_date_group_time_buttons(date, group_id, SESSIONS.get(ADMIN_ID if is_offline(user_id) else user_id), user_id, ignore_checked_in=is_offline(user_id)),
+        caption=generators.generate_group_time_caption(group_id, SERVICE.session()),
+        reply_markup=generators.generate_date_group_time_buttons(date, group_id, user_session(user_id), user_id, ignore_checked_in=is_offline(user_id), public_session=SERVICE.session()),
     )
     await callback_query.answer('Select time')
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('auto'))
-async def auto_menu(callback_query: CallbackQuery):
-    date = callback_query.data.split('/')[1]
+@router.route(callbacks.AUTO_MENU)
+async def auto_menu(callback_query: CallbackQuery, payload):
+    date = payload.date
     user_id = callback_query.from_user.id
 
     if is_offline(user_id):
         await callback_query.answer('Please switch to a `full-experience mode` in order to set autocheckin', show_alert=True)
         return
 
-    await bot.edit_message_caption(
+    await outputs.show(
+        bot,
         chat_id=callback_query.message.chat.id,
         message_id=callback_query.message.message_id,
         caption=generators.generate_auto_checkin_list_caption(),
@@ -570,8 +962,8 @@ async def auto_menu(callback_query: CallbackQuery):
     await callback_query.answer('Select training')
 
 
-@dp.callback_query_handler(lambda c: c.data == 'why')
-async def why_did_you_click_it(callback_query: CallbackQuery):
+@router.route(callbacks.WHY)
+async def why_did_you_click_it(callback_query: CallbackQuery, payload):
     why_messages = [
         'Why? Just why?'
         'Why you clicked it?',
@@ -585,10 +977,10 @@ async def why_did_you_click_it(callback_query: CallbackQuery):
     await callback_query.answer(random.choice(why_messages), show_alert=True)
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('aid/'))
-async def set_auto_checkin(callback_query: CallbackQuery):
+@router.route(callbacks.AUTO_CHECKIN)
+async def set_auto_checkin(callback_query: CallbackQuery, payload):
     user_id = callback_query.from_user.id
-    _, date, training_key = callback_query.data.split('/')
+    date, training_key = payload.date, payload.training_key
 
     auto_checked_in = database.check_auto_checkin(user_id, training_key)
     if auto_checked_in:
@@ -614,41 +1006,44 @@ async def set_auto_checkin(callback_query: CallbackQuery):
         'Auto-checkin removed successfully' if auto_checked_in else 'Auto-checkin set successfully')
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('unckin/'))
-async def selected(callback_query: CallbackQuery):
-    date = callback_query.data.split('/')[1]
+@router.route(callbacks.UNCHECKIN_MENU)
+async def uncheckin_menu(callback_query: CallbackQuery, payload):
+    date = payload.date
     user_id = callback_query.from_user.id
 
     if is_offline(user_id):
         await callback_query.answer('Please switch to a `full-experience mode` in order to uncheckin', show_alert=True)
         return
 
-    await bot.edit_message_caption(
+    await outputs.show(
+        bot,
         chat_id=callback_query.message.chat.id,
         message_id=callback_query.message.message_id,
         caption=generators.generate_fast_un_checkin_caption(),
-        reply_markup=generators.generate_fast_un_checkin_markup(SESSIONS.get(user_id), date)
+        reply_markup=generators.generate_fast_un_checkin_markup(SESSIONS.get(user_id), user_id, date)
     )
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('tid/') or c.data.startswith('ntid/'))
-async def selected(callback_query: CallbackQuery):
-    training_id = int(callback_query.data.split('/')[1])
+@router.route(callbacks.TRAINING, callbacks.NOTIFICATION, coalesce=True)
+async def selected(callback_query: CallbackQuery, payload):
+    training_id = payload.training_id
     user_id = callback_query.from_user.id
-    callback_type = callback_query.data.split('/')[0]
+    callback_type = callbacks.get_prefix(callback_query.data)
 
     if is_offline(user_id) and callback_type == 'tid':
         await callback_query.answer('Please switch to a `full-experience mode` in order to check in', show_alert=True)
         return
 
     try:
-        training = api.get_training_info(SESSIONS.get(user_id if not is_offline(user_id) else ADMIN_ID), training_id)
+        training = await asyncio.to_thread(api.get_training_info, user_session(user_id), training_id)
         start_datetime = datetime.datetime.fromisoformat(training['training']['start'].split('+')[0])
         if callback_type == 'tid':
             if training['can_check_in'] and not training['checked_in']:
-                api.checkin(SESSIONS.get(user_id), training_id)
+                await asyncio.to_thread(api.checkin, SESSIONS.get(user_id), training_id)
+                changed_check_in(user_id, training_id, True)
             elif training['checked_in']:
-                api.cancel_checkin(SESSIONS.get(user_id), training_id)
+                await asyncio.to_thread(api.cancel_checkin, SESSIONS.get(user_id), training_id)
+                changed_check_in(user_id, training_id, False)
             elif datetime.datetime.now() + datetime.timedelta(days=7) < start_datetime:
                 await callback_query.answer(
                     'This training is not available for checkin now', show_alert=True)
@@ -659,48 +1054,47 @@ async def selected(callback_query: CallbackQuery):
                     'information when at least one seat appears', show_alert=True)
                 return
         else:
-            notified_users = database.get_notification_users(training_id)
-            if user_id in notified_users:
+            if database.is_user_notified(training_id, user_id):
                 database.remove_user_notification(training_id, user_id)
             else:
                 database.add_user_notification(training_id, user_id)
 
-        training = api.get_training_info(SESSIONS.get(ADMIN_ID), training_id)
         date = training['training']['start'].split('T')[0]
         group_id = training['training']['group']['id']
 
         if is_offline(user_id):
-            contains = generators.generate_date_image(date, user_id, SESSIONS.get(ADMIN_ID), rewrite=True, ignore_checked_in=True)
+            contains = generators.generate_date_image(date, user_id, SERVICE.session(), rewrite=True, ignore_checked_in=True)
         else:
             contains = generators.generate_date_image(date, user_id, SESSIONS.get(user_id), rewrite=True)
 
-        with open(f'images/{user_id if contains else "free"}.png', 'rb') as file:
-            await bot.edit_message_media(
-                chat_id=callback_query.message.chat.id,
-                message_id=callback_query.message.message_id,
-                media=InputMediaPhoto(
-                    file,
-                    caption=generators.generate_group_time_caption(group_id, SESSIONS.get(ADMIN_ID)),
-                    parse_mode='Markdown'),
-                reply_markup=generators.generate_date_group_time_buttons(date, group_id, SESSIONS.get(ADMIN_ID if is_offline(user_id) else user_id), user_id, ignore_checked_in=is_offline(user_id)),
-
-            )
+        render = user_id if contains else 'free'
+        await outputs.show(
+            bot,
+            chat_id=callback_query.message.chat.id,
+            message_id=callback_query.message.message_id,
+            image=f'images/{render}.png',
+            image_version=image_version(render),
+            caption=generators.generate_group_time_caption(group_id, SERVICE.session()),
+            parse_mode='Markdown',
+            reply_markup=generators.generate_date_group_time_buttons(date, group_id, user_session(user_id), user_id, ignore_checked_in=is_offline(user_id), public_session=SERVICE.session()),
+        )
 
         await callback_query.answer('Notification status changed' if callback_type == 'ntid' else 'Information updated')
     except Exception as ex:
         await callback_query.answer('Some error occurred, please try again later', show_alert=True)
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('rawckin/') or c.data.startswith('rawnid/') or c.data.startswith('fckin/'))
-async def raw_checkin(callback_query: CallbackQuery):
-    training_id = int(callback_query.data.split('/')[1])
+@router.route(callbacks.RAW_CHECKIN, callbacks.RAW_NOTIFICATION, callbacks.FAST_CHECKIN)
+async def raw_checkin(callback_query: CallbackQuery, payload):
+    training_id = payload.training_id
     user_id = callback_query.from_user.id
-    callback_type = callback_query.data.split('/')[0]
+    callback_type = callbacks.get_prefix(callback_query.data)
 
-    training_info = api.get_training_info(SESSIONS.get(user_id), training_id)
+    training_info = await asyncio.to_thread(api.get_training_info, SESSIONS.get(user_id), training_id)
     if callback_type == 'rawckin' or callback_type == 'fckin':
         if training_info['can_check_in'] and not training_info['checked_in']:
-            api.checkin(SESSIONS.get(user_id), training_id)
+            await asyncio.to_thread(api.checkin, SESSIONS.get(user_id), training_id)
+            changed_check_in(user_id, training_id, True)
 
             if callback_type == 'rawckin':  # message with no image
                 await bot.delete_message(
@@ -709,34 +1103,37 @@ async def raw_checkin(callback_query: CallbackQuery):
                 )
             else:
                 contains = generators.draw_my_week(SESSIONS.get(user_id), user_id)  # offline guys should never reach
-                with open(f'images/{user_id if contains else "sleep"}.png', 'rb') as file:
-                    await bot.edit_message_media(
-                        chat_id=callback_query.message.chat.id,
-                        message_id=callback_query.message.message_id,
-                        media=InputMediaPhoto(
-                            file,
-                            caption=generators.generate_fast_un_checkin_caption(),
-                            parse_mode='Markdown'),
-                        reply_markup=generators.generate_fast_un_checkin_markup(SESSIONS.get(user_id),
-                                                                                previous_markup=callback_query.message.reply_markup)
-                    )
+                render = user_id if contains else 'sleep'
+                await outputs.show(
+                    bot,
+                    chat_id=callback_query.message.chat.id,
+                    message_id=callback_query.message.message_id,
+                    image=f'images/{render}.png',
+                    image_version=image_version(render),
+                    caption=generators.generate_fast_un_checkin_caption(),
+                    parse_mode='Markdown',
+                    reply_markup=generators.generate_fast_un_checkin_markup(SESSIONS.get(user_id), user_id,
+                                                                            previous_markup=callback_query.message.reply_markup)
+                )
 
         elif training_info['checked_in']:
-            api.cancel_checkin(SESSIONS.get(user_id), training_id)
+            await asyncio.to_thread(api.cancel_checkin, SESSIONS.get(user_id), training_id)
+            changed_check_in(user_id, training_id, False)
 
             if callback_query.message.photo is not None:
                 contains = generators.draw_my_week(SESSIONS.get(user_id), user_id)
-                with open(f'images/{user_id if contains else "sleep"}.png', 'rb') as file:
-                    await bot.edit_message_media(
-                        chat_id=callback_query.message.chat.id,
-                        message_id=callback_query.message.message_id,
-                        media=InputMediaPhoto(
-                            file,
-                            caption=generators.generate_fast_un_checkin_caption(),
-                            parse_mode='Markdown'),
-                        reply_markup=generators.generate_fast_un_checkin_markup(SESSIONS.get(user_id),
-                                                                                previous_markup=callback_query.message.reply_markup)
-                    )
+                render = user_id if contains else 'sleep'
+                await outputs.show(
+                    bot,
+                    chat_id=callback_query.message.chat.id,
+                    message_id=callback_query.message.message_id,
+                    image=f'images/{render}.png',
+                    image_version=image_version(render),
+                    caption=generators.generate_fast_un_checkin_caption(),
+                    parse_mode='Markdown',
+                    reply_markup=generators.generate_fast_un_checkin_markup(SESSIONS.get(user_id), user_id,
+                                                                            previous_markup=callback_query.message.reply_markup)
+                )
 
         else:
             await callback_query.answer(
@@ -748,7 +1145,7 @@ async def raw_checkin(callback_query: CallbackQuery):
                 chat_id=user_id,
                 message_id=callback_query.message.message_id,
                 reply_markup=generators.generate_inline_markup(
-                    {'text': 'Notify me 🔔', 'callback_data': f'rawnid/{training_id}'})
+                    {'text': 'Notify me 🔔', 'callback_data': callbacks.RAW_NOTIFICATION.encode(training_id)})
             )
     else:
         database.add_user_notification(training_id, user_id)
@@ -759,15 +1156,15 @@ async def raw_checkin(callback_query: CallbackQuery):
         await callback_query.answer('Success')
 
 
-@dp.callback_query_handler(lambda c: c.data == 'del')
-async def delete_message(callback_query: CallbackQuery):
+@router.route(callbacks.DELETE)
+async def delete_message(callback_query: CallbackQuery, payload):
     await callback_query.message.delete()
     await callback_query.answer('Nice!')
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('logout/'))
-async def logout_approve(callback_query: CallbackQuery):
-    date = callback_query.data.split('/')[1]
+@router.route(callbacks.LOGOUT)
+async def logout_approve(callback_query: CallbackQuery, payload):
+    date = payload.date
     user_id = callback_query.from_user.id
 
     await bot.edit_message_caption(
@@ -778,12 +1175,14 @@ async def logout_approve(callback_query: CallbackQuery):
     )
 
 
-@dp.callback_query_handler(lambda c: c.data == 'logoutnow')
-async def logout_now(callback_query: CallbackQuery):
+@router.route(callbacks.LOGOUT_NOW)
+async def logout_now(callback_query: CallbackQuery, payload):
     user_id = callback_query.from_user.id
-    if SESSIONS.get(user_id):
-        SESSIONS[user_id] = None
+    SESSIONS.pop(user_id)
+    week_view.forget(user_id)
+    user_stats.forget_user(user_id)
     database.remove_user(user_id)
+    sessions.reset_context(user_id)
     await bot.send_message(
         chat_id=callback_query.from_user.id,
         text="Your session information successfully deleted from the database. Message /start if you want to register."
@@ -793,9 +1192,11 @@ async def logout_now(callback_query: CallbackQuery):
 @dp.message_handler(commands=['logout'])
 async def logout(message: Message):
     user_id = message.from_user.id
-    if SESSIONS.get(user_id):
-        SESSIONS[user_id] = None
+    SESSIONS.pop(user_id)
+    week_view.forget(user_id)
+    user_stats.forget_user(user_id)
     database.remove_user(user_id)
+    sessions.reset_context(user_id)
     await message.reply("Your session information successfully deleted from the database. Message /start if you want to register.")
 
 
@@ -830,9 +1231,69 @@ async def kill_application(message: Message):
 
 @dp.message_handler(lambda msg: msg.from_user.id == ADMIN_ID, commands=['reload_semester'])
 async def reload_semester(message: Message):
-    logging.critical('Reload semester_trainings.json file')
+    logging.critical('Reload semester trainings')
     if message.from_user.id == ADMIN_ID:  # useless if, but extra safety is nice
-        generators.parse_and_save_whole_semester(SESSIONS.get(ADMIN_ID))
+        reference.invalidate('semester')
+        generators.parse_and_save_whole_semester(SERVICE.session())
+
+
+@dp.message_handler(lambda msg: msg.from_user.id == ADMIN_ID, commands=['memory'])
+async def memory_usage(message: Message):
+    if message.from_user.id == ADMIN_ID:  # useless if, but extra safety is nice
+        stats = SESSIONS.stats()
+        await message.reply(
+            f'Sessions: {stats["sessions"]}/{stats["max_sessions"]} '
+            f'(evicted {stats["evictions"]}, rebuilt {stats["rehydrations"]})\n'
+            f'Login requests: {len(LOGIN_REQUEST)}\n'
+            f'FSM records: {len(storage) if isinstance(storage, sessions.BoundedMemoryStorage) else "shared"}\n'
+            f'Occupancy history: {occupancy.stats()["trainings"]} trainings, {occupancy.stats()["samples"]} samples\n'
+            f'Upstream: {upstream.GATE.stats()}\n'
+            f'Service accounts: ' + ', '.join(
+                f'{account["email"]} {"ok" if account["healthy"] else account["last error"]} ({account["in flight"]} in flight, {account["served"]} served)'
+                for account in SERVICE.stats()
+            ) + '\n'
+            f'Max RSS: {stats["max_rss_mb"]} MB'
+        )
+
+
+@dp.message_handler(lambda msg: msg.from_user.id == ADMIN_ID, commands=['stats'])
+async def call_statistics(message: Message):
+    if message.from_user.id == ADMIN_ID:  # useless if, but extra safety is nice
+        await message.reply(metrics.REGISTRY.summary())
+
+
+@dp.message_handler(lambda msg: msg.from_user.id == ADMIN_ID, commands=['seats'])
+async def seat_history(message: Message):
+    if message.from_user.id == ADMIN_ID:  # useless if, but extra safety is nice
+        argument = message.get_args()
+        if argument.isdigit():
+            await message.reply(occupancy.describe(int(argument)))
+            return
+        top = occupancy.top_groups()
+        await message.reply(
+            'Groups by released seats:\n' + '\n'.join(f'{group_id}: {amount}' for group_id, amount in top)
+            if top else 'No released seats observed yet'
+        )
+
+
+@dp.message_handler(lambda msg: msg.from_user.id == ADMIN_ID, commands=['profile'])
+async def profile_bot(message: Message):
+    if message.from_user.id == ADMIN_ID:  # useless if, but extra safety is nice
+        if profiler.is_running():
+            await message.reply('Profiler is already running, wait for it to finish')
+            return
+        argument = message.get_args()
+        seconds = min(int(argument), 120) if argument.isdigit() and int(argument) > 0 else 10
+        logging.info(f'Profiling bot for {seconds} seconds')
+        await message.reply(f'Profiling bot for {seconds} seconds...')
+
+        result = await profiler.profile(seconds)
+        await message.reply(result.report()[:4096])
+        await bot.send_document(
+            chat_id=message.chat.id,
+            document=InputFile(io.BytesIO(result.sampler.collapsed().encode()), filename=f'profile_{int(time.time())}.collapsed'),
+            caption='Collapsed stacks (flamegraph.pl, speedscope)'
+        )
 
 
 @dp.message_handler(lambda msg: msg.from_user.id == ADMIN_ID, commands=['broadcast'])
@@ -846,9 +1307,13 @@ async def print_help(message: Message):
     if message.from_user.id == ADMIN_ID:  # special for admin only
         await message.reply(
             'You are admin, how you have forgotten your commands? Ok, let me explain:\n'
-            '/reload_semester - you will reload huge file that contains info about all trainings for current semester (used in auto-checkin)\n'
+            '/reload_semester - you will reload info about all trainings for current semester (used in auto-checkin)\n'
             '/broadcast - you will open menu to send message to all users (statistic will be provided). '
             'MardownV2 is implemented, so you can add *balled*, _italic_ and |spoiler| messages!\n'
+            '/memory - amount of cached sessions, FSM records and memory usage\n'
+            '/stats - calls count, error rate and latency of sport site, database, renders, telegram and jobs\n'
+            '/seats GROUP_ID - when seats of the group usually free up (groups with most released seats without id)\n'
+            '/profile N - profile bot for N seconds (10 by default), you will get top functions and flame graph stacks\n'
             '/kill - kill bot even if you are not connected to university wifi\n'
         )
     else:
@@ -878,11 +1343,11 @@ async def process_message(message: Message, state: FSMContext):
     )
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith('conf/'), state=BroadcastInfo.confirmation)
+@dp.callback_query_handler(lambda c: callbacks.get_prefix(c.data) == callbacks.CONFIRMATION.prefix, state=BroadcastInfo.confirmation)
 async def selected_confirmation_result(callback_query: CallbackQuery, state: FSMContext):
     await bot.edit_message_reply_markup(chat_id=callback_query.message.chat.id,
                                         message_id=callback_query.message.message_id)
-    choice = callback_query.data.split('/')[1]
+    choice = callbacks.CONFIRMATION.decode(callback_query.data).choice
     if choice == 'sure':
         users = database.get_users()
         fail = 0
@@ -912,20 +1377,48 @@ async def unknown_message(message: Message):
 
     date = generators.get_today()
     if is_offline(user_id):
-        contains = generators.generate_date_image(date, user_id, SESSIONS.get(ADMIN_ID), rewrite=True, ignore_checked_in=True)
+        contains = generators.generate_date_image(date, user_id, SERVICE.session(), rewrite=True, ignore_checked_in=True)
     else:
         contains = generators.generate_date_image(date, user_id, SESSIONS.get(user_id), rewrite=True)
 
-    with open(f'images/{user_id if contains else "free"}.png', 'rb') as file:
-        await bot.send_photo(
+    render = user_id if contains else 'free'
+    caption = generators.generate_date_caption(date)
+    reply_markup = generators.generate_date_inline(date)
+    with open(f'images/{render}.png', 'rb') as file:
+        sent = await bot.send_photo(
             chat_id=message.from_user.id,
-            caption=generators.generate_date_caption(generators.get_today()),
+            caption=caption,
             parse_mode="Markdown",
-            reply_markup=generators.generate_date_inline(generators.get_today()),
+            reply_markup=reply_markup,
             photo=file
         )
+    outputs.remember(sent.chat.id, sent.message_id, image_version(render), caption, reply_markup, parse_mode='Markdown')
 
 
 if __name__ == '__main__':
-    update_session(ADMIN_ID)
-    executor.start_polling(dp, skip_updates=True)
+    migrated = database.migrate_notifications()
+    if migrated:
+        logging.info(f'Migrated {migrated} notification lists to keyed sets')
+    if METRICS_PORT:
+        metrics.serve(METRICS_HOST, METRICS_PORT)
+    if WORKER_COUNT > 1:
+        logging.info(f'Worker {WORKER_INDEX + 1}/{WORKER_COUNT} ({cluster.worker_name()}) started')
+    if BOT_MODE == 'webhook':
+        webhook.run(
+            dp,
+            url=WEBHOOK_URL,
+            path=WEBHOOK_PATH,
+            host=WEBAPP_HOST,
+            port=WEBAPP_PORT,
+            workers=UPDATE_WORKERS,
+            secret_token=WEBHOOK_SECRET,
+            on_startup=start_watchdog,
+            on_shutdown=shutdown_scheduler
+        )
+    else:
+        executor.start_polling(
+            dp,
+            skip_updates=True,
+            on_startup=lambda _: start_watchdog(),
+            on_shutdown=lambda _: shutdown_scheduler()
+        )
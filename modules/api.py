@@ -1,31 +1,58 @@
 from requests.exceptions import ContentDecodingError, ConnectionError, RetryError
-from requests import session as create_request_session, get
+from requests import session as create_request_session
 from requests.sessions import Session
-from bs4 import BeautifulSoup
-from datetime import datetime
+from bs4 import BeautifulSoup, SoupStrainer
+from datetime import datetime, timedelta
+from modules import reference, upstream
+from os import getenv
 import calendar
 
+try:
+    import lxml  # noqa: F401, several times faster parser backend when installed
+    PARSER = 'lxml'
+except ImportError:
+    PARSER = 'html.parser'
 
-SERVER_URL = 'https://sport.innopolis.university'
+
+SERVER_URL = getenv('SPORT_SERVER_URL', 'https://sport.innopolis.university')
+
+# Scrapers build trees only of elements they read
+LOGIN_FORM = SoupStrainer('form', id='options')
+SEMESTER_HOURS = SoupStrainer('div', id='semester-hours')
+
+
+def _auth_result(name: str, attrs: dict) -> bool:
+    """
+    Error message or card with student id on the page after login form
+    """
+    if name != 'div':
+        return False
+    classes = attrs.get('class') or []
+    return attrs.get('id') == 'error' or 'card-body' in (classes.split() if isinstance(classes, str) else classes)
+
+
+AUTH_RESULT = SoupStrainer(_auth_result)
+
+_anonymous = upstream.mount(create_request_session())  # requests that need no account
 
 
 def is_dead() -> bool:
-    return get(SERVER_URL).status_code != 200
+    return _anonymous.get(SERVER_URL).status_code != 200
 
 
 def login_user(email: str, password: str) -> Session:
-    s = create_request_session()
+    s = upstream.mount(create_request_session())
     res = s.get(f'{SERVER_URL}/oauth2/login')
     if res.status_code != 200:
         raise ConnectionError('Server is down')
 
-    bs = BeautifulSoup(res.content, 'html.parser')
+    bs = BeautifulSoup(res.content, PARSER, parse_only=LOGIN_FORM)
     oath_url = bs.find('form', {'id': 'options'}).get('action')
     res = s.post(oath_url, data={
         'UserName': email,
         'Password': password,
         'AuthMethod': 'FormsAuthenication'})
-    bs = BeautifulSoup(res.content, 'html.parser')
+    bs = BeautifulSoup(res.content, PARSER, parse_only=AUTH_RESULT)
     dif_error = bs.find('div', {'id': 'error'})
     if res.status_code != 200:
         raise RetryError('Authentication problem on the server side')
@@ -62,13 +89,15 @@ def get_group_info(session: Session, group_id: int) -> dict:
 def checkin(session: Session, training_id: int) -> None:
     session.headers['Referer'] = f'{SERVER_URL}/profile/'
     session.headers['X-CSRFToken'] = session.cookies['csrftoken']
-    session.post(f'{SERVER_URL}/api/training/{training_id}/check_in')
+    with upstream.priority(upstream.CHECK_IN):
+        session.post(f'{SERVER_URL}/api/training/{training_id}/check_in')
 
 
 def cancel_checkin(session: Session, training_id: int) -> None:
     session.headers['Referer'] = f'{SERVER_URL}/profile/'
     session.headers['X-CSRFToken'] = session.cookies['csrftoken']
-    session.post(f'{SERVER_URL}/api/training/{training_id}/cancel_check_in')
+    with upstream.priority(upstream.CHECK_IN):
+        session.post(f'{SERVER_URL}/api/training/{training_id}/cancel_check_in')
 
 
 def session_is_valid(session: Session) -> bool:
@@ -84,11 +113,12 @@ def student_id_is_valid(session: Session, student_id: int or str) -> bool:
     return 'html' not in str(session.get(f'{SERVER_URL}/api/attendance/{student_id}/negative_hours').content)
 
 
-def get_user_statistics(session: Session) -> dict:
-    return {
-        'hours': session.get(f'{SERVER_URL}/api/attendance/{session.cookies["student_id"]}/negative_hours').json()['final_hours'],
-        'better_than': session.get(f'{SERVER_URL}/api/attendance/{session.cookies["student_id"]}/better_than').json()
-    }
+def get_negative_hours(session: Session) -> float:
+    return session.get(f'{SERVER_URL}/api/attendance/{session.cookies["student_id"]}/negative_hours').json()['final_hours']
+
+
+def get_better_than(session: Session) -> float:
+    return session.get(f'{SERVER_URL}/api/attendance/{session.cookies["student_id"]}/better_than').json()
 
 
 def get_teachers(session: Session, group_id: int) -> dict:
@@ -96,8 +126,17 @@ def get_teachers(session: Session, group_id: int) -> dict:
 
 
 def get_semester_start_end_dates(session: Session) -> list:
-    res = session.get(f'{SERVER_URL}/profile')
-    bs = BeautifulSoup(res.content, 'html.parser')
+    dates = reference.get(
+        'semester',
+        lambda s: [day.isoformat() for day in parse_semester_start_end_dates(s.get(f'{SERVER_URL}/profile').content)],
+        ttl=lambda days: (datetime.fromisoformat(days[1]) + timedelta(days=1) - datetime.now()).total_seconds(),  # till the end of the last day
+        session=session
+    )
+    return [datetime.fromisoformat(day) for day in dates]
+
+
+def parse_semester_start_end_dates(content: bytes) -> list:
+    bs = BeautifulSoup(content, PARSER, parse_only=SEMESTER_HOURS)
     raw_table = bs.find('div', {'id': 'semester-hours'})
     raw_row = raw_table.find_all('tr', limit=2)[1]
     raw_semester_start_end = list(map(lambda a: a.text.replace(',', '').replace('.', '').split(), raw_row.find_all('td', limit=2)))
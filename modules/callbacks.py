@@ -0,0 +1,145 @@
+from collections import namedtuple
+from typing import Callable, Awaitable
+
+MAX_CALLBACK_BYTES = 64  # telegram limit for callback_data
+SEPARATOR = '/'
+
+
+class CallbackKind:
+    """
+    Typed codec of one callback kind: `prefix/field1/field2/...`
+
+    GROUP = CallbackKind('gid', date=str, group_id=int)
+    GROUP.encode('2022-10-10', 436) -> 'gid/2022-10-10/436'
+    GROUP.decode('gid/2022-10-10/436') -> Payload(date='2022-10-10', group_id=436)
+    """
+    def __init__(self, prefix: str, **fields: type):
+        self.prefix = prefix
+        self.fields = fields
+        self.payload = namedtuple(f'{prefix.capitalize()}Payload', fields.keys())
+        self._types = tuple(fields.values())
+        self._parts = len(fields) + 1
+
+    def __repr__(self) -> str:
+        return f'CallbackKind({self.prefix!r})'
+
+    def encode(self, *values) -> str:
+        if len(values) != len(self.fields):
+            raise ValueError(f'{self.prefix} expects {len(self.fields)} values, got {len(values)}')
+        parts = [self.prefix]
+        for (name, field_type), value in zip(self.fields.items(), values):
+            value = str(field_type(value))
+            if SEPARATOR in value:
+                raise ValueError(f'{self.prefix}.{name} cannot contain "{SEPARATOR}": {value!r}')
+            parts.append(value)
+        data = SEPARATOR.join(parts)
+        if len(data.encode()) > MAX_CALLBACK_BYTES:
+            raise ValueError(f'Callback data is longer than {MAX_CALLBACK_BYTES} bytes: {data!r}')
+        return data
+
+    def decode(self, data: str):
+        parts = data.split(SEPARATOR)
+        if len(parts) != self._parts or parts[0] != self.prefix:
+            raise ValueError(f'{data!r} is not a {self.prefix} callback')
+        return self.payload._make(map(lambda field_type, value: field_type(value), self._types, parts[1:]))
+
+
+START = CallbackKind('start', mode=str)
+MY = CallbackKind('my', date=str)
+CHANGE_DAY = CallbackKind('change')
+DATE = CallbackKind('date', date=str)
+CHECKIN_MENU = CallbackKind('ckin', date=str)
+GROUP = CallbackKind('gid', date=str, group_id=int)
+AUTO_MENU = CallbackKind('auto', date=str)
+WHY = CallbackKind('why')
+AUTO_CHECKIN = CallbackKind('aid', date=str, training_key=str)
+UNCHECKIN_MENU = CallbackKind('unckin', date=str)
+TRAINING = CallbackKind('tid', training_id=int)
+NOTIFICATION = CallbackKind('ntid', training_id=int)
+RAW_CHECKIN = CallbackKind('rawckin', training_id=int)
+RAW_NOTIFICATION = CallbackKind('rawnid', training_id=int)
+FAST_CHECKIN = CallbackKind('fckin', training_id=int)
+DELETE = CallbackKind('del')
+LOGOUT = CallbackKind('logout', date=str)
+LOGOUT_NOW = CallbackKind('logoutnow')
+CONFIRMATION = CallbackKind('conf', choice=str)
+
+
+def get_prefix(data: str) -> str:
+    return data.partition(SEPARATOR)[0]
+
+
+class Router:
+    """
+    O(1) dispatch of callback queries by prefix to `handler(callback_query, payload)`.
+
+    Routes registered with coalesce=True run one at a time per (user, message): taps that come
+    while a handler runs wait, a newer tap replaces the waiting one (which is answered right away)
+    and a tap with the same data as the running one is dropped as a repeated tap
+    """
+    SUPERSEDED_TEXT = 'Updating, please wait...'
+
+    def __init__(self):
+        self.routes = dict()  # prefix -> (kind, handler, requires_session, coalesce)
+        self._running = dict()  # (user_id, chat_id, message_id) -> [running data, waiting (handler, callback_query, payload)]
+
+    def route(self, *kinds: CallbackKind, requires_session: bool = True, coalesce: bool = False):
+        def decorator(handler: Callable[..., Awaitable]):
+            for kind in kinds:
+                if kind.prefix in self.routes:
+                    raise ValueError(f'Route for {kind.prefix} is already registered')
+                self.routes[kind.prefix] = (kind, handler, requires_session, coalesce)
+            return handler
+        return decorator
+
+    def resolve(self, data: str) -> tuple or None:
+        """
+        Returns (handler, payload) for callback data or None if no route found
+        """
+        route = self.routes.get(get_prefix(data or ''))
+        if route is None:
+            return None
+        kind, handler = route[:2]
+        try:
+            return handler, kind.decode(data)
+        except ValueError:
+            return None
+
+    def is_public(self, data: str) -> bool:
+        route = self.routes.get(get_prefix(data or ''))
+        return route is not None and not route[2]
+
+    async def dispatch(self, callback_query) -> None:
+        resolved = self.resolve(callback_query.data)
+        if resolved is None:
+            await callback_query.answer('This button is outdated, please send /now')
+            return
+        handler, payload = resolved
+        if not self.routes[get_prefix(callback_query.data)][3] or callback_query.message is None:
+            await handler(callback_query, payload)
+            return
+
+        key = (callback_query.from_user.id, callback_query.message.chat.id, callback_query.message.message_id)
+        state = self._running.get(key)
+        if state is not None:  # handler for this message is running, latest tap waits for it
+            running_data, waiting = state
+            if callback_query.data == running_data:  # repeated tap, running handler already does it
+                state[1] = None
+                await callback_query.answer(self.SUPERSEDED_TEXT)
+            else:
+                state[1] = (handler, callback_query, payload)
+            if waiting is not None:
+                await waiting[1].answer(self.SUPERSEDED_TEXT)
+            return
+
+        state = self._running[key] = [callback_query.data, None]
+        try:
+            await handler(callback_query, payload)
+            while state[1] is not None:  # only the latest tap that came meanwhile
+                handler, callback_query, payload = state[1]
+                state[0], state[1] = callback_query.data, None
+                await handler(callback_query, payload)
+        finally:
+            self._running.pop(key, None)
+            if state[1] is not None:  # handler failed, waiting tap is not going to run
+                await state[1][1].answer('Some error occurred, please try again later')
@@ -0,0 +1,60 @@
+"""
+Schedule change detector: snapshots of upcoming trainings of the semester are compared with
+the previous one to find added, removed and moved trainings, so caches, auto-checkins and
+notifications that depend on them are fixed in one pass instead of being probed per user
+"""
+from requests.sessions import Session
+from datetime import datetime
+from modules import api
+import calendar
+
+
+def fetch_snapshot(session: Session) -> dict:
+    """
+    Upcoming trainings of the semester {str(training_id): [group_id, title, start, end]}
+    """
+    today = datetime.now()
+    semester_end = api.get_semester_start_end_dates(session)[1]
+    if semester_end < today:
+        return dict()
+    sports = api.get_full_time_period(session, today.strftime('%Y-%m-%d'), semester_end.strftime('%Y-%m-%d'))
+    return {
+        str(sport['extendedProps']['id']): [
+            sport['extendedProps']['group_id'], sport['title'], sport['start'].split('+')[0], sport['end'].split('+')[0]
+        ]
+        for sport in sports
+    }
+
+
+def diff(previous: dict, current: dict, since: str) -> tuple:
+    """
+    Ids of added, removed and moved (other group or time) trainings. Trainings of the previous
+    snapshot that started before `since` (iso) have just passed, they are not removed
+    """
+    added = [training_id for training_id in current if training_id not in previous]
+    removed = [
+        training_id for training_id, entry in previous.items()
+        if training_id not in current and entry[2] >= since
+    ]
+    moved = [
+        training_id for training_id, entry in current.items()
+        if training_id in previous and (previous[training_id][0], previous[training_id][2:]) != (entry[0], entry[2:])
+    ]
+    return added, removed, moved
+
+
+def training_key(entry: list) -> str:
+    """
+    Auto-checkin key `group_id|weekday|start-end` of a snapshot entry
+    """
+    start, end = datetime.fromisoformat(entry[2]), datetime.fromisoformat(entry[3])
+    return f"{entry[0]}|{start.weekday()}|{start.strftime('%H:%M')}-{end.strftime('%H:%M')}"
+
+
+def describe(entry: list) -> str:
+    start, end = datetime.fromisoformat(entry[2]), datetime.fromisoformat(entry[3])
+    return f"{entry[1]} on {calendar.day_name[start.weekday()]} at {start.strftime('%H:%M')}-{end.strftime('%H:%M')} ({start.strftime('%d/%m/%Y')})"
+
+
+def dates(*entries: list) -> set:
+    return {entry[2].split('T')[0] for entry in entries}
@@ -0,0 +1,160 @@
+from aiogram.dispatcher.storage import BaseStorage
+from functools import wraps
+from typing import Callable, Awaitable
+from modules import sessions
+from modules.database import db  # firebase or in-memory stand-in
+import threading
+import asyncio
+import logging
+import socket
+import time
+import os
+
+
+def worker_name() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def owns(user_id: int or str, worker_index: int, worker_count: int) -> bool:
+    """
+    Whether user is handled by this worker when per-user jobs are sharded between workers
+    """
+    return int(user_id) % worker_count == worker_index
+
+
+class LocalLeaseBackend:
+    """
+    In-process lease storage (single worker and tests)
+    """
+    def __init__(self):
+        self._leases = dict()
+        self._lock = threading.Lock()
+
+    def acquire(self, name: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            current = self._leases.get(name)
+            if current is None or current['owner'] == owner or current['expires'] < now:
+                self._leases[name] = {'owner': owner, 'expires': now + ttl}
+                return True
+            return False
+
+    def release(self, name: str, owner: str) -> None:
+        with self._lock:
+            if self._leases.get(name, {}).get('owner') == owner:
+                self._leases.pop(name)
+
+
+class FirebaseLeaseBackend:
+    """
+    Leases stored in /leases/{name} and taken with firebase transactions, shared by all workers
+    """
+    def acquire(self, name: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+
+        def take(current):
+            if current is None or current.get('owner') == owner or current.get('expires', 0) < now:
+                return {'owner': owner, 'expires': now + ttl}
+            return current
+
+        try:
+            result = db.reference(f'/leases/{name}').transaction(take)
+        except db.TransactionAbortedError:
+            return False
+        return result is not None and result.get('owner') == owner
+
+    def release(self, name: str, owner: str) -> None:
+        db.reference(f'/leases/{name}').transaction(
+            lambda current: None if current is not None and current.get('owner') == owner else current
+        )
+
+
+class Lease:
+    """
+    Time-limited leadership over a named job. Holder renews it on every acquire(),
+    others can take it only after it expires (holder died or stopped)
+    """
+    def __init__(self, name: str, ttl: float, backend=None, owner: str = None):
+        self.name = name
+        self.ttl = ttl
+        self.backend = backend if backend is not None else LocalLeaseBackend()
+        self.owner = owner if owner is not None else worker_name()
+        self.held = False
+
+    def acquire(self) -> bool:
+        held = self.backend.acquire(self.name, self.owner, self.ttl)
+        if held != self.held:
+            logging.info(f'cluster.py -> Lease -> {self.owner} {"became" if held else "is no longer"} leader of {self.name}')
+        self.held = held
+        return held
+
+    def release(self) -> None:
+        if self.held:
+            self.backend.release(self.name, self.owner)
+            self.held = False
+
+
+def leader_only(lease: Lease):
+    """
+    Run decorated scheduler job only on the worker that holds the lease (taken in a thread,
+    firebase transactions block). The lease is renewed every third of its ttl while the job
+    runs, and the job is cancelled when another worker took it over
+    """
+    def decorator(job: Callable[[], Awaitable]):
+        @wraps(job)
+        async def wrapper():
+            if not await asyncio.to_thread(lease.acquire):
+                return
+            task = asyncio.ensure_future(job())
+            try:
+                while not (await asyncio.wait({task}, timeout=lease.ttl / 3))[0]:
+                    if not await asyncio.to_thread(lease.acquire):
+                        logging.warning(f'cluster.py -> leader_only -> lease {lease.name} lost, {job.__name__} is stopped')
+                        task.cancel()
+                        await asyncio.wait({task})
+                        return
+                task.result()
+            finally:
+                task.cancel()  # no-op when finished, stops the job when the wrapper itself is cancelled
+        return wrapper
+    return decorator
+
+
+class SharedFlags:
+    """
+    Dict-like user_id -> bool flags stored in /flags/{name}, so every worker sees the same value
+    """
+    def __init__(self, name: str):
+        self.name = name
+
+    def __len__(self) -> int:
+        data = db.reference(f'/flags/{self.name}').get(shallow=True)
+        return len(data) if data else 0
+
+    def get(self, key, default=None):
+        value = db.reference(f'/flags/{self.name}/{key}').get()
+        return default if value is None else value
+
+    def __setitem__(self, key, value) -> None:
+        db.reference(f'/flags/{self.name}/{key}').set(value if value else None)
+
+    def prune(self) -> int:
+        return 0
+
+
+def create_storage(redis_url: str = None, max_size: int = 1000) -> BaseStorage:
+    """
+    FSM storage shared by workers (redis) or local bounded memory storage when redis_url is not set
+    """
+    if redis_url is None:
+        return sessions.BoundedMemoryStorage(max_size=max_size)
+    from aiogram.contrib.fsm_storage.redis import RedisStorage2  # requires optional aioredis
+    from urllib.parse import urlparse
+    url = urlparse(redis_url)
+    return RedisStorage2(
+        host=url.hostname or 'localhost',
+        port=url.port or 6379,
+        db=int(url.path.lstrip('/') or 0),
+        password=url.password,
+        prefix='sport_ui_bot_fsm'
+    )
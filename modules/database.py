@@ -1,23 +1,109 @@
 from requests.sessions import Session, session
 import firebase_admin
 from firebase_admin import db
+from firebase_admin.exceptions import FirebaseError
 from os import getenv
 from collections import OrderedDict
+from contextlib import nullcontext
+from modules import upstream
+import logging
+import asyncio
+import time
 import dotenv
 
 dotenv.load_dotenv(dotenv.find_dotenv())
-cred_obj = firebase_admin.credentials.Certificate('firebase-adminsdk.json')
-default_app = firebase_admin.initialize_app(
-    cred_obj,
-    {
-        'databaseURL': getenv('DATABASE_URL')
-    }
-)
-
-
-def create_session(user_id: int) -> Session or None:
-    s = session()
-    data = get_user(user_id)
+if getenv('DATABASE_URL', '').startswith('memory://'):  # local in-memory database (benchmarks, local runs)
+    from modules import memory_db as db
+else:
+    cred_obj = firebase_admin.credentials.Certificate('firebase-adminsdk.json')
+    default_app = firebase_admin.initialize_app(
+        cred_obj,
+        {
+            'databaseURL': getenv('DATABASE_URL')
+        }
+    )
+
+
+class Batch:
+    """
+    Collect mutations and write them as one atomic multi-location update
+
+    with database.Batch() as batch:
+        database.remove_auto_checkin(user_id, training_string, batch=batch)
+
+    Coroutines use `async with`, so the write and its retry back-off run in a thread
+    """
+    def __init__(self, retries: int = 3, retry_delay: float = 0.5):
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.updates = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await asyncio.to_thread(self.flush)
+
+    def __len__(self):
+        return len(self.updates)
+
+    def set(self, path: str, value) -> None:
+        path = path.strip('/')
+        for key in list(self.updates):
+            if key.startswith(path + '/'):  # overwritten by the new value
+                self.updates.pop(key)
+            elif path.startswith(key + '/'):  # firebase rejects ancestor paths in one update, so merge into it
+                node = self.updates[key]
+                if not isinstance(node, dict):
+                    node = self.updates[key] = dict()
+                *parents, child = path[len(key) + 1:].split('/')
+                for parent in parents:
+                    if not isinstance(node.get(parent), dict):
+                        node[parent] = dict()
+                    node = node[parent]
+                node[child] = value
+                return
+        self.updates[path] = value
+
+    def delete(self, path: str) -> None:
+        self.set(path, None)
+
+    def flush(self) -> None:
+        if not self.updates:
+            return
+        updates, self.updates = self.updates, dict()
+        for attempt in range(self.retries + 1):
+            try:
+                db.reference('/').update(updates)
+                return
+            except FirebaseError as ex:
+                if attempt == self.retries:
+                    logging.error(f'database.py -> Batch.flush -> {len(updates)} writes lost: {ex}')
+                    raise
+                time.sleep(self.retry_delay * 2 ** attempt)
+
+
+def _write(path: str, value, batch: Batch = None) -> None:
+    if batch is not None:
+        batch.set(path, value)
+    elif value is None:
+        db.reference(path).delete()
+    else:
+        db.reference(path).set(value)
+
+
+def create_session(user_id: int, data: OrderedDict = None) -> Session or None:
+    """
+    Session of the user built from the database entry (read when `data` is not given)
+    """
+    s = upstream.mount(session())
+    data = data if data is not None else get_user(user_id)
     if data:
         data: OrderedDict
         s.cookies['sessionid'] = data.get('session_id')
@@ -27,21 +113,21 @@ def create_session(user_id: int) -> Session or None:
     return None
 
 
-def create_user(user_id: int, student_id: int or str, session_id: str = None, csrftoken: str = None) -> None:
-    remove_user(user_id)
-    ref = db.reference(f'/users')
-    ref.child(str(user_id)).set(
+def create_user(user_id: int, student_id: int or str, session_id: str = None, csrftoken: str = None, batch: Batch = None) -> None:
+    # set replaces the whole node, so the previous user data is dropped in the same write
+    _write(
+        f'/users/{user_id}',
         {
             'student_id': student_id,
             'session_id': session_id,
             'csrf_token': csrftoken
-        }
+        },
+        batch
     )
 
 
-def remove_user(user_id: int):
-    ref = db.reference(f'/users/{user_id}')
-    ref.delete()
+def remove_user(user_id: int, batch: Batch = None):
+    _write(f'/users/{user_id}', None, batch)
 
 
 def get_user(user_id: int) -> OrderedDict or None:
@@ -55,36 +141,79 @@ def get_users() -> list:
     return [int(elem) for elem in data] if data else []
 
 
-def get_notification_users(training_id: int):
+def __keys(data) -> set:
+    """
+    Keys of a keyed set node (firebase may return sparse integer keys as a list)
+    """
+    if not data:
+        return set()
+    if isinstance(data, list):
+        return {key for key, value in enumerate(data) if value is not None}
+    return {int(key) for key in data}
+
+
+def get_notification_users(training_id: int) -> set:
     ref = db.reference(f'/notifications/{training_id}')
-    data = ref.get()
-    return list(data.values()) if data else []
+    return __keys(ref.get(shallow=True))
+
+
+def get_user_notifications(user_id: int) -> set:
+    ref = db.reference(f'/user_notifications/{user_id}')
+    return __keys(ref.get(shallow=True))
+
+
+def is_user_notified(training_id: int, user_id: int) -> bool:
+    ref = db.reference(f'/notifications/{training_id}/{user_id}')
+    return ref.get() is not None
 
 
 def add_user_notification(training_id: int, user_id: int):
-    ref = db.reference(f'/notifications/{training_id}')
-    ref.push(user_id)
+    ref = db.reference('/')
+    ref.update({
+        f'notifications/{training_id}/{user_id}': True,
+        f'user_notifications/{user_id}/{training_id}': True
+    })
 
 
 def remove_user_notification(training_id: int, user_id: int):
-    ref = db.reference(f'/notifications/{training_id}')
-    res = ref.get()
-    for (key, value) in res.items() if res else []:
-        if value == user_id:
-            ref = db.reference(f'/notifications/{training_id}/{key}')
-            ref.delete()
-            return
+    ref = db.reference('/')
+    ref.update({
+        f'notifications/{training_id}/{user_id}': None,
+        f'user_notifications/{user_id}/{training_id}': None
+    })
 
 
 def get_notifications() -> list:
     ref = db.reference(f'/notifications')
-    data = ref.get()
-    return [int(elem) for elem in data] if data else []
+    return list(__keys(ref.get(shallow=True)))
 
 
-def remove_notification(training_id: int):
-    ref = db.reference(f'/notifications/{training_id}')
-    ref.delete()
+def remove_notification(training_id: int, users: set = None, batch: Batch = None):
+    with Batch() if batch is None else nullcontext(batch) as batch:
+        batch.delete(f'notifications/{training_id}')
+        for user_id in get_notification_users(training_id) if users is None else users:
+            batch.delete(f'user_notifications/{user_id}/{training_id}')
+
+
+def migrate_notifications() -> int:
+    """
+    Convert old push-list notifications (/notifications/{training_id}/{push_key} = user_id)
+    into keyed sets (/notifications/{training_id}/{user_id} and /user_notifications/{user_id}/{training_id})
+    """
+    ref = db.reference(f'/notifications')
+    data = ref.get()
+    updates = dict()
+    for training_id, subscribers in (data or dict()).items():
+        if not isinstance(subscribers, dict) or all(value is True for value in subscribers.values()):
+            continue
+        users = {int(value) for value in subscribers.values() if value is not True}
+        users |= {int(key) for key, value in subscribers.items() if value is True}
+        updates[f'notifications/{training_id}'] = {str(user_id): True for user_id in users}
+        for user_id in users:
+            updates[f'user_notifications/{user_id}/{training_id}'] = True
+    if updates:
+        db.reference('/').update(updates)
+    return sum(key.count('/') == 1 for key in updates)
 
 
 def get_auto_checkins() -> OrderedDict or None:
@@ -97,12 +226,16 @@ def add_auto_checkin(user_id: int, training_string: str, training_ids: list) ->
     ref.child(training_string).set(training_ids)
 
 
-def remove_given_auto_checkin(user_id: int, training_string, training_id: int) -> None:
-    ref = db.reference(f'/auto_checkin/{user_id}/{training_string}')
-    training_ids: list = ref.get()
+def remove_given_auto_checkin(user_id: int, training_string, training_id: int, training_ids: list = None, batch: Batch = None) -> None:
+    """
+    Remove one training id from an auto-checkin key. When caller already holds
+    the id list (e.g. from get_auto_checkins) it is updated in place instead of re-read
+    """
+    if training_ids is None:
+        training_ids = db.reference(f'/auto_checkin/{user_id}/{training_string}').get() or []
     if training_id in training_ids:
         training_ids.remove(training_id)
-    ref.set(training_ids)
+    _write(f'/auto_checkin/{user_id}/{training_string}', training_ids or None, batch)
 
 
 def get_user_auto_checkins(user_id: int) -> OrderedDict or None:
@@ -115,6 +248,40 @@ def check_auto_checkin(user_id: int, training_string: str) -> bool:
     return ref.get() is not None
 
 
-def remove_auto_checkin(user_id: int, training_string: str) -> None:
-    ref = db.reference(f'/auto_checkin/{user_id}/{training_string}')
-    ref.delete()
+def remove_auto_checkin(user_id: int, training_string: str, batch: Batch = None) -> None:
+    _write(f'/auto_checkin/{user_id}/{training_string}', None, batch)
+
+
+def set_auto_checkin_ids(user_id: int, training_string: str, training_ids: list, batch: Batch = None) -> None:
+    _write(f'/auto_checkin/{user_id}/{training_string}', training_ids or None, batch)
+
+
+def set_semester_trainings(trainings: dict) -> None:
+    """
+    Replace semester trainings, trainings are {'group_id/weekday/start-end': [training_id, ...]}
+    """
+    nested = dict()
+    for training_key, training_ids in trainings.items():
+        group_id, weekday, time_range = training_key.split('/')
+        nested.setdefault(group_id, dict()).setdefault(weekday, dict())[time_range] = training_ids
+    ref = db.reference(f'/semester_trainings')
+    ref.set(nested)
+
+
+def get_semester_training_ids(training_key: str) -> list or None:
+    ref = db.reference(f'/semester_trainings/{training_key}')
+    return ref.get()
+
+
+def get_schedule_snapshot() -> dict or None:
+    """
+    Last seen upcoming trainings {training_id: [group_id, title, start, end]} (keys are strings)
+    """
+    data = db.reference('/schedule_snapshot').get()
+    if isinstance(data, list):  # firebase returns sparse integer keys as a list
+        return {str(key): value for key, value in enumerate(data) if value is not None}
+    return None if data is None else {str(key): value for key, value in data.items()}
+
+
+def set_schedule_snapshot(snapshot: dict) -> None:
+    _write('/schedule_snapshot', snapshot or None)
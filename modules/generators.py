@@ -2,14 +2,20 @@ import logging
 
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from requests.sessions import Session
+from typing import Callable
 import plotly.express as px
 from datetime import datetime, timedelta
 from transliterate import translit
 from os.path import isfile
-from modules import api, database
+from modules import api, callbacks, database, reference, schedule, sessions, tracing, user_stats, week_view
 import pandas as pd
+import threading
 import calendar
+import hashlib
+import shutil
 import json
+import glob
+import os
 
 COLORS = [
     '#e6194B',
@@ -33,6 +39,13 @@ COLORS = [
     '#000075'
 ]
 
+_render_lock = threading.Lock()  # kaleido is shared by handlers and warm-up thread
+_offline_renders = dict()  # date -> (schedule version, contains) of images/offline_{date}.png
+# (kind, date, group, identity class, data version) -> keyboard or its shared rows before per-user marks
+_keyboards = sessions.LRUCache(max_size=1024)
+_keyboards_lock = threading.Lock()
+_rendered = dict()  # safe_file_name -> fingerprint of the data rendered into images/{safe_file_name}.png
+
 
 def generate_inline_markup(*args) -> InlineKeyboardMarkup:
     """
@@ -78,17 +91,52 @@ def __get_time(date: str) -> str:
     return date.split('T')[1].split('+')[0]
 
 
+def __render_fingerprint(*data) -> str:
+    return hashlib.sha1(json.dumps(data, sort_keys=True, ensure_ascii=False, default=str).encode()).hexdigest()
+
+
+def __already_rendered(safe_file_name: str, fingerprint: str) -> bool:
+    return _rendered.get(safe_file_name) == fingerprint and isfile(f'images/{safe_file_name}.png')
+
+
+def __cached_keyboard(key: tuple, build: Callable):
+    """
+    Keyboard (or shared rows of it) built once per key, key has to contain version of the data it depends on
+    """
+    with _keyboards_lock:
+        keyboard = _keyboards.get(key)
+    if keyboard is None:
+        keyboard = build()
+        with _keyboards_lock:
+            _keyboards[key] = keyboard
+    return keyboard
+
+
+def rendered_version(safe_file_name: int or str) -> str or None:
+    """
+    Fingerprint of the data that images/{safe_file_name}.png was rendered from (None if unknown)
+    """
+    return _rendered.get(str(safe_file_name))
+
+
 def __adjust_text(text: str, char: str, size: int) -> str:
     len_text = len(text)
     just_size = (size - len_text - 2) // 2
     return char * just_size + ' ' + text + ' ' + char * just_size
 
 
-def draw_day(session: Session, current_date: str, safe_file_name: str, ignore_checked_in: bool = False) -> bool:
+def draw_day(session: Session, current_date: str, safe_file_name: str, ignore_checked_in: bool = False, user_id: int = None) -> bool:
     color_map = dict(not_available="#DDDDDD")
     graph_data = []
     default_colors = False
-    for sport in api.get_full_day(session, current_date):
+    # ignore_checked_in renders only public data, so they share the schedule cache
+    if ignore_checked_in:
+        sports = schedule.get_full_day(session, current_date)
+    elif user_id is not None:
+        sports = week_view.get_day(session, user_id, current_date)
+    else:
+        sports = api.get_full_day(session, current_date)
+    for sport in sports:
         if color_map.get(sport['title']) is None:
             if len(color_map) < len(COLORS):
                 color_map[sport['title']] = COLORS[len(color_map)]
@@ -97,7 +145,7 @@ def draw_day(session: Session, current_date: str, safe_file_name: str, ignore_ch
 
         cant_check_in = (not sport['extendedProps']['checked_in'] or ignore_checked_in) and not sport['extendedProps']['can_check_in']
         if cant_check_in and ignore_checked_in:
-            training_info = api.get_training_info(session, sport['extendedProps']['id'])
+            training_info = schedule.get_training_info(session, sport['extendedProps']['id'])
 
             capacity = training_info['training']['group']['capacity']
             load = capacity - training_info['training']['load']
@@ -121,6 +169,9 @@ def draw_day(session: Session, current_date: str, safe_file_name: str, ignore_ch
         })
     if not graph_data:
         return False
+    fingerprint = __render_fingerprint('day', current_date, graph_data, color_map, default_colors)
+    if __already_rendered(safe_file_name, fingerprint):  # same picture is already in the file
+        return True
     df = pd.DataFrame(graph_data)
     fig = px.timeline(df, x_start="Start", x_end="Finish", y="Sport type", color="Color", text='Text',
                       color_discrete_map=None if default_colors else color_map, width=1920, height=1080)
@@ -130,18 +181,18 @@ def draw_day(session: Session, current_date: str, safe_file_name: str, ignore_ch
         font=dict(size=14)
     )
 
-    fig.write_image(f'images/{safe_file_name}.png')
+    with tracing.span('render.write_image'), _render_lock:
+        fig.write_image(f'images/{safe_file_name}.png')
+    _rendered[safe_file_name] = fingerprint
     return True
 
 
-def draw_my_week(session: Session, safe_file_name: str) -> bool:
+def draw_my_week(session: Session, user_id: int) -> bool:
     color_map = dict()
     graph_data = []
     default_colors = False
-    start_date = get_today()
-    end_date = get_shifted_day(8)
-    start = datetime.fromisoformat(start_date)
-    for sport in api.get_full_time_period(session, start_date, end_date):
+    start = datetime.fromisoformat(get_today())
+    for sport in week_view.get_week(session, user_id):
         if not sport['extendedProps']['checked_in']:
             continue
 
@@ -181,13 +232,19 @@ def draw_my_week(session: Session, safe_file_name: str) -> bool:
         })
     if not graph_data:
         return False
+    safe_file_name = str(user_id)
+    fingerprint = __render_fingerprint('week', graph_data, color_map, default_colors)
+    if __already_rendered(safe_file_name, fingerprint):
+        return True
     df = pd.DataFrame(graph_data)
     fig = px.timeline(df, x_start="Start", x_end="Finish", y="Day", text='Text', color='Title',
                       color_discrete_map=None if default_colors else color_map, width=2048, height=1080)
     fig.update_xaxes(showticklabels=False)
     fig.update_layout(font=dict(size=30))
 
-    fig.write_image(f'images/{safe_file_name}.png')
+    with tracing.span('render.write_image'), _render_lock:
+        fig.write_image(f'images/{safe_file_name}.png')
+    _rendered[safe_file_name] = fingerprint
     return True
 
 
@@ -198,58 +255,107 @@ def generate_today_image(user_id: int, session: Session, ignore_checked_in: bool
 def generate_date_image(date: str, user_id: int, session: Session, rewrite: bool = False, ignore_checked_in: bool = False) -> bool:
     if isfile(f'images/{user_id}.png') and not rewrite:
         return True
-    return draw_day(session=session, current_date=date, safe_file_name=str(user_id), ignore_checked_in=ignore_checked_in)
+    if ignore_checked_in:  # same picture for every offline user, copy shared render
+        contains = generate_offline_day_image(session, date)
+        version = _rendered.get(f'offline_{date}')
+        if contains and not __already_rendered(str(user_id), version):
+            shutil.copyfile(f'images/offline_{date}.png', f'images/{user_id}.png')
+            _rendered[str(user_id)] = version
+        return contains
+    return draw_day(session=session, current_date=date, safe_file_name=str(user_id), user_id=user_id)
+
+
+def generate_offline_day_image(session: Session, date: str) -> bool:
+    """
+    Render images/offline_{date}.png unless it is already rendered from the same schedule version
+    """
+    for sport in schedule.get_full_day(session, date):  # refresh expired data that draw_day depends on
+        if not sport['extendedProps']['can_check_in']:
+            schedule.get_training_info(session, sport['extendedProps']['id'])
+    version = schedule.version(date)
+    cached = _offline_renders.get(date)
+    if cached is not None and cached[0] == version and (not cached[1] or isfile(f'images/offline_{date}.png')):
+        return cached[1]
+
+    new_file_name = f'offline_{date}_{threading.get_ident()}'
+    contains = draw_day(session=session, current_date=date, safe_file_name=new_file_name, ignore_checked_in=True)
+    if contains:  # replace atomically, handlers may be copying the old render right now
+        os.replace(f'images/{new_file_name}.png', f'images/offline_{date}.png')
+        _rendered[f'offline_{date}'] = _rendered.pop(new_file_name)
+    _offline_renders[date] = (version, contains)
+    return contains
+
+
+def warm_up_day(session: Session, date: str) -> None:
+    """
+    Refresh public schedule of the date and rebuild offline image and course keyboard if it changed
+    """
+    schedule.refresh_day(session, date)
+    generate_offline_day_image(session, date)
+    generate_date_courses_buttons(date, session)
+
+
+def drop_stale_renders(dates: list) -> None:
+    """
+    Remove offline renders of dates other than given ones (days that passed), keyboards age out of the LRU
+    """
+    for date in set(_offline_renders) - set(dates):
+        _offline_renders.pop(date, None)
+    for path in glob.glob('images/offline_*.png'):
+        if os.path.basename(path)[len('offline_'):len('offline_YYYY-MM-DD')] not in dates:
+            os.remove(path)
 
 
 def generate_mode_selection_inline():
-    return generate_inline_markup(
-        {'text': 'Offline', 'callback_data': 'start/offline'},
-        {'text': 'Full-experience', 'callback_data': 'start/full'}
-    )
+    return __cached_keyboard(('mode_selection',), lambda: generate_inline_markup(
+        {'text': 'Offline', 'callback_data': callbacks.START.encode('offline')},
+        {'text': 'Full-experience', 'callback_data': callbacks.START.encode('full')}
+    ))
 
 
 def generate_investigate_inline(text: str = 'Investigate!'):
-    return generate_inline_markup(
-        {'text': text, 'callback_data': f'my/{get_today()}'}
-    )
+    today = get_today()
+    return __cached_keyboard(('investigate', today, text), lambda: generate_inline_markup(
+        {'text': text, 'callback_data': callbacks.MY.encode(today)}
+    ))
 
 
 def generate_delete_inline(text: str = 'Got it!'):
-    return generate_inline_markup(
-        {'text': text, 'callback_data': 'del'}
-    )
+    return __cached_keyboard(('delete', text), lambda: generate_inline_markup(
+        {'text': text, 'callback_data': callbacks.DELETE.encode()}
+    ))
 
 
 def generate_confirmation_inline():
-    return generate_inline_markup(
-        {'text': 'Yes, I am sure', 'callback_data': 'conf/sure'},
-        {'text': 'No', 'callback_data': f'conf/no'},
-    )
+    return __cached_keyboard(('confirmation',), lambda: generate_inline_markup(
+        {'text': 'Yes, I am sure', 'callback_data': callbacks.CONFIRMATION.encode('sure')},
+        {'text': 'No', 'callback_data': callbacks.CONFIRMATION.encode('no')},
+    ))
 
 
 def generate_date_inline(date: str):
-    return generate_inline_markup(
-        {'text': 'My sports', 'callback_data': f'my/{date}'},
-        {'text': 'Checkin to sport', 'callback_data': f'ckin/{date}'},
-        {'text': 'Change day', 'callback_data': 'change'}
-    )
+    return __cached_keyboard(('date', date), lambda: generate_inline_markup(
+        {'text': 'My sports', 'callback_data': callbacks.MY.encode(date)},
+        {'text': 'Checkin to sport', 'callback_data': callbacks.CHECKIN_MENU.encode(date)},
+        {'text': 'Change day', 'callback_data': callbacks.CHANGE_DAY.encode()}
+    ))
 
 
 def generate_my_inline(date: str):
-    return generate_inline_markup(
-        {'text': 'Update info', 'callback_data': f'my/{date}'},
-        {'text': 'Set autocheckin', 'callback_data': f'auto/{date}'},
-        {'text': 'Fast uncheckin', 'callback_data': f'unckin/{date}'},
-        {'text': 'Logout', 'callback_data': f'logout/{date}'},
-        {'text': '« Back', 'callback_data': f'date/{date}'}
-    )
+    return __cached_keyboard(('my', date), lambda: generate_inline_markup(
+        {'text': 'Update info', 'callback_data': callbacks.MY.encode(date)},
+        {'text': 'Set autocheckin', 'callback_data': callbacks.AUTO_MENU.encode(date)},
+        {'text': 'Fast uncheckin', 'callback_data': callbacks.UNCHECKIN_MENU.encode(date)},
+        {'text': 'Logout', 'callback_data': callbacks.LOGOUT.encode(date)},
+        {'text': '« Back', 'callback_data': callbacks.DATE.encode(date)}
+    ))
 
 
 def generate_logout_inline(date: str):
-    return generate_inline_markup(
-        {'text': 'Yes, I want to logout', 'callback_data': 'logoutnow'},
-        {'text': '<< Back', 'callback_data': f'my/{date}'}
-    )
+    return __cached_keyboard(('logout', date), lambda: generate_inline_markup(
+        {'text': 'Yes, I want to logout', 'callback_data': callbacks.LOGOUT_NOW.encode()},
+        {'text': '<< Back', 'callback_data': callbacks.MY.encode(date)}
+    ))
 
 
 def generate_date_caption(date: str):
@@ -257,8 +363,8 @@ def generate_date_caption(date: str):
     return f'Sport schedule for *{calendar.day_name[now.weekday()]} ({date})*\n\nHere is the list of commands what this bot can do:'
 
 
-def generate_my_caption(session: Session):
-    user_statistics = api.get_user_statistics(session)
+def generate_my_caption(session: Session, user_id: int):
+    user_statistics = user_stats.get(session, user_id)
     return f'Your sport schedule for the upcoming week\n\n' \
            f'Your statistics:\n' \
            f'• Current sport hours: *{user_statistics["hours"]}*\n' \
@@ -266,68 +372,108 @@ def generate_my_caption(session: Session):
 
 
 def generate_date_courses_buttons(date: str, session: Session):
-    res = []
-    sports = api.get_full_day(session, date)
-    used = dict()
-    unique_sports = [(sport['title'], sport['extendedProps']['group_id']) for sport in sports]
-    for unique in unique_sports:
-        if used.get(unique[0]):
-            continue
-        res.append({
-            'text': unique[0],
-            'callback_data': f'gid/{date}/{unique[1]}'
-        })
-        used[unique[0]] = True
-    res = res[::-1]
-    res.append({'text': '« Back', 'callback_data': f'date/{date}'})
-    return generate_inline_markup(*res)
-
-
-def generate_date_group_time_buttons(date: str, group_id: int, session: Session, user_id: int, ignore_checked_in: bool = False):
-    res = []
-    sports = api.get_full_day(session, date)
+    sports = schedule.get_full_day(session, date)  # titles and groups are public
+
+    def build():
+        res = []
+        used = dict()
+        unique_sports = [(sport['title'], sport['extendedProps']['group_id']) for sport in sports]
+        for unique in unique_sports:
+            if used.get(unique[0]):
+                continue
+            res.append({
+                'text': unique[0],
+                'callback_data': callbacks.GROUP.encode(date, unique[1])
+            })
+            used[unique[0]] = True
+        res = res[::-1]
+        res.append({'text': '« Back', 'callback_data': callbacks.DATE.encode(date)})
+        return generate_inline_markup(*res)
+
+    return __cached_keyboard(('courses', date, None, 'public', schedule.version(date)), build)
+
+
+def __group_time_rows(date: str, group_id: int, session: Session) -> tuple:
+    """
+    Public part of the time buttons: trainings of the group sorted by start, with seats as the
+    schedule cache sees them, shared by all users until the data of the date changes.
+    Returns data version and the rows
+    """
+    sports = schedule.get_full_day(session, date)
     trainings = [sport for sport in sports if sport['extendedProps']['group_id'] == group_id]
-    for sport in trainings:
-        training_info = api.get_training_info(session, sport['extendedProps']['id'])
-        training_id = training_info['training']['id']
-        notified_users = database.get_notification_users(training_id)
-
-        capacity = training_info['training']['group']['capacity']
-        load = capacity - training_info['training']['load']
-
-        start_datetime = datetime.fromisoformat(sport['start'].split('+')[0])
+    for sport in trainings:  # refresh expired capacities before the version is taken
+        schedule.get_training_info(session, sport['extendedProps']['id'])
 
+    def build():
+        rows = []
+        for sport in trainings:
+            training_info = schedule.get_training_info(session, sport['extendedProps']['id'])
+            capacity = training_info['training']['group']['capacity']
+            rows.append({
+                'id': training_info['training']['id'],
+                'text': f"{sport['start'].split('T')[1].split('+')[0][:-3]}-{sport['end'].split('T')[1].split('+')[0][:-3]} ({capacity - training_info['training']['load']}/{capacity})",
+                'free': capacity - training_info['training']['load'],
+                'start': sport['start'],
+                'can_check_in': sport['extendedProps']['can_check_in'],
+            })
+        rows.sort(key=lambda row: datetime.fromisoformat(row['start']).timestamp())
+        return tuple(rows)
+
+    version = schedule.version(date)
+    return version, __cached_keyboard(('group_times', date, group_id, 'public', version), build)
+
+
+def generate_date_group_time_buttons(date: str, group_id: int, session: Session, user_id: int, ignore_checked_in: bool = False,
+                                     public_session: Session = None):
+    """
+    Time buttons of the group: public rows from the schedule cache (read with `public_session`,
+    `session` by default) with marks of the user on top. `session` is only asked for the user's
+    own check-ins, offline users get none
+    """
+    public_session = public_session or session
+    version, rows = __group_time_rows(date, group_id, public_session)
+    own = dict()
+    if not ignore_checked_in:
+        own = {sport['extendedProps']['id']: sport['extendedProps'] for sport in week_view.get_day(session, user_id, date)}
+    notified_trainings = database.get_user_notifications(user_id)
+
+    marks = []
+    for row in rows:
+        props = own.get(row['id'], {'checked_in': False, 'can_check_in': row['can_check_in']})
+        notified = row['id'] in notified_trainings
         l_symbol = r_symbol = ""
-        if sport['extendedProps']['checked_in'] and not ignore_checked_in:
+        if props['checked_in'] and not ignore_checked_in:
             r_symbol = "✅"
-        elif not sport['extendedProps']['can_check_in']:
+        elif not props['can_check_in']:
             r_symbol = "❌" if not ignore_checked_in else ""
-            if load == 0:
-                l_symbol = '🔔' if user_id in notified_users else '🔕'
-        if datetime.now() + timedelta(days=7) < start_datetime:
-            l_symbol = '🔔' if user_id in notified_users else '🔕'
-        res.append([
-            {
-                'text': f"{sport['start'].split('T')[1].split('+')[0][:-3]}-{sport['end'].split('T')[1].split('+')[0][:-3]} ({load}/{capacity}) {r_symbol}",
-                'callback_data': f'tid/{sport["extendedProps"]["id"]}',
-                'time': datetime.fromisoformat(sport['start']).timestamp()
-            }
-        ]
-        )
-        if l_symbol:
-            res[-1].append(
-                {
-                    'text': f"Notification {'on' if user_id in notified_users else 'off'} {l_symbol} ",
-                    'callback_data': f'ntid/{sport["extendedProps"]["id"]}',
-                    'time': datetime.now().timestamp()
-                }
-            )
-    res.sort(key=lambda a: a[0]['time'])
-    res.append([{'text': '« Back', 'callback_data': f'ckin/{date}'}])
-    return generate_inline_markup(*res)
+            if row['free'] == 0:
+                l_symbol = '🔔' if notified else '🔕'
+        if datetime.now() + timedelta(days=7) < datetime.fromisoformat(row['start'].split('+')[0]):
+            l_symbol = '🔔' if notified else '🔕'
+        marks.append((r_symbol, l_symbol, notified))
+
+    def build():
+        res = []
+        for row, (r_symbol, l_symbol, notified) in zip(rows, marks):
+            res.append([{'text': f"{row['text']} {r_symbol}", 'callback_data': callbacks.TRAINING.encode(row['id'])}])
+            if l_symbol:
+                res[-1].append({
+                    'text': f"Notification {'on' if notified else 'off'} {l_symbol} ",
+                    'callback_data': callbacks.NOTIFICATION.encode(row['id'])
+                })
+        res.append([{'text': '« Back', 'callback_data': callbacks.CHECKIN_MENU.encode(date)}])
+        return generate_inline_markup(*res)
+
+    identity = 'offline' if ignore_checked_in else 'full'
+    return __cached_keyboard(('group_times', date, group_id, identity, version, tuple(marks)), build)
 
 
 def generate_group_time_caption(group_id: int, session: Session):
+    teacher_markdown = reference.get(f'teachers/{group_id}', lambda s: __teacher_lines(s, group_id), reference.TEACHERS_TTL, session)
+    return f"Teachers emails:\n{teacher_markdown}\n\nSelect time when you want to checkin:\n\n"
+
+
+def __teacher_lines(session: Session, group_id: int) -> str:
     teachers = api.get_teachers(session, group_id)
     teacher_markdown = []
     for teacher in teachers:
@@ -336,8 +482,7 @@ def generate_group_time_caption(group_id: int, session: Session):
         teacher_markdown.append(
             f'{full_name} {teacher["trainer_email"]}'
         )
-    teacher_markdown = '\n'.join(teacher_markdown)
-    return f"Teachers emails:\n{teacher_markdown}\n\nSelect time when you want to checkin:\n\n"
+    return '\n'.join(teacher_markdown)
 
 
 def generate_auto_checkin_list_caption():
@@ -345,11 +490,8 @@ def generate_auto_checkin_list_caption():
 
 
 def generate_auto_checkin_list_markup(session: Session, date: str, user_id: int):
-    start_date = get_today()
-    end_date = get_shifted_day(8)
-
     sport_to_id = dict()
-    for sport in api.get_full_time_period(session, start_date, end_date):
+    for sport in week_view.get_week(session, user_id):
         if not sport['extendedProps']['checked_in']:
             continue
         group_id = sport['extendedProps']['group_id']
@@ -363,50 +505,60 @@ def generate_auto_checkin_list_markup(session: Session, date: str, user_id: int)
             sport_to_id[title] = []
         sport_to_id[title].append({'id': parsed_string, 'text': f'{calendar.day_name[weekday]} {start_time}-{end_time}'})
 
-    res = []
-    for sport_title in sport_to_id:
-        res.append([
-            {
-                'text': f'===== {sport_title} =====',
-                'callback_data': 'why'
-            }
-        ])
-        for training in sport_to_id[sport_title]:
-            auto_checked_in = database.check_auto_checkin(user_id, training['id'])
-            new_button = {
-                'text': f"{training['text']} " + ('🔁' if auto_checked_in else ''),
-                'callback_data': f'aid/{date}/{training["id"]}'
-            }
-            if new_button not in res:
-                res.append(new_button)
+    auto_checkins = database.get_user_auto_checkins(user_id) or dict()  # one read instead of one per button
+    marked = tuple(sorted(
+        training['id'] for trainings in sport_to_id.values() for training in trainings if training['id'] in auto_checkins
+    ))
+
+    def build():
+        res = []
+        for sport_title in sport_to_id:
+            res.append([
+                {
+                    'text': f'===== {sport_title} =====',
+                    'callback_data': callbacks.WHY.encode()
+                }
+            ])
+            for training in sport_to_id[sport_title]:
+                auto_checked_in = training['id'] in marked
+                new_button = {
+                    'text': f"{training['text']} " + ('🔁' if auto_checked_in else ''),
+                    'callback_data': callbacks.AUTO_CHECKIN.encode(date, training['id'])
+                }
+                if new_button not in res:
+                    res.append(new_button)
 
-    res.append([{'text': '« Back', 'callback_data': f'my/{date}'}])
+        res.append([{'text': '« Back', 'callback_data': callbacks.MY.encode(date)}])
+        return generate_inline_markup(*res)
 
-    return generate_inline_markup(*res)
+    # users with the same weekly trainings and auto-checkins get the same keyboard
+    trainings = json.dumps(sport_to_id)
+    return __cached_keyboard(('auto_checkin_list', date, None, 'full', trainings, marked), build)
 
 
 def generate_fast_un_checkin_caption():
     return f"Chose sport you want to unchekin:"
 
 
-def generate_fast_un_checkin_markup(session: Session, date: str = None, previous_markup: InlineKeyboardMarkup = None):
+def generate_fast_un_checkin_markup(session: Session, user_id: int, date: str = None, previous_markup: InlineKeyboardMarkup = None):
+    """
+    Checked in trainings of the week of the user. Trainings listed in `previous_markup` stay
+    in the list after cancel, so they can be checked in back
+    """
     if date is None:
         date = get_today()
 
-    prev_training_ids = set()
+    shown = set()
     if previous_markup:
         for button_line in previous_markup['inline_keyboard']:
             for button in button_line:
-                if button['callback_data'].startswith('fckin/') and button['text'][-1] == '✅':
-                    prev_training_ids.add(button['callback_data'])
-
-    start_date = get_today()
-    end_date = get_shifted_day(8)
+                if callbacks.get_prefix(button['callback_data']) == callbacks.FAST_CHECKIN.prefix:
+                    shown.add(button['callback_data'])
 
     trainings = dict()
-    new_training_ids = set()
-    for sport in api.get_full_time_period(session, start_date, end_date):
-        if not sport['extendedProps']['checked_in']:
+    for sport in week_view.get_week(session, user_id):
+        callback_data = callbacks.FAST_CHECKIN.encode(sport['extendedProps']['id'])
+        if not sport['extendedProps']['checked_in'] and callback_data not in shown:
             continue
 
         start_datetime = datetime.fromisoformat(sport['start'].split('+')[0])
@@ -417,40 +569,26 @@ def generate_fast_un_checkin_markup(session: Session, date: str = None, previous
         r_symbol = "✅" if sport['extendedProps']['checked_in'] else ''
         title = sport['title']
 
-        new_training_ids.add(f'fckin/{sport["extendedProps"]["id"]}')
-
         if trainings.get(title) is None:
             trainings[title] = []
         trainings[title].append({
             'text': f'{calendar.day_name[start_datetime.weekday()]} {start_datetime.strftime("%H:%M")}-{end_datetime.strftime("%H:%M")} ({start_datetime.strftime("%d.%m")}) {r_symbol}',
-            'callback_data': f'fckin/{sport["extendedProps"]["id"]}'
+            'callback_data': callback_data
         })
 
-    if previous_markup:
-        for training_id in prev_training_ids ^ new_training_ids:
-            for i_line, line in enumerate(previous_markup['inline_keyboard']):
-                for i, button in enumerate(line):
-                    if button['callback_data'] != training_id:
-                        continue
-                    if button['text'][-1] != "✅":
-                        previous_markup['inline_keyboard'][i_line][i]['text'] = button['text'] + ' ✅'
-                    else:
-                        previous_markup['inline_keyboard'][i_line][i]['text'] = button['text'][:-2]
-        return previous_markup
-
     res = []
 
     for sport_title in trainings:
         res.append([
             {
                 'text': f'===== {sport_title} =====',
-                'callback_data': 'why'
+                'callback_data': callbacks.WHY.encode()
             }
         ])
         for training_button in trainings[sport_title]:
             res.append(training_button)
 
-    res.append([{'text': '« Back', 'callback_data': f'my/{date}'}])
+    res.append([{'text': '« Back', 'callback_data': callbacks.MY.encode(date)}])
     return generate_inline_markup(*res)
 
 
@@ -489,21 +627,18 @@ def parse_and_save_whole_semester(session: Session):
             parsed_sports[parsed_string] = []  # Create new key
         parsed_sports[parsed_string].append(sport['extendedProps']['id'])  # Add training_id
 
-    with open('semester_trainings.json', 'w') as file:
-        file.write(json.dumps(parsed_sports, indent=4))
+    database.set_semester_trainings(parsed_sports)  # shared by all bot workers
 
 
 def get_training_ids_to_auto_checkin(session: Session, training_key: str) -> list:
-    with open('semester_trainings.json', 'r') as file:
-        trainings = json.load(file)
+    training_ids = database.get_semester_training_ids(training_key)
 
-    if trainings.get(training_key) is None:  # In case when semester changed, we want all file to reload and be up-to-date
+    if training_ids is None:  # In case when semester changed, we want all trainings to reload and be up-to-date
         parse_and_save_whole_semester(session)
-        with open('semester_trainings.json', 'r') as file:
-            trainings = json.load(file)
+        training_ids = database.get_semester_training_ids(training_key)
 
-    if trainings.get(training_key) is None:  # If nothing found (strangely and should not happen), no ids are found
+    if training_ids is None:  # If nothing found (strangely and should not happen), no ids are found
         logging.warning(f'generator.py -> get_training_ids_to_auto_checkin -> no trainings found for key "{training_key}"')
         return []
 
-    return trainings[training_key]
+    return training_ids
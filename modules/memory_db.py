@@ -0,0 +1,122 @@
+"""
+In-memory stand-in for firebase realtime database (`firebase_admin.db`) used by
+benchmarks and local runs (DATABASE_URL=memory://). Implements the part of
+`db.Reference` interface that modules/database.py and modules/cluster.py use
+"""
+from itertools import count
+import threading
+import copy
+import time
+
+_root = dict()
+_lock = threading.RLock()
+_push_ids = count()
+
+
+class TransactionAbortedError(Exception):
+    pass
+
+
+def _parts(path: str) -> list:
+    return [part for part in path.strip('/').split('/') if part]
+
+
+def _prune(node):
+    """
+    Firebase does not store empty objects, nulls and empty lists
+    """
+    if isinstance(node, dict):
+        for key in list(node):
+            node[key] = _prune(node[key])
+            if node[key] in (None, {}, []):
+                del node[key]
+    return node
+
+
+def _normalize(value):
+    value = copy.deepcopy(value)
+    if isinstance(value, dict):
+        value = {str(key): item for key, item in value.items()}
+    return _prune(value)
+
+
+def clear() -> None:
+    with _lock:
+        _root.clear()
+
+
+class Reference:
+    def __init__(self, path: str = '/'):
+        self.path = '/' + '/'.join(_parts(path))
+
+    @property
+    def key(self) -> str or None:
+        parts = _parts(self.path)
+        return parts[-1] if parts else None
+
+    def child(self, path: str) -> 'Reference':
+        return Reference(f'{self.path}/{path}')
+
+    def get(self, etag: bool = False, shallow: bool = False):
+        with _lock:
+            node = _root
+            for part in _parts(self.path):
+                if not isinstance(node, dict) or part not in node:
+                    node = None
+                    break
+                node = node[part]
+            if node == {}:
+                node = None
+            if shallow and isinstance(node, dict):
+                return {key: True for key in node}
+            return copy.deepcopy(node)
+
+    def set(self, value) -> None:
+        with _lock:
+            parts = _parts(self.path)
+            if not parts:
+                _root.clear()
+                _root.update(_normalize(value) or dict())
+                return
+            node = _root
+            ancestors = []  # (parent, key) of every node on the path
+            for part in parts[:-1]:
+                if not isinstance(node.get(part), dict):
+                    node[part] = dict()
+                ancestors.append((node, part))
+                node = node[part]
+            value = _normalize(value)
+            if value in (None, {}, []):
+                node.pop(parts[-1], None)
+            else:
+                node[parts[-1]] = value
+            for parent, part in reversed(ancestors):  # only nodes on the path may have become empty
+                if parent[part]:
+                    break
+                del parent[part]
+
+    def delete(self) -> None:
+        self.set(None)
+
+    def update(self, value: dict) -> None:
+        if not value or not isinstance(value, dict):
+            raise ValueError('Value argument must be a non-empty dictionary.')
+        with _lock:
+            for path, item in value.items():
+                self.child(str(path)).set(item)
+
+    def push(self, value=None) -> 'Reference':
+        ref = self.child(f'-{int(time.time() * 1000):013d}{next(_push_ids):06d}')
+        if value is not None:
+            ref.set(value)
+        return ref
+
+    def transaction(self, transaction_update):
+        with _lock:
+            value = transaction_update(self.get())
+            self.set(value)
+            return value
+
+
+def reference(path: str = '/') -> Reference:
+    return Reference(path)
@@ -0,0 +1,202 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from functools import wraps
+from types import ModuleType
+from typing import Callable
+from modules import tracing
+import threading
+import inspect
+import logging
+import bisect
+import time
+
+# Latency histogram bucket upper bounds in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PREFIX = 'sportbot'
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.count = 0
+        self.errors = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float, error: bool = False) -> None:
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if error:
+            self.errors += 1
+
+    def quantile(self, q: float) -> float:
+        """
+        Upper bound of the bucket that contains q-th quantile
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, amount in zip(self.buckets, self.counts):
+            seen += amount
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Registry:
+    """
+    Thread-safe storage of call counts, errors and latency histograms by (kind, name)
+    """
+    def __init__(self):
+        self._histograms = dict()
+        self._gauges = dict()  # (name, labels) -> value
+        self._lock = threading.Lock()
+
+    def observe(self, kind: str, name: str, seconds: float, error: bool = False) -> None:
+        with self._lock:
+            histogram = self._histograms.get((kind, name))
+            if histogram is None:
+                histogram = self._histograms[(kind, name)] = Histogram()
+            histogram.observe(seconds, error)
+
+    def set_gauge(self, name: str, labels: dict, value: float) -> None:
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def get(self, kind: str, name: str) -> Histogram or None:
+        return self._histograms.get((kind, name))
+
+    def items(self) -> list:
+        with self._lock:
+            return sorted(self._histograms.items())
+
+    def render(self) -> str:
+        """
+        Prometheus text exposition format
+        """
+        lines = [
+            f'# TYPE {PREFIX}_calls_total counter',
+            f'# TYPE {PREFIX}_errors_total counter',
+            f'# TYPE {PREFIX}_call_duration_seconds histogram',
+        ]
+        for (kind, name), histogram in self.items():
+            labels = f'kind="{kind}",name="{name}"'
+            lines.append(f'{PREFIX}_calls_total{{{labels}}} {histogram.count}')
+            lines.append(f'{PREFIX}_errors_total{{{labels}}} {histogram.errors}')
+            cumulative = 0
+            for bound, amount in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                cumulative += amount
+                lines.append(f'{PREFIX}_call_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{PREFIX}_call_duration_seconds_sum{{{labels}}} {histogram.sum:.6f}')
+            lines.append(f'{PREFIX}_call_duration_seconds_count{{{labels}}} {histogram.count}')
+        with self._lock:
+            gauges = sorted(self._gauges.items())
+        for (name, labels), value in gauges:
+            labels = ','.join(f'{key}="{label}"' for key, label in labels)
+            lines.append(f'{PREFIX}_{name}{{{labels}}} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, limit: int = 15) -> str:
+        """
+        Human-readable table of the calls with the biggest total time
+        """
+        rows = sorted(self.items(), key=lambda item: item[1].sum, reverse=True)[:limit]
+        lines = []
+        for (kind, name), histogram in rows:
+            average = histogram.sum / histogram.count if histogram.count else 0
+            error_rate = 100 * histogram.errors / histogram.count if histogram.count else 0
+            lines.append(
+                f'{kind}.{name}: {histogram.count} calls, {error_rate:.1f}% errors, '
+                f'avg {average * 1000:.0f}ms, p95 <= {histogram.quantile(0.95) * 1000:.0f}ms, '
+                f'total {histogram.sum:.1f}s'
+            )
+        return '\n'.join(lines) if lines else 'No calls recorded yet'
+
+
+REGISTRY = Registry()
+
+
+def timed(kind: str, name: str = None, registry: Registry = REGISTRY):
+    """
+    Record duration and errors of every call of decorated function (sync or async),
+    inside of a trace the call is also recorded as a span
+    """
+    def decorator(function: Callable):
+        label = name or function.__name__
+
+        if inspect.iscoroutinefunction(function):
+            @wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                error = False
+                try:
+                    with tracing.span(f'{kind}.{label}'):
+                        return await function(*args, **kwargs)
+                except BaseException:
+                    error = True
+                    raise
+                finally:
+                    registry.observe(kind, label, time.perf_counter() - start, error)
+            return async_wrapper
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            error = False
+            try:
+                with tracing.span(f'{kind}.{label}'):
+                    return function(*args, **kwargs)
+            except BaseException:
+                error = True
+                raise
+            finally:
+                registry.observe(kind, label, time.perf_counter() - start, error)
+        return wrapper
+    return decorator
+
+
+def instrument_module(module: ModuleType, kind: str, names: list = None) -> None:
+    """
+    Replace public functions defined in module (or only given names) with timed versions.
+    Callers use `module.function` so they pick wrapped versions up
+    """
+    if names is None:
+        names = [
+            name for name, value in vars(module).items()
+            if inspect.isfunction(value) and value.__module__ == module.__name__ and not name.startswith('_')
+        ]
+    for name in names:
+        function = getattr(module, name)
+        if not getattr(function, '__timed__', False):
+            wrapped = timed(kind, name)(function)
+            wrapped.__timed__ = True
+            setattr(module, name, wrapped)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host: str = '127.0.0.1', port: int = 9090) -> ThreadingHTTPServer:
+    """
+    Start /metrics endpoint for prometheus in a background thread
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logging.info(f'Metrics are available at http://{host}:{port}/metrics')
+    return server
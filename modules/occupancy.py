@@ -0,0 +1,160 @@
+"""
+Seat occupancy history: every observed load of a training is kept in compact per-training
+arrays (only changes are appended), samples older than DOWNSAMPLE_AGE are merged into one per
+DOWNSAMPLE_STEP and trainings are forgotten RETENTION seconds after their end. Released seats
+are also counted per group by lead time (hours before start) and hour of day, so the admin can
+see when seats free up and the notification watcher polls hot trainings on every pass and the
+rest once per COLD_INTERVAL
+"""
+from collections import Counter
+from datetime import datetime
+from array import array
+import threading
+import bisect
+import time
+
+DOWNSAMPLE_AGE = 6 * 3600  # seconds, older samples are downsampled
+DOWNSAMPLE_STEP = 900  # seconds, one sample (the last one) is kept per step
+RETENTION = 28 * 24 * 3600  # seconds after the end of a training
+COLD_INTERVAL = 120  # seconds between polls of trainings that are not hot, 0 polls everything every time
+CHURN_WINDOW = 3600  # seconds, trainings whose load changed that recently are hot
+HOT_SHARE = 0.5  # bucket is hot when it has at least that share of the average releases per bucket
+MIN_RELEASES = 5  # groups with fewer observed releases are treated as hot everywhere
+LEAD_BUCKETS = (1, 3, 12, 24, 72, 168)  # hours before start, upper bounds
+LEAD_NAMES = ('<1h', '1-3h', '3-12h', '12-24h', '1-3d', '3-7d', '>7d')
+
+
+class Series:
+    __slots__ = ('group_id', 'start', 'end', 'capacity', 'times', 'loads', 'last_seen')
+
+    def __init__(self, group_id: int, start: float, end: float, capacity: int):
+        self.group_id = group_id
+        self.start = start
+        self.end = end
+        self.capacity = capacity
+        self.times = array('I')  # unix seconds of load changes
+        self.loads = array('H')  # taken seats since that time
+        self.last_seen = 0.0
+
+
+_lock = threading.Lock()
+_series = dict()  # training_id -> Series
+_by_lead = Counter()  # (group_id, lead bucket) -> released seats
+_by_hour = Counter()  # (group_id, hour of day) -> released seats
+_releases = Counter()  # group_id -> released seats
+
+
+def _lead_bucket(start: float, at: float) -> int:
+    return bisect.bisect_right(LEAD_BUCKETS, (start - at) / 3600)
+
+
+def record(training_info: dict, at: float = None) -> None:
+    """
+    Remember load of the training from `api.get_training_info` response
+    """
+    training = training_info.get('training')
+    if training is None:
+        return
+    at = time.time() if at is None else at
+    load = training['load']
+    with _lock:
+        series = _series.get(training['id'])
+        if series is None:
+            series = _series[training['id']] = Series(
+                training['group']['id'],
+                datetime.fromisoformat(training['start']).timestamp(),
+                datetime.fromisoformat(training['end']).timestamp(),
+                training['group']['capacity']
+            )
+        series.last_seen = at
+        if series.loads and series.loads[-1] == load:
+            return
+        if series.loads and load < series.loads[-1]:
+            released = series.loads[-1] - load
+            _by_lead[(series.group_id, _lead_bucket(series.start, at))] += released
+            _by_hour[(series.group_id, datetime.fromtimestamp(at).hour)] += released
+            _releases[series.group_id] += released
+        series.times.append(int(at))
+        series.loads.append(load)
+
+
+def _hot(counter: Counter, group_id: int, key: int, buckets: int) -> bool:
+    total = _releases[group_id]
+    return total < MIN_RELEASES or counter[(group_id, key)] >= HOT_SHARE * total / buckets
+
+
+def should_poll(training_id: int, now: float = None) -> bool:
+    """
+    Whether the watcher should fetch the training now: unknown, finished, recently changed or
+    hot (seats of its group usually free up at its lead time or at this hour) trainings are
+    polled every time, others once per COLD_INTERVAL
+    """
+    now = time.time() if now is None else now
+    with _lock:
+        series = _series.get(training_id)
+        if series is None or not COLD_INTERVAL or now - series.last_seen >= COLD_INTERVAL or now >= series.end:
+            return True
+        if series.times and now - series.times[-1] < CHURN_WINDOW:
+            return True
+        return (
+            _hot(_by_lead, series.group_id, _lead_bucket(series.start, now), len(LEAD_NAMES))
+            or _hot(_by_hour, series.group_id, datetime.fromtimestamp(now).hour, 24)
+        )
+
+
+def compact(now: float = None) -> tuple:
+    """
+    Drop trainings past retention and downsample old samples. Returns amount of dropped trainings and samples
+    """
+    now = time.time() if now is None else now
+    dropped_trainings = dropped_samples = 0
+    with _lock:
+        for training_id in [training_id for training_id, series in _series.items() if now - series.end > RETENTION]:
+            dropped_samples += len(_series.pop(training_id).times)
+            dropped_trainings += 1
+        for series in _series.values():
+            old = bisect.bisect_left(series.times, int(now - DOWNSAMPLE_AGE))
+            if old < 2:
+                continue
+            times, loads = array('I'), array('H')
+            for i in range(old):
+                if i + 1 < old and series.times[i + 1] // DOWNSAMPLE_STEP == series.times[i] // DOWNSAMPLE_STEP:
+                    continue  # not the last sample of its step
+                times.append(series.times[i])
+                loads.append(series.loads[i])
+            dropped_samples += old - len(times)
+            series.times = times + series.times[old:]
+            series.loads = loads + series.loads[old:]
+    return dropped_trainings, dropped_samples
+
+
+def stats() -> dict:
+    with _lock:
+        return {
+            'trainings': len(_series),
+            'samples': sum(len(series.times) for series in _series.values()),
+            'releases': sum(_releases.values()),
+        }
+
+
+def describe(group_id: int) -> str:
+    """
+    When seats of the group free up, for the admin
+    """
+    with _lock:
+        total = _releases[group_id]
+        leads = [_by_lead[(group_id, bucket)] for bucket in range(len(LEAD_NAMES))]
+        hours = [_by_hour[(group_id, hour)] for hour in range(24)]
+        trainings = sum(1 for series in _series.values() if series.group_id == group_id)
+    if not total:
+        return f'No released seats observed for group {group_id} ({trainings} trainings watched)'
+    lines = [f'Group {group_id}: {total} released seats in {trainings} watched trainings', '', 'Before start:']
+    lines += [f'{name}: {amount} ({amount * 100 // total}%)' for name, amount in zip(LEAD_NAMES, leads) if amount]
+    lines += ['', 'Hour of day:']
+    lines += [f'{hour:02}:00 {amount} ({amount * 100 // total}%)' for hour, amount in enumerate(hours) if amount]
+    return '\n'.join(lines)
+
+
+def top_groups(limit: int = 10) -> list:
+    with _lock:
+        return _releases.most_common(limit)
@@ -0,0 +1,90 @@
+"""
+Remembers what the bot last showed in every (chat, message): fingerprints of the image,
+caption and reply markup. Edits that would change nothing are skipped and partial changes
+are sent with the cheapest Bot API method (markup only, caption only, full media last)
+"""
+from aiogram import Bot
+from aiogram.types import InlineKeyboardMarkup
+from aiogram.types.input_media import InputMediaPhoto
+from aiogram.utils.exceptions import MessageNotModified
+from modules import sessions
+import hashlib
+import json
+
+# Bot API methods that change or remove a message, any of them makes remembered output unknown
+EDIT_METHODS = {'editMessageText', 'editMessageCaption', 'editMessageMedia', 'editMessageReplyMarkup', 'deleteMessage'}
+
+# Output is remembered in process memory, so it is only reliable when one process edits all messages
+ENABLED = True
+
+_shown = sessions.LRUCache(max_size=10000, max_age=24 * 3600)  # (chat_id, message_id) -> (image, caption, markup)
+
+
+def fingerprint(value) -> str:
+    if isinstance(value, InlineKeyboardMarkup):
+        value = value.to_python()
+    return hashlib.sha1(json.dumps(value, sort_keys=True, ensure_ascii=False, default=str).encode()).hexdigest()
+
+
+def _key(chat_id: int or str, message_id: int or str) -> tuple:
+    return int(chat_id), int(message_id)
+
+
+def remember(chat_id: int, message_id: int, image_version: str, caption: str, reply_markup: InlineKeyboardMarkup = None, parse_mode: str = None) -> None:
+    """
+    Record output of a message the bot has just sent
+    """
+    if ENABLED:
+        _shown[_key(chat_id, message_id)] = (image_version, fingerprint([caption, parse_mode]), fingerprint(reply_markup))
+
+
+def forget(chat_id: int or str, message_id: int or str) -> None:
+    if chat_id is not None and message_id is not None:
+        _shown.pop(_key(chat_id, message_id))
+
+
+async def show(bot: Bot, chat_id: int, message_id: int, caption: str, reply_markup: InlineKeyboardMarkup = None,
+               image: str = None, image_version: str = None, parse_mode: str = None) -> str:
+    """
+    Make the message show given image (png path; None keeps current image), caption and markup.
+    `image_version` identifies the image content (e.g. render fingerprint), by default file content is hashed.
+    Returns what was sent: `nothing`, `markup`, `caption` or `media`
+    """
+    key = _key(chat_id, message_id)
+    previous = _shown.get(key) if ENABLED else None
+    if image is not None and image_version is None:
+        with open(image, 'rb') as file:
+            image_version = hashlib.sha1(file.read()).hexdigest()
+    if image is None:
+        image_version = previous[0] if previous is not None else None
+    current = (image_version, fingerprint([caption, parse_mode]), fingerprint(reply_markup))
+
+    if previous == current:
+        return 'nothing'
+    try:
+        if image is not None and (previous is None or previous[0] != image_version):
+            sent = 'media'
+            with open(image, 'rb') as file:
+                await bot.edit_message_media(
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    media=InputMediaPhoto(file, caption=caption, parse_mode=parse_mode),
+                    reply_markup=reply_markup
+                )
+        elif previous is None or previous[1] != current[1]:
+            sent = 'caption'
+            await bot.edit_message_caption(
+                chat_id=chat_id,
+                message_id=message_id,
+                caption=caption,
+                parse_mode=parse_mode,
+                reply_markup=reply_markup
+            )
+        else:
+            sent = 'markup'
+            await bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=reply_markup)
+    except MessageNotModified:
+        sent = 'nothing'
+    if ENABLED:
+        _shown[key] = current
+    return sent
@@ -0,0 +1,99 @@
+from collections import Counter
+import threading
+import cProfile
+import asyncio
+import pstats
+import time
+import sys
+import io
+import os
+
+
+class StackSampler:
+    """
+    Samples stacks of all threads every `interval` seconds and counts them in collapsed
+    format (`thread;module:function;... count`) used by flame graph tools
+    """
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def collapsed(self) -> str:
+        return '\n'.join(f'{stack} {count}' for stack, count in self.samples.most_common())
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.samples[';'.join(reversed(stack))] += 1
+
+
+class ProfileResult:
+    def __init__(self, seconds: float, stats: pstats.Stats, sampler: StackSampler):
+        self.seconds = seconds
+        self.stats = stats
+        self.sampler = sampler
+
+    def top(self, sort_key: str, limit: int = 15) -> str:
+        """
+        Top functions by pstats sort key (`cumulative` or `tottime`)
+        """
+        rows = []
+        for (filename, line, name), (_, calls, tottime, cumtime, _) in self.stats.stats.items():
+            rows.append((tottime if sort_key == 'tottime' else cumtime, calls, f'{os.path.basename(filename)}:{line}({name})'))
+        rows.sort(reverse=True)
+        return '\n'.join(f'{value:8.3f}s {calls:>7} {function}' for value, calls, function in rows[:limit])
+
+    def report(self, limit: int = 15) -> str:
+        return (
+            f'Profiled {self.seconds:.1f}s, {sum(self.sampler.samples.values())} stack samples\n\n'
+            f'Top by cumulative time:\n{self.top("cumulative", limit)}\n\n'
+            f'Top by self time:\n{self.top("tottime", limit)}'
+        )
+
+
+_lock = asyncio.Lock()
+
+
+def is_running() -> bool:
+    return _lock.locked()
+
+
+async def profile(seconds: float, sample_interval: float = 0.005) -> ProfileResult:
+    """
+    Profile running bot for `seconds`: cProfile on the event loop thread (where handlers run)
+    and stack sampling of every thread (including executor threads with blocking calls)
+    """
+    async with _lock:
+        profiler = cProfile.Profile()
+        sampler = StackSampler(sample_interval)
+        start = time.perf_counter()
+        sampler.start()
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+            sampler.stop()
+        return ProfileResult(time.perf_counter() - start, pstats.Stats(profiler, stream=io.StringIO()), sampler)
@@ -0,0 +1,124 @@
+"""
+Persistent cache of reference data that changes a few times per semester (trainers of groups,
+semester boundaries). Entries have their own TTL and live in memory, changes are written to a
+JSON file by `save()` (scheduler job) and the file is loaded on start, so a restarted bot needs
+no upstream requests for them. Expired entries are still served and refreshed in background by
+`refresh()` with a session from SESSION, callers' sessions are never kept
+"""
+from requests.sessions import Session
+from typing import Callable
+import threading
+import logging
+import json
+import time
+import os
+
+FILE = 'reference_cache.json'
+TEACHERS_TTL = 7 * 24 * 3600  # seconds
+MIN_TTL = 3600  # seconds, lower bound of TTLs computed from values
+SESSION = None  # function returning a session for background refresh (service pool)
+
+_lock = threading.Lock()
+_save_lock = threading.Lock()  # one writer of the file at a time, threads share the temporary file name
+_entries = dict()  # key -> {'value': ..., 'expires': unix time}
+_stale = dict()  # key -> (fetch, ttl) of expired entries waiting for refresh()
+_dirty = False  # entries changed since the last save
+
+
+def load(path: str = None) -> int:
+    """
+    Read entries saved by previous run, returns amount of loaded entries
+    """
+    global FILE
+    FILE = path or FILE
+    try:
+        with open(FILE, encoding='utf-8') as file:
+            entries = json.load(file)
+    except FileNotFoundError:
+        return 0
+    except (OSError, ValueError) as ex:
+        logging.warning(f'reference.py -> load -> {FILE} is ignored: {ex}')
+        return 0
+    with _lock:
+        _entries.update(entries)
+    return len(entries)
+
+
+def save() -> None:
+    """
+    Write entries to the file if they changed since the last save
+    """
+    global _dirty
+    with _save_lock:
+        with _lock:  # serialised under the save lock, so the last written file has the newest entries
+            if not _dirty:
+                return
+            data = json.dumps(_entries, ensure_ascii=False)
+            _dirty = False
+        temporary = f'{FILE}.{os.getpid()}.tmp'
+        try:
+            with open(temporary, 'w', encoding='utf-8') as file:
+                file.write(data)
+            os.replace(temporary, FILE)  # readers never see half written file
+        except OSError as ex:
+            with _lock:
+                _dirty = True  # next save tries again
+            logging.warning(f'reference.py -> save -> {ex}')
+
+
+def _store(key: str, value, ttl: float or Callable) -> None:
+    global _dirty
+    seconds = ttl(value) if callable(ttl) else ttl
+    with _lock:
+        _entries[key] = {'value': value, 'expires': time.time() + max(seconds, MIN_TTL if callable(ttl) else 0)}
+        _stale.pop(key, None)
+        _dirty = True
+
+
+def get(key: str, fetch: Callable[[Session], object], ttl: float or Callable, session: Session):
+    """
+    Cached value of the key. Missing value is fetched right away with the given session, expired
+    one is returned as is and fetched again by the next `refresh()`. `fetch` takes a session,
+    `ttl` is seconds or function of the value (e.g. time left till the end of the semester).
+    Value must be JSON serializable
+    """
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None and entry['expires'] <= time.time():
+            _stale[key] = (fetch, ttl)
+    if entry is not None:
+        return entry['value']
+    value = fetch(session)
+    _store(key, value, ttl)
+    return value
+
+
+def refresh() -> int:
+    """
+    Fetch again expired entries that were requested, returns amount of refreshed entries
+    """
+    with _lock:
+        stale = list(_stale.items())
+    if stale and SESSION is None:
+        logging.warning('reference.py -> refresh -> no SESSION to refresh with')
+        return 0
+    refreshed = 0
+    for key, (fetch, ttl) in stale:
+        try:
+            _store(key, fetch(SESSION()), ttl)
+            refreshed += 1
+        except Exception as ex:  # keep serving the old value, next refresh tries again
+            logging.warning(f'reference.py -> refresh -> {key}: {ex}')
+    return refreshed
+
+
+def invalidate(prefix: str = '') -> None:
+    """
+    Forget entries with keys starting with prefix, they are fetched again on next use
+    """
+    global _dirty
+    with _lock:
+        for key in [key for key in _entries if key.startswith(prefix)]:
+            _entries.pop(key)
+            _stale.pop(key, None)
+            _dirty = True
@@ -0,0 +1,94 @@
+"""
+Cache of the public schedule: day calendars and training capacities as a service session
+sees them. Nothing user specific is stored here: offline (`ignore_checked_in`) views use it
+as is, and the group time buttons of full users are built from it with their own check-ins
+marked on top. Every date has a version that changes together with its data, so renders
+derived from it are rebuilt only when something really changed
+"""
+from requests.sessions import Session
+from modules import api, occupancy, sessions
+import threading
+import hashlib
+import json
+import time
+
+DAY_TTL = 300  # seconds, calendar of a day rarely changes
+CAPACITY_TTL = 60  # seconds, seats are taken and freed all the time
+
+_lock = threading.Lock()  # warm-up job refreshes the cache from a worker thread
+_days = sessions.LRUCache(max_size=32)  # date -> (sports, fetch timestamp)
+_trainings = sessions.LRUCache(max_size=4096)  # training_id -> (training info, fetch timestamp)
+
+
+def _cached(cache: sessions.LRUCache, key, max_age: float):
+    with _lock:
+        entry = cache.get(key)
+    if entry is not None and time.monotonic() - entry[1] <= max_age:
+        return entry[0]
+    return None
+
+
+def _store(cache: sessions.LRUCache, key, value) -> None:
+    with _lock:
+        cache[key] = (value, time.monotonic())
+
+
+def get_full_day(session: Session, date: str, max_age: float = None) -> list:
+    sports = _cached(_days, date, DAY_TTL if max_age is None else max_age)
+    if sports is None:
+        sports = api.get_full_day(session, date)
+        _store(_days, date, sports)
+    return sports
+
+
+def get_training_info(session: Session, training_id: int, max_age: float = None) -> dict:
+    training_info = _cached(_trainings, training_id, CAPACITY_TTL if max_age is None else max_age)
+    if training_info is None:
+        training_info = api.get_training_info(session, training_id)
+        occupancy.record(training_info)
+        _store(_trainings, training_id, training_info)
+    return training_info
+
+
+def refresh_day(session: Session, date: str) -> None:
+    """
+    Fetch calendar of the date and capacities of all its trainings, ignoring cached values
+    """
+    for sport in get_full_day(session, date, max_age=0):
+        get_training_info(session, sport['extendedProps']['id'], max_age=0)
+
+
+def version(date: str) -> str or None:
+    """
+    Fingerprint of the cached calendar of the date and loads of its cached trainings
+    """
+    with _lock:
+        entry = _days.get(date)
+        if entry is None:
+            return None
+        loads = []
+        for sport in entry[0]:
+            training = _trainings.get(sport['extendedProps']['id'])
+            loads.append(training[0]['training']['load'] if training is not None and 'training' in training[0] else None)
+    data = json.dumps([entry[0], loads], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+def forget_training(training_id: int) -> None:
+    """
+    Forget cached capacity of the training, e.g. after the bot checked somebody in or out of it
+    """
+    with _lock:
+        _trainings.pop(training_id)
+
+
+def invalidate(date: str = None) -> None:
+    """
+    Forget cached calendar of the date (or everything)
+    """
+    with _lock:
+        if date is None:
+            _days.clear()
+            _trainings.clear()
+        else:
+            _days.pop(date)
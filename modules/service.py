@@ -0,0 +1,186 @@
+"""
+Pool of service accounts for requests that are not made on behalf of a logged in user (offline
+users, notification polls, schedule snapshots, warm-ups). Each request picks the healthy account
+with the fewest requests in flight (round-robin between equal ones), responses mark accounts
+healthy or not, and `maintain()` logs accounts in again before their sessions expire or after
+they failed, so no pass of a job waits for a login and one dead account does not stop the rest
+"""
+from requests.exceptions import RequestException
+from requests.sessions import Session
+from modules import api, upstream
+import threading
+import logging
+import time
+
+MAX_AGE = 12 * 3600  # seconds a session is used before it is logged in again
+RELOGIN_AHEAD = 1800  # seconds, sessions whose cookie expires sooner are logged in again
+MAX_FAILURES = 3  # consecutive failed requests after which an account is not used
+DEAD_STATUSES = (401, 403)  # session is not valid anymore
+
+
+class Unavailable(Exception):
+    """
+    No service account has a session yet (first login of `maintain()` did not finish or failed)
+    """
+
+
+class Account:
+    __slots__ = ('email', 'password', 'session', 'expires', 'in_flight', 'served', 'failures', 'healthy', 'last_error')
+
+    def __init__(self, email: str, password: str):
+        self.email = email
+        self.password = password
+        self.session = None
+        self.expires = 0.0  # unix time after which the session is logged in again
+        self.in_flight = 0
+        self.served = 0
+        self.failures = 0
+        self.healthy = False
+        self.last_error = None
+
+
+class PooledAdapter(upstream.ScheduledAdapter):
+    """
+    Scheduled adapter that counts requests of its account and tracks its health
+    """
+    def __init__(self, pool, account: Account):
+        super().__init__()
+        self.pool = pool
+        self.account = account
+
+    def send(self, request, *args, **kwargs):
+        self.pool._started(self.account)
+        response = None
+        try:
+            response = super().send(request, *args, **kwargs)
+            return response
+        finally:
+            self.pool._finished(self.account, None if response is None else response.status_code)
+
+
+def _expiry(session: Session, now: float) -> float:
+    cookies = [cookie.expires for cookie in session.cookies if cookie.name == 'sessionid' and cookie.expires]
+    return min([now + MAX_AGE] + [expires - RELOGIN_AHEAD for expires in cookies])
+
+
+class Pool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._accounts = []
+        self._next = 0  # round-robin position
+        self._login_lock = threading.Lock()
+
+    def add(self, email: str, password: str, session: Session = None) -> None:
+        """
+        Add an account, optionally with a session restored from the database
+        """
+        account = Account(email, password)
+        if session is not None:
+            self._use(account, session)
+        with self._lock:
+            self._accounts.append(account)
+
+    def __len__(self) -> int:
+        return len(self._accounts)
+
+    def _use(self, account: Account, session: Session) -> None:
+        adapter = PooledAdapter(self, account)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        with self._lock:
+            account.session = session
+            account.expires = _expiry(session, time.time())
+            account.failures = 0
+            account.healthy = True
+
+    def _started(self, account: Account) -> None:
+        with self._lock:
+            account.in_flight += 1
+
+    def _finished(self, account: Account, status: int or None) -> None:
+        with self._lock:
+            account.in_flight -= 1
+            account.served += 1
+            if status is not None and status not in DEAD_STATUSES and status < 500:
+                account.failures = 0
+                return
+            account.failures = MAX_FAILURES if status in DEAD_STATUSES else account.failures + 1
+            account.last_error = f'HTTP {status}' if status is not None else 'no response'
+            if account.failures >= MAX_FAILURES and account.healthy:
+                account.healthy = False
+                logging.warning(f'service.py -> {account.email} is unhealthy: {account.last_error}')
+
+    def session(self) -> Session:
+        """
+        Session of the least loaded healthy account. When no account is healthy, the least failed
+        one with a session is used. Callers never wait for a login: without any session
+        `Unavailable` is raised and `maintain()` logs accounts in
+        """
+        with self._lock:
+            count = len(self._accounts)
+            candidates = [self._accounts[(self._next + i) % count] for i in range(count)]
+            self._next = (self._next + 1) % max(1, count)
+            healthy = [account for account in candidates if account.healthy]
+            if healthy:
+                return min(healthy, key=lambda account: account.in_flight).session
+            with_session = [account for account in candidates if account.session is not None]
+            if with_session:
+                return min(with_session, key=lambda account: account.failures).session
+        raise Unavailable('No service account is logged in' if candidates else 'No service accounts configured')
+
+    def _login(self, account: Account) -> bool:
+        with self._login_lock:  # one login at a time, a concurrent maintain() reuses its result
+            with self._lock:
+                if account.healthy and account.expires > time.time():
+                    return True
+            try:
+                with upstream.priority(upstream.BACKGROUND):
+                    session = api.login_user(account.email, account.password)
+            except (RequestException, AttributeError) as ex:  # AttributeError when login page has no form
+                with self._lock:  # healthy account keeps using its session until the next try
+                    account.last_error = f'login: {ex!r}'
+                logging.warning(f'service.py -> login -> {account.email}: {ex!r}')
+                return False
+            self._use(account, session)
+            logging.info(f'service.py -> login -> {account.email} logged in')
+            return True
+
+    def maintain(self) -> int:
+        """
+        Log in accounts that have no session, failed or expire soon. Returns amount of healthy accounts
+        """
+        now = time.time()
+        with self._lock:
+            due = [account for account in self._accounts if not account.healthy or account.expires <= now]
+        for account in due:
+            self._login(account)
+        with self._lock:
+            return sum(account.healthy for account in self._accounts)
+
+    def stats(self) -> list:
+        now = time.time()
+        with self._lock:
+            return [
+                {
+                    'email': account.email,
+                    'healthy': account.healthy,
+                    'in flight': account.in_flight,
+                    'served': account.served,
+                    'failures': account.failures,
+                    'relogin in': round(account.expires - now) if account.session is not None else None,
+                    'last error': account.last_error,
+                }
+                for account in self._accounts
+            ]
+
+
+def parse_accounts(value: str) -> list:
+    """
+    `email:password` pairs separated by commas (passwords may contain colons, not commas)
+    """
+    accounts = []
+    for pair in filter(None, (pair.strip() for pair in (value or '').split(','))):
+        email, _, password = pair.partition(':')
+        if email:
+            accounts.append((email, password))
+    return accounts
@@ -0,0 +1,280 @@
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.types import Message, CallbackQuery
+from requests.sessions import Session
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import Callable
+from modules import database, tracing
+import resource
+import time
+
+
+class LRUCache:
+    """
+    Dict-like storage bounded by amount of entries (least recently used are evicted first)
+    and by idle age in seconds (max_age=None disables age bound)
+    """
+    def __init__(self, max_size: int = 1000, max_age: float = None, pinned: set = None):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.pinned = pinned if pinned is not None else set()
+        self.evictions = 0
+        self._data = OrderedDict()  # key -> (value, last access timestamp)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value) -> None:
+        if key in self._data:
+            self._discard(key, self._data.pop(key)[0], value)
+        self._data[key] = (value, time.monotonic())
+        self._shrink()
+
+    def get(self, key, default=None):
+        if key not in self._data:
+            return default
+        value, last_access = self._data[key]
+        if self._expired(key, last_access):
+            self._evict(key)
+            return default
+        self._data[key] = (value, time.monotonic())
+        self._data.move_to_end(key)
+        return value
+
+    def pop(self, key, default=None):
+        if key not in self._data:
+            return default
+        value = self._data.pop(key)[0]
+        self._discard(key, value)
+        return value
+
+    def clear(self) -> None:
+        for key in list(self._data):
+            self.pop(key)
+
+    def items(self) -> list:
+        """
+        Snapshot of (key, value) pairs, access order is not changed
+        """
+        return [(key, value) for key, (value, _) in self._data.items()]
+
+    def prune(self) -> int:
+        """
+        Drop all entries that are idle for longer than max_age, returns amount of dropped entries
+        """
+        expired = [key for key, (_, last_access) in self._data.items() if self._expired(key, last_access)]
+        for key in expired:
+            self._evict(key)
+        return len(expired)
+
+    def _expired(self, key, last_access: float) -> bool:
+        return self.max_age is not None and key not in self.pinned and time.monotonic() - last_access > self.max_age
+
+    def _shrink(self) -> None:
+        for key in list(self._data):
+            if len(self._data) <= self.max_size:
+                return
+            if key not in self.pinned:
+                self._evict(key)
+
+    def _evict(self, key) -> None:
+        self.evictions += 1
+        self._discard(key, self._data.pop(key)[0])
+
+    def _discard(self, key, value, replacement=None) -> None:
+        """
+        Called when value leaves the cache (evicted, popped or replaced)
+        """
+        pass
+
+
+def _matches(session: Session, data: dict or None) -> bool:
+    """
+    Whether cached session is the one stored in the database entry of its user
+    """
+    return bool(data) and session.cookies.get('sessionid') == data.get('session_id') \
+        and str(session.cookies.get('student_id')) == str(data.get('student_id'))
+
+
+class SessionStore(LRUCache):
+    """
+    Bounded user_id -> requests.Session storage. Evicted sessions are closed (to free their
+    connection pools) and transparently rebuilt from the database on next load(). The database
+    entry is checked on every load(), so a logout or re-login handled by another worker drops or
+    replaces the cached session here too
+    """
+    def __init__(self, max_size: int = 1000, max_age: float = 3600, pinned: set = None):
+        super().__init__(max_size=max_size, max_age=max_age, pinned=pinned)
+        self.rehydrations = 0
+        self.invalidations = 0
+
+    def load(self, user_id: int) -> Session or None:
+        session = self.get(user_id)
+        data = database.get_user(user_id)
+        if session is not None and not _matches(session, data):
+            self.invalidations += 1
+            self.pop(user_id)
+            session = None
+        if session is None and data:
+            session = database.create_session(user_id, data)
+            self.rehydrations += 1
+            self[user_id] = session
+        return session
+
+    def _discard(self, key, value, replacement=None) -> None:
+        if value is not None and value is not replacement:
+            value.close()
+
+    def stats(self) -> dict:
+        return {
+            'sessions': len(self),
+            'max_sessions': self.max_size,
+            'evictions': self.evictions,
+            'rehydrations': self.rehydrations,
+            'invalidations': self.invalidations,
+            'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        }
+
+
+class BoundedMemoryStorage(MemoryStorage):
+    """
+    aiogram MemoryStorage that keeps at most max_size (chat, user) records. Records without
+    state are dropped first, then least recently used ones
+    """
+    def __init__(self, max_size: int = 1000, max_age: float = 24 * 3600):
+        super().__init__()
+        self.max_size = max_size
+        self.max_age = max_age
+        self._access = OrderedDict()  # (chat, user) -> last access timestamp
+
+    def resolve_address(self, chat, user):
+        chat_id, user_id = super().resolve_address(chat, user)
+        self._access[(chat_id, user_id)] = time.monotonic()
+        self._access.move_to_end((chat_id, user_id))
+        if len(self._access) > self.max_size:
+            self.prune(keep=(chat_id, user_id))
+        return chat_id, user_id
+
+    def prune(self, keep: tuple = None) -> int:
+        now = time.monotonic()
+        dropped = 0
+        for address, last_access in list(self._access.items()):
+            record = self.data.get(address[0], {}).get(address[1])
+            idle = record is None or (record['state'] is None and not record['data'] and not record['bucket'])
+            if address != keep and (idle or now - last_access > self.max_age):
+                self._drop(address)
+                dropped += 1
+        for address in list(self._access):  # still too big, drop least recently used with state
+            if len(self._access) <= self.max_size:
+                break
+            if address != keep:
+                self._drop(address)
+                dropped += 1
+        return dropped
+
+    def _drop(self, address: tuple) -> None:
+        chat_id, user_id = address
+        self._access.pop(address, None)
+        self.data.get(chat_id, {}).pop(user_id, None)
+        if not self.data.get(chat_id, True):
+            self.data.pop(chat_id)
+
+    def __len__(self) -> int:
+        return len(self._access)
+
+
+class UpdateContext:
+    """
+    Session state of the user who sent current Telegram update. Every value is resolved
+    at most once, so filters and handlers can ask for it as many times as they want
+    """
+    def __init__(self, user_id: int, store: SessionStore, validator: Callable[[Session], bool]):
+        self.user_id = user_id
+        self._store = store
+        self._validator = validator
+        self._valid = None
+
+    @property
+    def session(self) -> Session or None:
+        return self._store.get(self.user_id)
+
+    @property
+    def valid(self) -> bool:
+        if self._valid is None:
+            with tracing.span('session.resolve', user_id=self.user_id):
+                session = self._store.load(self.user_id)
+                if session is None:
+                    self._valid = False
+                elif session.cookies.get('sessionid') is None:  # offline users are valid users with valid session
+                    self._valid = True
+                else:
+                    self._valid = self._validator(session)
+        return self._valid
+
+    @property
+    def offline(self) -> bool:
+        self.valid  # make sure session is loaded
+        session = self.session
+        return session is not None and session.cookies.get('sessionid') is None
+
+    def reset(self) -> None:
+        """
+        Forget resolved values (session was created or removed during the update)
+        """
+        self._valid = None
+
+
+_update_context: ContextVar[UpdateContext or None] = ContextVar('update_context', default=None)
+
+
+def current_context(user_id: int) -> UpdateContext or None:
+    context = _update_context.get()
+    return context if context is not None and context.user_id == user_id else None
+
+
+def reset_context(user_id: int) -> None:
+    context = current_context(user_id)
+    if context is not None:
+        context.reset()
+
+
+class SessionContextMiddleware(BaseMiddleware):
+    """
+    Create UpdateContext for every message and callback query before filters are checked
+    """
+    def __init__(self, store: SessionStore, validator: Callable[[Session], bool]):
+        super().__init__()
+        self.store = store
+        self.validator = validator
+
+    def _enter(self, user_id: int, data: dict) -> None:
+        context = UpdateContext(user_id, self.store, self.validator)
+        data['_context_token'] = _update_context.set(context)
+
+    @staticmethod
+    def _exit(data: dict) -> None:
+        token = data.pop('_context_token', None)
+        if token is not None:
+            _update_context.reset(token)
+
+    async def on_pre_process_message(self, message: Message, data: dict):
+        self._enter(message.from_user.id, data)
+
+    async def on_post_process_message(self, message: Message, results: list, data: dict):
+        self._exit(data)
+
+    async def on_pre_process_callback_query(self, callback_query: CallbackQuery, data: dict):
+        self._enter(callback_query.from_user.id, data)
+
+    async def on_post_process_callback_query(self, callback_query: CallbackQuery, results: list, data: dict):
+        self._exit(data)
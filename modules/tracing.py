@@ -0,0 +1,131 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from functools import wraps
+from typing import Callable, Awaitable
+import threading
+import logging
+import json
+import time
+import uuid
+
+# Traces that took longer than threshold (seconds) are appended to file as json lines
+THRESHOLD = 2.0
+OUTPUT_FILE = 'traces.jsonl'
+
+
+class Span:
+    def __init__(self, name: str, trace_id: str, attributes: dict = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.attributes = attributes or dict()
+        self.children = []
+        self.error = None
+        self.start = time.perf_counter()
+        self.end = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def to_dict(self, origin: float) -> dict:
+        res = {
+            'name': self.name,
+            'offset_ms': round((self.start - origin) * 1000, 2),
+            'duration_ms': round(self.duration * 1000, 2),
+        }
+        if self.attributes:
+            res['attributes'] = self.attributes
+        if self.error:
+            res['error'] = self.error
+        if self.children:
+            res['children'] = [child.to_dict(origin) for child in list(self.children)]
+        return res
+
+
+_current_span: ContextVar[Span or None] = ContextVar('current_span', default=None)
+_write_lock = threading.Lock()
+
+
+def current_trace_id() -> str or None:
+    span = _current_span.get()
+    return span.trace_id if span is not None else None
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Nested span of the current trace, does nothing outside of a trace
+    """
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, parent.trace_id, attributes)
+    parent.children.append(child)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as ex:
+        child.error = repr(ex)
+        raise
+    finally:
+        child.end = time.perf_counter()
+        _current_span.reset(token)
+
+
+def start_trace(name: str, **attributes) -> tuple:
+    """
+    Start root span, returns (span, token) that have to be passed to finish_trace
+    """
+    root = Span(name, uuid.uuid4().hex[:16], attributes)
+    root.wall_start = datetime.now().isoformat(timespec='milliseconds')
+    return root, _current_span.set(root)
+
+
+def finish_trace(root: Span, token, error: BaseException = None) -> None:
+    root.end = time.perf_counter()
+    if error is not None:
+        root.error = repr(error)
+    _current_span.reset(token)
+    if root.duration >= THRESHOLD:
+        _write(root)
+
+
+@contextmanager
+def trace(name: str, **attributes):
+    root, token = start_trace(name, **attributes)
+    error = None
+    try:
+        yield root
+    except BaseException as ex:
+        error = ex
+        raise
+    finally:
+        finish_trace(root, token, error)
+
+
+def traced(name: str = None):
+    """
+    Run every call of decorated coroutine function (e.g. scheduler job) in its own trace
+    """
+    def decorator(function: Callable[..., Awaitable]):
+        @wraps(function)
+        async def wrapper(*args, **kwargs):
+            with trace(name or function.__name__):
+                return await function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _write(root: Span) -> None:
+    record = {
+        'trace_id': root.trace_id,
+        'start': root.wall_start,
+        **root.to_dict(root.start)
+    }
+    try:
+        with _write_lock, open(OUTPUT_FILE, 'a') as file:
+            file.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+    except OSError as ex:
+        logging.warning(f'tracing.py -> _write -> cannot write trace {root.trace_id}: {ex}')
@@ -0,0 +1,158 @@
+"""
+Scheduler of requests to upstream hosts (sport site and its login server). Every request waits
+for a slot of a global concurrency cap and for its turn in a per-host rate limit, waiting
+requests are served by priority class: check-in first, then interactive taps, then background
+polling. Background requests may only take part of the slots, so taps never queue behind a
+big scheduler pass. Priority is taken from a context variable that jobs set for their work
+(`asyncio.to_thread` copies it into the worker thread). Requests sent from the event loop thread
+never wait, waiting there would freeze every update: they take their slots right away and only
+push other requests back
+"""
+from requests.adapters import HTTPAdapter
+from requests.sessions import Session
+from contextlib import contextmanager
+from contextvars import ContextVar
+from urllib.parse import urlsplit
+from modules import tracing
+import threading
+import asyncio
+import heapq
+import time
+
+CHECK_IN, INTERACTIVE, BACKGROUND = 0, 1, 2
+NAMES = ('check-in', 'interactive', 'background')
+
+MAX_CONCURRENCY = 8  # requests in flight to all hosts, 0 disables the scheduler
+RESERVED = 2  # slots background requests can not take
+RATE = 20.0  # requests per second to one host, 0 disables rate limit
+
+_priority = ContextVar('upstream_priority', default=INTERACTIVE)
+
+
+@contextmanager
+def priority(value: int):
+    """
+    Requests made inside (in this context) have given priority class
+    """
+    token = _priority.set(value)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def set_priority(value: int) -> None:
+    """
+    Priority class of the rest of current context (e.g. a scheduler job)
+    """
+    _priority.set(value)
+
+
+class Gate:
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._waiting = []  # heap of (priority, sequence number)
+        self._sequence = 0
+        self._active = 0
+        self._next_slot = dict()  # host -> monotonic time of the next free rate limit slot
+        self.waited = [0.0] * len(NAMES)  # seconds spent waiting by priority class
+        self.served = [0] * len(NAMES)
+        self.unscheduled = 0  # requests sent from the event loop thread without waiting
+
+    def _limit(self, value: int) -> int:
+        return MAX_CONCURRENCY - RESERVED if value == BACKGROUND else MAX_CONCURRENCY
+
+    def acquire(self, host: str, value: int) -> None:
+        start = time.monotonic()
+        with self._condition:
+            self._sequence += 1
+            ticket = (value, self._sequence)
+            heapq.heappush(self._waiting, ticket)
+            while True:
+                if self._waiting[0] == ticket and self._active < max(1, self._limit(value)):
+                    # background takes only a rate limit slot that is free now, so it never
+                    # holds future slots that taps would have to wait for
+                    backlog = self._next_slot.get(host, 0) - time.monotonic() if RATE and value == BACKGROUND else 0
+                    if backlog <= 0:
+                        break
+                    self._condition.wait(backlog)
+                else:
+                    self._condition.wait()
+            heapq.heappop(self._waiting)
+            self._active += 1
+            delay = 0.0
+            if RATE:  # slot is reserved in priority order, waiting for it happens outside of the lock
+                now = time.monotonic()
+                slot = max(now, self._next_slot.get(host, now))
+                self._next_slot[host] = slot + 1 / RATE
+                delay = slot - now
+            self._condition.notify_all()  # next in the queue may fit under its limit
+        if delay > 0:
+            time.sleep(delay)
+        waited = time.monotonic() - start
+        with self._condition:
+            self.waited[value] += waited
+            self.served[value] += 1
+
+    def enter(self, host: str) -> None:
+        """
+        Take a slot and a rate limit slot without waiting (event loop thread)
+        """
+        with self._condition:
+            self._active += 1
+            if RATE:
+                now = time.monotonic()
+                self._next_slot[host] = max(now, self._next_slot.get(host, now)) + 1 / RATE
+            self.unscheduled += 1
+
+    def release(self) -> None:
+        with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                'active': self._active,
+                'waiting': len(self._waiting),
+                'unscheduled': self.unscheduled,
+                **{f'{name} served': self.served[i] for i, name in enumerate(NAMES)},
+                **{f'{name} waited': round(self.waited[i], 3) for i, name in enumerate(NAMES)},
+            }
+
+
+GATE = Gate()
+
+
+def _on_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+class ScheduledAdapter(HTTPAdapter):
+    """
+    Transport adapter that sends every request through the gate
+    """
+    def send(self, request, *args, **kwargs):
+        if not MAX_CONCURRENCY:
+            return super().send(request, *args, **kwargs)
+        value = _priority.get()
+        if _on_event_loop():
+            GATE.enter(urlsplit(request.url).netloc)
+        else:
+            with tracing.span('upstream.wait', priority=NAMES[value]):
+                GATE.acquire(urlsplit(request.url).netloc, value)
+        try:
+            return super().send(request, *args, **kwargs)
+        finally:
+            GATE.release()
+
+
+def mount(session: Session) -> Session:
+    adapter = ScheduledAdapter()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
@@ -0,0 +1,102 @@
+"""
+Statistics of students for the "My sports" caption: sport hours and the better-than percentile
+are fetched concurrently and cached per user, the percentile longer since it moves slowly.
+Check-ins made by the bot forget the cached values, and values of users who looked at them
+recently are refreshed in background before they expire, so taps are served from memory
+"""
+from concurrent.futures import ThreadPoolExecutor
+from requests.sessions import Session
+from modules import api, sessions
+import contextvars
+import threading
+import time
+
+HOURS_TTL = 300  # seconds
+BETTER_THAN_TTL = 6 * 3600  # seconds
+ACTIVE_WINDOW = 3600  # seconds, users who looked at their statistics that recently are refreshed in background
+REFRESH_AHEAD = 0.8  # share of TTL after which background refresh fetches a value again
+
+# looked up on every call, so functions wrapped by metrics.instrument_module after import are used
+FETCHERS = {'hours': lambda session: api.get_negative_hours(session), 'better_than': lambda session: api.get_better_than(session)}
+TTLS = {'hours': lambda: HOURS_TTL, 'better_than': lambda: BETTER_THAN_TTL}
+
+_lock = threading.Lock()
+_stats = sessions.LRUCache(max_size=4096)  # user_id -> {name: (value, fetch timestamp)}
+_active = sessions.LRUCache(max_size=4096)  # user_id -> timestamp of the last look
+_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='user_stats')
+
+
+def _fetch(session: Session, names: list) -> dict:
+    """
+    Fetch values concurrently in the pool
+    """
+    futures = {
+        name: _pool.submit(contextvars.copy_context().run, FETCHERS[name], session)  # keeps upstream priority and trace
+        for name in names
+    }
+    return {name: future.result() for name, future in futures.items()}
+
+
+def _missing(entry: dict or None, now: float, share: float = 1.0) -> list:
+    return [
+        name for name in FETCHERS
+        if entry is None or name not in entry or now - entry[name][1] > share * TTLS[name]()
+    ]
+
+
+def _update(user_id: int, values: dict, now: float) -> dict:
+    with _lock:
+        entry = dict(_stats.get(user_id) or {})
+        entry.update({name: (value, now) for name, value in values.items()})
+        _stats[user_id] = entry
+    return {name: value for name, (value, _) in entry.items()}
+
+
+def get(session: Session, user_id: int) -> dict:
+    """
+    {'hours': ..., 'better_than': ...} of the user, expired values are fetched again
+    """
+    now = time.monotonic()
+    with _lock:
+        entry = _stats.get(user_id)
+        _active[user_id] = now
+    missing = _missing(entry, now)
+    if not missing:
+        return {name: value for name, (value, _) in entry.items()}
+    return _update(user_id, _fetch(session, missing), now)
+
+
+def refresh(session: Session, user_id: int) -> bool:
+    """
+    Fetch values of the user that are close to expiry, returns whether anything was fetched
+    """
+    now = time.monotonic()
+    with _lock:
+        entry = _stats.get(user_id)
+    missing = _missing(entry, now, REFRESH_AHEAD)
+    if missing:
+        _update(user_id, _fetch(session, missing), now)
+    return bool(missing)
+
+
+def active_users() -> list:
+    """
+    Users who looked at their statistics within ACTIVE_WINDOW
+    """
+    now = time.monotonic()
+    with _lock:
+        return [user_id for user_id, seen in _active.items() if now - seen <= ACTIVE_WINDOW]
+
+
+def forget(user_id: int) -> None:
+    with _lock:
+        _stats.pop(user_id)
+
+
+def forget_user(user_id: int) -> None:
+    """
+    Forget the user completely (e.g. logout)
+    """
+    with _lock:
+        _stats.pop(user_id)
+        _active.pop(user_id)
@@ -0,0 +1,98 @@
+from collections import deque
+from modules import metrics
+import traceback
+import threading
+import inspect
+import asyncio
+import logging
+import time
+import sys
+
+
+class LoopWatchdog:
+    """
+    Measures event loop lag with a heartbeat coroutine. A separate thread notices when
+    heartbeat is late by more than `threshold` seconds and logs stack of the code that
+    holds the loop (usually a blocking call inside of a coroutine)
+    """
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, interval: float = 0.1, threshold: float = 0.5, window: int = 3000,
+                 registry: metrics.Registry = metrics.REGISTRY):
+        self.interval = interval
+        self.threshold = threshold
+        self.registry = registry
+        self.stalls = 0
+        self._lags = deque(maxlen=window)  # recent lags for percentiles (~5 minutes by default)
+        self._last_beat = time.monotonic()
+        self._loop = None
+        self._loop_thread_id = None
+        self._task = None
+        self._stopped = threading.Event()
+
+    def start(self, loop: asyncio.AbstractEventLoop = None) -> None:
+        self._loop = loop or asyncio.get_event_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stopped.clear()
+        self._task = self._loop.create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name='loop-watchdog', daemon=True).start()
+        logging.info(f'Event loop watchdog started (stall threshold {self.threshold}s)')
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    def percentiles(self) -> dict:
+        lags = sorted(self._lags)
+        if not lags:
+            return {q: 0.0 for q in self.QUANTILES}
+        return {q: lags[min(len(lags) - 1, int(q * len(lags)))] for q in self.QUANTILES}
+
+    async def _heartbeat(self) -> None:
+        beats = 0
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self._last_beat = time.monotonic()
+            lag = max(0.0, self._last_beat - start - self.interval)
+            self._lags.append(lag)
+            self.registry.observe('loop', 'lag', lag)
+            beats += 1
+            if beats % 10 == 0:
+                for q, value in self.percentiles().items():
+                    self.registry.set_gauge('loop_lag_seconds', {'quantile': q}, value)
+
+    def _watch(self) -> None:
+        reported_beat = None
+        while not self._stopped.wait(self.interval / 2):
+            last_beat = self._last_beat
+            late = time.monotonic() - last_beat
+            if late < self.threshold or reported_beat == last_beat:
+                continue
+            reported_beat = last_beat  # report every stall once
+            self.stalls += 1
+            self.registry.set_gauge('loop_stalls_total', {}, self.stalls)
+            frame = sys._current_frames().get(self._loop_thread_id)  # one sample for the name and the stack
+            logging.warning(
+                f'Event loop is blocked for {late:.2f}s in {self._current_task_name(frame)}:\n{self._loop_stack(frame)}'
+            )
+
+    @staticmethod
+    def _current_task_name(frame) -> str:
+        """
+        Outermost coroutine on the stack of the loop thread, the entry point of the running task
+        """
+        name = None
+        while frame is not None:
+            if frame.f_code.co_flags & inspect.CO_COROUTINE:
+                name = getattr(frame.f_code, 'co_qualname', frame.f_code.co_name)
+            frame = frame.f_back
+        return 'callback outside of task' if name is None else f'task ({name})'
+
+    @staticmethod
+    def _loop_stack(frame) -> str:
+        if frame is None:
+            return '<no frame>'
+        return ''.join(traceback.format_stack(frame))
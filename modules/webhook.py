@@ -0,0 +1,111 @@
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+from typing import Callable, Awaitable
+import asyncio
+import logging
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class UpdateWorkers:
+    """
+    Fixed amount of workers that process updates received by webhook. Webhook request is
+    answered as soon as update is queued, so slow handlers do not delay telegram
+    """
+    def __init__(self, dp: Dispatcher, workers: int = 4):
+        self.dp = dp
+        self.workers = workers
+        self.queue = asyncio.Queue()
+        self._tasks = []
+
+    def __len__(self) -> int:
+        return self.queue.qsize()
+
+    async def start(self) -> None:
+        Bot.set_current(self.dp.bot)
+        Dispatcher.set_current(self.dp)
+        self._tasks = [asyncio.create_task(self._work(), name=f'update-worker-{i}') for i in range(self.workers)]
+
+    async def put(self, update: Update) -> None:
+        await self.queue.put(update)
+
+    async def stop(self, timeout: float = 30) -> None:
+        """
+        Finish already queued updates (at most `timeout` seconds) and stop workers
+        """
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f'webhook.py -> UpdateWorkers.stop -> {self.queue.qsize()} updates dropped on shutdown')
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _work(self) -> None:
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dp.updates_handler.notify(update)
+            except Exception as ex:
+                logging.exception(f'webhook.py -> UpdateWorkers -> update {update.update_id} failed: {ex}')
+            finally:
+                self.queue.task_done()
+
+
+def create_app(dp: Dispatcher, path: str, workers: int = 4, secret_token: str = None) -> web.Application:
+    """
+    aiohttp application with webhook endpoint on `path`
+    """
+    app = web.Application()
+    app['workers'] = UpdateWorkers(dp, workers)
+
+    async def handle_update(request: web.Request) -> web.Response:
+        if secret_token is not None and request.headers.get(SECRET_HEADER) != secret_token:
+            return web.Response(status=403)
+        update = Update(**await request.json())
+        await app['workers'].put(update)
+        return web.Response()
+
+    async def start_workers(_: web.Application):
+        await app['workers'].start()
+
+    async def stop_workers(_: web.Application):
+        await app['workers'].stop()
+
+    app.router.add_post(path, handle_update)
+    app.on_startup.append(start_workers)
+    app.on_shutdown.append(stop_workers)
+    return app
+
+
+def run(dp: Dispatcher, url: str, path: str = '/webhook', host: str = '0.0.0.0', port: int = 8080,
+        workers: int = 4, secret_token: str = None, on_startup: Callable[[], Awaitable] = None,
+        on_shutdown: Callable[[], Awaitable] = None) -> None:
+    """
+    Register webhook `url + path` in telegram and serve updates until SIGINT/SIGTERM.
+    Updates that came while bot was down are kept by telegram and delivered after start
+    """
+    app = create_app(dp, path, workers, secret_token)
+
+    async def register_webhook(_: web.Application):
+        await dp.bot.set_webhook(url.rstrip('/') + path, secret_token=secret_token, drop_pending_updates=False)
+        logging.info(f'Webhook set to {url.rstrip("/") + path} with {workers} update workers')
+        if on_startup is not None:
+            await on_startup()
+
+    async def stop_jobs(_: web.Application):
+        if on_shutdown is not None:
+            await on_shutdown()
+
+    async def close(_: web.Application):
+        await dp.storage.close()
+        await dp.storage.wait_closed()
+        session = await dp.bot.get_session()
+        await session.close()
+
+    app.on_startup.insert(0, register_webhook)
+    app.on_shutdown.insert(0, stop_jobs)  # no new scheduler passes while queued updates are finishing
+    app.on_cleanup.append(close)
+    web.run_app(app, host=host, port=port, loop=asyncio.get_event_loop())
@@ -0,0 +1,111 @@
+"""
+Materialised week of full users: calendar of today and the next days as the user's own session
+sees it (check-ins included). Check-in and cancel made by the bot update it in place right away
+and a background refetch confirms them, so the week image, fast uncheckin keyboard and day
+images are derived from it without another request to the sport site
+"""
+from requests.sessions import Session
+from datetime import datetime, timedelta
+from modules import api, sessions, upstream
+import threading
+import logging
+import time
+
+WEEK_TTL = 300  # seconds, check-ins made outside of the bot show up after that
+DAYS = 8  # days after today in the view
+
+_lock = threading.Lock()
+_views = sessions.LRUCache(max_size=4096)  # user_id -> (first date, sports, fetch timestamp)
+
+
+def _today() -> str:
+    return datetime.now().strftime("%Y-%m-%d")
+
+
+def _date(sport: dict) -> str:
+    return sport['start'].split('T')[0]
+
+
+def refresh(session: Session, user_id: int) -> list:
+    """
+    Fetch the week of the user, ignoring the cached one
+    """
+    start_date = _today()
+    end_date = (datetime.now() + timedelta(days=DAYS)).strftime("%Y-%m-%d")
+    sports = api.get_full_time_period(session, start_date, end_date)
+    with _lock:
+        _views[user_id] = (start_date, sports, time.monotonic())
+    return sports
+
+
+def get_week(session: Session, user_id: int, max_age: float = None) -> list:
+    with _lock:
+        entry = _views.get(user_id)
+    max_age = WEEK_TTL if max_age is None else max_age
+    if entry is not None and entry[0] == _today() and time.monotonic() - entry[2] <= max_age:
+        return entry[1]
+    return refresh(session, user_id)
+
+
+def get_day(session: Session, user_id: int, date: str) -> list:
+    """
+    Trainings of the date from the week of the user, dates out of the week are fetched directly
+    """
+    last_date = (datetime.now() + timedelta(days=DAYS)).strftime("%Y-%m-%d")
+    if not _today() <= date <= last_date:
+        return api.get_full_day(session, date)
+    return [sport for sport in get_week(session, user_id) if _date(sport) == date]
+
+
+def set_checked_in(user_id: int, training_id: int, checked_in: bool) -> None:
+    """
+    Apply check-in (or cancel) the bot has just made to the cached week, if there is one
+    """
+    with _lock:
+        entry = _views.get(user_id)
+        if entry is None:
+            return
+        sports = []
+        for sport in entry[1]:  # readers may iterate the old list, so it is copied
+            if sport['extendedProps']['id'] == training_id:
+                sport = dict(sport, extendedProps=dict(sport['extendedProps'], checked_in=checked_in, can_check_in=not checked_in))
+            sports.append(sport)
+        _views[user_id] = (entry[0], sports, entry[2])
+
+
+def confirm(session: Session, user_id: int, training_id: int, checked_in: bool) -> None:
+    """
+    Refetch the week after an optimistic update, the sport site has the last word
+    """
+    with _lock:
+        if _views.get(user_id) is None:
+            return  # nothing was updated
+    try:
+        with upstream.priority(upstream.BACKGROUND):
+            sports = refresh(session, user_id)
+    except Exception as ex:
+        forget(user_id)
+        logging.warning(f'week_view.py -> confirm -> {user_id}: {ex}')
+        return
+    for sport in sports:
+        if sport['extendedProps']['id'] == training_id and sport['extendedProps']['checked_in'] != checked_in:
+            logging.warning(f'week_view.py -> confirm -> {user_id}: training {training_id} is not {"checked in" if checked_in else "cancelled"}')
+
+
+def forget(user_id: int) -> None:
+    with _lock:
+        _views.pop(user_id)
+
+
+def forget_trainings(training_ids: set) -> int:
+    """
+    Forget weeks that contain any of the trainings (e.g. they were moved), returns amount of forgotten weeks
+    """
+    with _lock:
+        users = [
+            user_id for user_id, entry in _views.items()
+            if any(sport['extendedProps']['id'] in training_ids for sport in entry[1])
+        ]
+        for user_id in users:
+            _views.pop(user_id)
+    return len(users)